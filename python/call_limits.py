@@ -0,0 +1,160 @@
+"""Limits on the calls in flight to each peer of an RPCHandler."""
+
+import threading
+import time
+from collections import deque
+
+# What happens to a call when its peer is at its limit.
+BLOCK = 'block' # the caller waits for room (up to wait seconds)
+QUEUE = 'queue' # the call is sent when there is room; its callback waits
+FAIL = 'fail'   # the call fails at once with TooManyCalls
+
+MAX_QUEUE = 1000 # default calls waiting per peer before calls fail
+
+class TooManyCalls(Exception):
+    pass
+
+class PeerState(object):
+    """Limits and counters for the calls to one peer."""
+    def __init__(self, max_calls, max_bytes, policy, max_queue):
+        self.max_calls = max_calls
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.max_queue = max_queue
+        self.calls = 0 # in flight
+        self.bytes = 0 # sent by calls in flight
+        self.queue = deque()
+        self.peak = 0
+        self.queued = 0
+        self.blocked = 0
+        self.rejected = 0
+
+    def full(self):
+        return ((self.max_calls is not None and self.calls >= self.max_calls) or
+                (self.max_bytes is not None and self.bytes >= self.max_bytes))
+
+    def report(self):
+        return {'calls': self.calls, 'bytes': self.bytes, 'waiting': len(self.queue),
+                'max_calls': self.max_calls, 'max_bytes': self.max_bytes,
+                'max_queue': self.max_queue, 'policy': self.policy,
+                'peak': self.peak, 'queued': self.queued,
+                'blocked': self.blocked, 'rejected': self.rejected}
+
+class CallLimits(object):
+    """Per-peer limits on the number and size of unanswered calls.
+
+    A call counts against its peer from when it is sent until it is
+    answered, fails or expires (see release). Limits given here apply
+    to every peer unless changed for one with configure.
+
+    At most max_queue calls wait for each peer; further calls fail. A
+    BLOCK call made from a thread which must not block (see submit) is
+    queued instead.
+
+    :param max_calls: calls in flight per peer, or None for no limit
+    :param max_bytes: bytes sent by calls in flight, or None for no limit
+    :param policy: BLOCK, QUEUE or FAIL
+    :param wait: longest time for which a BLOCK caller waits
+    :param max_queue: calls waiting per peer, or None for no limit
+    """
+    def __init__(self, max_calls=None, max_bytes=None, policy=QUEUE, wait=10,
+                 max_queue=MAX_QUEUE):
+        self.defaults = max_calls, max_bytes, policy, max_queue
+        self.wait = wait
+        self.peers = {}
+        self.sent = {} # key -> node
+        self.sizes = {} # key -> bytes
+        self.cond = threading.Condition()
+
+    def configure(self, node, max_calls=None, max_bytes=None, policy=None,
+                  max_queue=MAX_QUEUE):
+        """Sets the limits for calls to node."""
+        with self.cond:
+            peer = self._peer(node)
+            peer.max_calls = max_calls
+            peer.max_bytes = max_bytes
+            peer.policy = policy or self.defaults[2]
+            peer.max_queue = max_queue
+            self.cond.notify_all()
+
+    def _peer(self, node):
+        try:
+            return self.peers[node]
+        except KeyError:
+            peer = self.peers[node] = PeerState(*self.defaults)
+            return peer
+
+    def submit(self, node, key, send, can_block=True):
+        """Sends a call to node now, later or not at all.
+
+        send() sends the call, returning its size in bytes or -1 if it
+        was dropped instead. Returns False if the call was rejected.
+
+        Pass can_block=False from a thread which must not block, such
+        as the one which handles replies: the release that would make
+        room could then never happen while it waits.
+        """
+        with self.cond:
+            peer = self._peer(node)
+            if peer.full():
+                if peer.policy == FAIL:
+                    peer.rejected += 1
+                    return False
+                if peer.policy == QUEUE or not can_block:
+                    if peer.max_queue is not None and len(peer.queue) >= peer.max_queue:
+                        peer.rejected += 1
+                        return False
+                    peer.queue.append((key, send))
+                    peer.queued += 1
+                    return True
+                peer.blocked += 1
+                deadline = time.time() + self.wait
+                while peer.full():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        peer.rejected += 1
+                        return False
+                    self.cond.wait(remaining)
+            self._start(peer, node, key)
+        self._send(key, send)
+        return True
+
+    def _start(self, peer, node, key):
+        peer.calls += 1
+        peer.peak = max(peer.peak, peer.calls)
+        self.sent[key] = node
+
+    def _send(self, key, send):
+        size = send()
+        if size < 0:
+            self.release(key)
+            return
+        with self.cond:
+            # The call may have been answered already.
+            node = self.sent.get(key)
+            if node is not None:
+                self.sizes[key] = size
+                self.peers[node].bytes += size
+
+    def release(self, key):
+        """Frees the room taken by the call key, sending waiting calls."""
+        ready = []
+        with self.cond:
+            node = self.sent.pop(key, None)
+            if node is None:
+                return
+            peer = self.peers[node]
+            peer.calls -= 1
+            peer.bytes -= self.sizes.pop(key, 0)
+            while peer.queue and not peer.full():
+                next_key, send = peer.queue.popleft()
+                self._start(peer, node, next_key)
+                ready.append((next_key, send))
+            self.cond.notify_all()
+        for next_key, send in ready:
+            self._send(next_key, send)
+
+    def report(self):
+        """Returns the limits and counters of each peer."""
+        with self.cond:
+            return dict((node, peer.report()) for node, peer in self.peers.iteritems())
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+"""Tests for CallLimits."""
+
+import time
+import unittest
+from serf.call_limits import CallLimits, TooManyCalls, BLOCK, QUEUE, FAIL
+from serf.mock_net import MockNet
+from serf.rpc_handler import CallTimeout
+from serf.serializer import SerializationError
+from serf.test_object import TestObject
+from serf.worker import Worker
+
+class CallLimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.net = MockNet()
+        self.na, self.va = self.net.addRPCHandler('A', '', {})
+        self.na['obj'] = TestObject()
+        self.nb, self.vb = self.net.addRPCHandler('B', '', {})
+        self.received = []
+        def stall(ev, msg):
+            self.received.append(msg)
+        self.stall = stall # subscriptions are weak
+        self.net.addNode('C').subscribe('message', stall) # never replies
+
+    def testReplies(self):
+        self.vb.setLimits(CallLimits(max_calls=1, policy=FAIL))
+        for i in range(3):
+            self.assertEqual(self.vb.call('A', 'obj', 'incr', [i]).wait(), i + 1)
+        self.assertEqual(self.vb.limits.report()['A']['calls'], 0)
+        self.assertEqual(self.vb.limits.report()['A']['bytes'], 0)
+
+    def testQueue(self):
+        self.vb.setLimits(CallLimits(max_calls=2, policy=QUEUE))
+        now = time.time()
+        cbs = [self.vb.call('C', 'x', 'foo', [], t) for t in (5, 50, 50)]
+        self.assertEqual(len(self.received), 2)
+        peer = self.vb.stats.peers()['C']
+        self.assertEqual((peer['calls'], peer['waiting'], peer['queued']), (2, 1, 1))
+
+        self.vb.expireCalls(now + 10) # frees room for the queued call
+        self.assertRaises(CallTimeout, cbs[0].wait)
+        self.assertEqual(len(self.received), 3)
+        self.assertEqual(self.vb.stats.peers()['C']['waiting'], 0)
+
+    def testQueuedBadCall(self):
+        self.vb.setLimits(CallLimits(max_calls=1, policy=QUEUE))
+        cbs = [self.vb.call('C', 'x', 'foo', args) for args in ([], [object()], [])]
+        self.vb.handleReply(cbs[0].reply_addr, {'r': 1})
+        self.assertEqual(cbs[0].wait(), 1)
+        self.assertRaises(SerializationError, cbs[1].wait)
+        self.assertEqual(len(self.received), 2) # the third call was sent
+        peer = self.vb.stats.peers()['C']
+        self.assertEqual((peer['calls'], peer['waiting']), (1, 0))
+
+    def testQueuedExpiry(self):
+        self.vb.setLimits(CallLimits(max_calls=1, policy=QUEUE))
+        now = time.time()
+        cbs = [self.vb.call('C', 'x', 'foo', [], t) for t in (50, 5)]
+        self.vb.expireCalls(now + 10) # the queued call expires unsent
+        self.assertRaises(CallTimeout, cbs[1].wait)
+        self.vb.expireCalls(now + 60)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.vb.stats.peers()['C']['calls'], 0)
+
+    def testFail(self):
+        limits = CallLimits(policy=FAIL)
+        limits.configure('C', max_calls=1)
+        self.vb.setLimits(limits)
+        self.vb.call('C', 'x', 'foo', [])
+        self.assertRaises(TooManyCalls, self.vb.call('C', 'x', 'foo', []).wait)
+        self.assertEqual(self.vb.callbacks.keys(), [self.vb.reply_prefix])
+        self.assertEqual(self.vb.stats.peers()['C']['rejected'], 1)
+
+    def testBlock(self):
+        worker = Worker() # calls from this thread are then foreign
+        net = MockNet()
+        nb, vb = net.addRPCHandler('B', '', {}, t_model=worker)
+        net.addNode('C').subscribe('message', self.stall)
+        worker.start()
+        try:
+            vb.setLimits(CallLimits(max_bytes=1, policy=BLOCK, wait=0.05))
+            vb.call('C', 'x', 'foo', [])
+            self.assertRaises(TooManyCalls, vb.call('C', 'x', 'foo', []).wait)
+            peer = vb.stats.peers()['C']
+            self.assertEqual((peer['blocked'], peer['rejected']), (1, 1))
+            self.assertTrue(peer['bytes'] > 0)
+        finally:
+            worker.stop()
+
+    def testBlockInDispatchThread(self):
+        # Synchronous calls are made in the dispatch thread, so they queue.
+        self.vb.setLimits(CallLimits(max_calls=1, policy=BLOCK, wait=0.05))
+        now = time.time()
+        for t in (5, 50):
+            self.vb.call('C', 'x', 'foo', [], t)
+        self.assertEqual(len(self.received), 1)
+        peer = self.vb.stats.peers()['C']
+        self.assertEqual((peer['blocked'], peer['queued']), (0, 1))
+        self.vb.expireCalls(now + 10)
+        self.assertEqual(len(self.received), 2)
+
+    def testMaxQueue(self):
+        self.vb.setLimits(CallLimits(max_calls=1, policy=QUEUE, max_queue=2))
+        self.vb.call('C', 'x', 'foo', [])
+        cbs = [self.vb.call('C', 'x', 'foo', []) for i in range(3)]
+        self.assertRaises(TooManyCalls, cbs[2].wait)
+        peer = self.vb.stats.peers()['C']
+        self.assertEqual((peer['waiting'], peer['queued'], peer['rejected']), (2, 2, 1))
+        self.assertEqual(self.vb.limits.report()['C']['max_queue'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
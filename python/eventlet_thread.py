@@ -10,8 +10,8 @@ class EventletCallback(object):
     def __init__(self):
         self.event = Event()
 
-    def wait(self):
-        with eventlet.Timeout(10):
+    def wait(self, timeout=10):
+        with eventlet.Timeout(timeout):
             return self.event.wait()
 
     def success(self, result):
@@ -27,6 +27,7 @@ class EventletThread(object):
         self.lock = None
         self.queue = []
         self.thread = None
+        self.hub_thread = None
         atexit.register(self.stop)
 
     def start(self, thread=False):
@@ -38,6 +39,7 @@ class EventletThread(object):
             self.thread.setDaemon(True)
             self.thread.start()
         else:
+            self.hub_thread = threading.currentThread()
             eventlet.spawn_n(self.run)
 
     def run(self):
@@ -61,6 +63,9 @@ class EventletThread(object):
             self.thread.join()
             self.thread = None
 
+    def inDispatchThread(self):
+        return threading.currentThread() in (self.thread, self.hub_thread)
+
     def makeCallback(self):
         return EventletCallback()
 
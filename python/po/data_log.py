@@ -1,17 +1,19 @@
 """Same as LogFile but stores serializable data structures."""
 
-from serf.serializer import encodes, decodes
+from serf.serializer import decodes, COMPACT_ENCODER
 from serf.storage import StorageCtx
 from serf.po.log_file import LogFile
 from serf.po.group import Group
 
 class DataLog(object):
-    serialize = ('#env', 'fh', 'obs')
+    serialize = ('#env', 'fh', 'obs', 'compact')
 
-    def __init__(self, env, fh=None, obs=None, begin=0, bm_gap=None):
+    def __init__(self, env, fh=None, obs=None, compact=False, begin=0, bm_gap=None):
         self.env = env
         self.fh = env.storage().makeFile() if fh is None else fh
         self.obs = Group() if obs is None else obs
+        self.compact = bool(compact)
+        self.encoders = COMPACT_ENCODER if compact else None
         self.log = LogFile(self.fh, begin, bm_gap)
         self.storage_ctx = StorageCtx(self.env.storage())
 
@@ -22,7 +24,7 @@ class DataLog(object):
         return [decodes(s, self.storage_ctx) for s in self.log[i:j]]
 
     def append(self, value):
-        index = self.log.append(encodes(value, self.storage_ctx))
+        index = self.log.appendValue(value, self.storage_ctx, self.encoders)
         self.obs.add(index, value)
         return index
 
@@ -60,6 +60,23 @@ class DataLogTest(unittest.TestCase):
         self.assertEqual(dl.end(), 3)
         self.assertEqual(dl[0:2], [1, 'two'])
 
+    def testCompact(self):
+        e = Env()
+        v = e.storage()
+
+        dl = DataLog(e, File(v, 'f'), compact=True)
+        v['dl'] = dl
+        rec = {'pkey': 7, 'count': 12, 'name': 'x'}
+        dl.append(rec)
+        self.assertEqual(len(dl.log[0]), 27)
+        self.assertEqual(dl[0], rec)
+
+        del dl
+        dl = v['dl']
+        self.assertTrue(dl.compact)
+        dl.append(rec)
+        self.assertEqual(dl.log[1], dl.log[0])
+
 
 if __name__ == '__main__':
     unittest.main()
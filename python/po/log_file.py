@@ -3,6 +3,19 @@
 import os
 import struct
 from serf.po.file import openFile
+from serf.serializer import encodes, encodeb
+
+# Values at least this big are encoded straight into the entry buffer.
+PREALLOC_MIN = 65536
+
+def minEncodedSize(value):
+    """A lower bound on the encoded size of value, from its top level only."""
+    t = type(value)
+    if t is str or t is unicode or t is bytearray or t is list or t is tuple:
+        return len(value)
+    if t is dict:
+        return 2 * len(value)
+    return 0
 
 class IncompleteRead(Exception):
     pass
@@ -83,16 +96,37 @@ class LogFile(object):
             raise BadSequence('Found seq=%d at position %d' % (seq, i))
         return item
 
-    def append(self, item):
+    def _seekEnd(self):
         self.fh.seek(0, os.SEEK_END) # could omit if fh is open in 'a+'
         if self._end % self._bookmark_gap == 0:
             self._bookmarks[self._end / self._bookmark_gap] = self.fh.tell()
+
+    def append(self, item):
+        self._seekEnd()
         self.fh.write(struct.pack('>I', len(item)))
         self.fh.write(item)
         self.fh.write(struct.pack('>q', self._end))
         self._end += 1
         return self._end - 1
 
+    def appendValue(self, value, ctx=None, encoders=None):
+        """Appends the encoding of value.
+
+        Large values are encoded into a buffer allocated once for the
+        whole entry, which is written in one piece. Sizing first costs
+        more CPU than encodes, so smaller values use append(encodes(...)).
+        """
+        if minEncodedSize(value) < PREALLOC_MIN:
+            return self.append(encodes(value, ctx, None, encoders))
+        entry = encodeb(value, ctx, encoders=encoders, head=4, tail=8)
+        n = len(entry) - 12
+        struct.pack_into('>I', entry, 0, n)
+        struct.pack_into('>q', entry, 4 + n, self._end)
+        self._seekEnd()
+        self.fh.write(entry)
+        self._end += 1
+        return self._end - 1
+
     def begin(self):
         return self._begin
 
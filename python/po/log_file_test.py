@@ -5,7 +5,8 @@
 import os
 import unittest
 from serf.po.file import TestFile
-from serf.po.log_file import LogFile
+from serf.po.log_file import LogFile, PREALLOC_MIN
+from serf.serializer import encodes
 
 class LogFileTest(unittest.TestCase):
     def setUp(self):
@@ -69,6 +70,18 @@ class LogFileTest(unittest.TestCase):
 
         self.assertEqual(log[398:402], ['item400', 'item401'])
 
+    def testAppendValue(self):
+        f = TestFile()
+        log = LogFile(f)
+        log.append('item0')
+        self.assertEqual(log.appendValue({'n': 1}), 1)
+        self.assertEqual(log.appendValue([u'x'] * 3), 2)
+        big = range(PREALLOC_MIN)
+        self.assertEqual(log.appendValue(big), 3)
+        log = LogFile(f)
+        self.assertEqual(log.end(), 4)
+        self.assertEqual(log[0:4], ['item0', encodes({'n': 1}), encodes([u'x'] * 3), encodes(big)])
+
 
 if __name__ == '__main__':
     unittest.main()
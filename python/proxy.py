@@ -1,10 +1,11 @@
 """Opaque handle for making remote calls."""
 
 class Proxy(object):
-    def __init__(self, node, path, vat=None):
+    def __init__(self, node, path, vat=None, timeout=None):
         self._node = node
         self._path = path
         self._vat = vat
+        self._timeout = timeout
 
     def __getattr__(self, method):
         if method.startswith('_'):
@@ -15,15 +16,23 @@ class Proxy(object):
 
     def _getattr(self, method):
         def _mcall(*args):
-            cb = self._vat.call(self._node, self._path, method, args)
-            return cb.wait()
+            cb = self._vat.call(self._node, self._path, method, args, self._timeout)
+            return self._vat.waitFor(cb)
         return _mcall
 
     def _getattr_f(self, method):
         def _mcall_f(*args):
-            return self._vat.call(self._node, self._path, method, args)
+            return self._vat.call(self._node, self._path, method, args, self._timeout)
         return _mcall_f
 
+    def _withTimeout(self, secs):
+        """Returns a Proxy whose calls fail if not answered within secs."""
+        return Proxy(self._node, self._path, self._vat, secs)
+
+    def _batch(self):
+        """Returns a Batch for calls to objects on this proxy's node."""
+        return Batch(self._vat, self._node, self._path)
+
     def __getitem__(self, key):
         return self._getattr('__getitem__')(key)
 
@@ -52,3 +61,81 @@ class Proxy(object):
 
     def _ext_encoding(self):
         return 'Proxy', {'n': self._node, 'o': self._path}
+
+
+class Batch(object):
+    """Collects calls to objects on one node and sends them together.
+
+    Used as a context manager:
+
+        with proxy._batch() as b:
+            f1 = b.get('x')
+            f2 = b.on(other).update('y', 1)
+        f1.wait(), f2.wait()
+
+    Each call returns a callback (future) immediately. The calls are sent
+    as a single message on leaving the with block (or by send()), run in
+    order at the far end, and all answered by one reply.
+    """
+    def __init__(self, vat, node, path=None):
+        self._vat = vat
+        self._node = node
+        self._path = path
+        self._calls = []
+        self._cbs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return self.on(self._path).__getattr__(method)
+
+    def on(self, target):
+        """Returns a BatchProxy for calls to target, a Proxy or path."""
+        if type(target) is Proxy:
+            if target._node != self._node:
+                raise ValueError('batch is for node %s' % self._node)
+            target = target._path
+        return BatchProxy(self, target)
+
+    def add(self, path, method, args):
+        """Adds a call to the batch and returns its callback."""
+        if self._cbs is None:
+            raise ValueError('batch already sent')
+        cb = self._vat.thread_model.makeCallback()
+        self._calls.append([path, method, list(args)])
+        self._cbs.append(cb)
+        return cb
+
+    def send(self):
+        """Sends the calls collected so far."""
+        calls, cbs = self._calls, self._cbs
+        self._cbs = None
+        if calls:
+            self._vat.callBatch(self._node, calls, cbs)
+
+
+class BatchProxy(object):
+    """Proxy-like handle whose method calls are added to a Batch."""
+    def __init__(self, batch, path):
+        self._batch = batch
+        self._path = path
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def _bcall(*args):
+            return self._batch.add(self._path, method, args)
+        return _bcall
+
+    def __getitem__(self, key):
+        return self._batch.add(self._path, '__getitem__', [key])
+
+    def __call__(self, *args):
+        return self._batch.add(self._path, '__call__', args)
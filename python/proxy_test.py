@@ -7,6 +7,7 @@ from serf.mock_net import MockNet, MockTransport
 from serf.rpc_handler import RPCHandler
 from serf.test_object import TestObject
 from serf.proxy import Proxy
+from serf.util import gather
 
 
 class ProxyTest(unittest.TestCase):
@@ -59,6 +60,49 @@ class ProxyTest(unittest.TestCase):
         # get object at pb to increment
         self.assertEqual(pr.callIncr(2), 3)
 
+    def testGather(self):
+        net = MockNet()
+        na, va = net.addRPCHandler('A', '', {})
+        nb, vb = net.addRPCHandler('B', '', {})
+        va.provide('addr', TestObject())
+        pr = Proxy('A', 'addr', vb)
+
+        cbs = [pr.incr_f(i) for i in range(100)]
+        self.assertEqual(gather(cbs), range(1, 101))
+
+        cbs = [pr.incr_f(1), pr.incr_f('x')]
+        self.assertRaises(TypeError, gather, cbs)
+        r = gather(cbs, return_exceptions=True, timeout=1)
+        self.assertEqual(r[0], 2)
+        self.assertEqual(type(r[1]), TypeError)
+
+    def testBatch(self):
+        net = MockNet()
+        na, va = net.addRPCHandler('A', '', {})
+        nb, vb = net.addRPCHandler('B', '', {})
+        va.provide('addr', TestObject())
+        va.provide('other', TestObject())
+
+        received = []
+        def count(ev, msg):
+            received.append(msg)
+        net.end['A'].subscribe('message', count)
+
+        pr = Proxy('A', 'addr', vb)
+        with pr._batch() as b:
+            f1 = b.incr(1)
+            f2 = b.incr('x')
+            f3 = b.on(Proxy('A', 'other', vb)).incr(5)
+            f4 = b.foo()
+        self.assertEqual(len(received), 1)
+        self.assertEqual(f1.wait(), 2)
+        self.assertRaises(TypeError, f2.wait)
+        self.assertEqual(f3.wait(), 6)
+        self.assertRaises(AttributeError, f4.wait)
+
+        self.assertRaises(ValueError, b.incr, 1) # already sent
+        self.assertRaises(ValueError, b.on, Proxy('B', 'x', vb))
+
     def testProxyEquality(self):
         va0 = RPCHandler(MockTransport('A'), {})
         va1 = RPCHandler(MockTransport('A'), {})
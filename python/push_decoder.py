@@ -0,0 +1,104 @@
+"""Incremental decoding of serf-encoded data arriving in chunks.
+
+The codecs read from file-like objects. A PushDecoder runs decode in a
+greenlet whose reads suspend it until enough data has been fed, so a
+value is decoded as it arrives and its partial state is simply the
+suspended decode.
+"""
+
+from collections import deque
+import greenlet
+from serf.serializer import decode, SerializationError
+
+class PushDecoder(object):
+    """Decodes a sequence of top-level values fed in arbitrary chunks.
+
+    :param ctx: serializer context used for decoding
+    """
+    def __init__(self, ctx=None):
+        self.ctx = ctx
+        self._chunks = deque()
+        self._pos = 0 # read position in _chunks[0]
+        self._avail = 0
+        self._closed = False
+        self._values = []
+        self._busy = False
+        self._parser = greenlet.greenlet(self._parse)
+
+    def feed(self, data):
+        """Adds data to the input.
+
+        Returns the list of values completed by the data, if any.
+        """
+        if self._closed:
+            raise SerializationError('feed after close')
+        if data:
+            self._chunks.append(data)
+            self._avail += len(data)
+            self._resume()
+        values, self._values = self._values, []
+        return values
+
+    def close(self):
+        """Signals the end of the input.
+
+        Returns any remaining values. Raises SerializationError if
+        the input ended part way through a value.
+        """
+        self._closed = True
+        self._resume()
+        values, self._values = self._values, []
+        return values
+
+    def pending(self):
+        """Returns True if a value has been partly received."""
+        return self._busy or self._avail > 0
+
+    def _resume(self):
+        if self._parser.dead:
+            raise SerializationError('decoder failed')
+        self._parser.parent = greenlet.getcurrent()
+        self._parser.switch()
+
+    def _wait(self):
+        self._parser.parent.switch()
+
+    def _parse(self):
+        while True:
+            self._busy = False
+            while not self._avail:
+                if self._closed:
+                    return
+                self._wait()
+            self._busy = True
+            value = decode(self, self.ctx)
+            self._values.append(value)
+
+    def read(self, n):
+        """File-like read, called by the codecs from the parser greenlet."""
+        if n == 0:
+            return ''
+        while self._avail < n:
+            if self._closed:
+                raise SerializationError('truncated data')
+            self._wait()
+        self._avail -= n
+        chunks = self._chunks
+        first = chunks[0]
+        pos = self._pos
+        if len(first) - pos > n:
+            self._pos = pos + n
+            return first[pos:pos + n]
+        parts = []
+        while n:
+            first = chunks[0]
+            part = first[pos:pos + n]
+            parts.append(part)
+            n -= len(part)
+            if pos + len(part) == len(first):
+                chunks.popleft()
+                pos = 0
+            else:
+                pos += len(part)
+        self._pos = pos
+        return ''.join(parts)
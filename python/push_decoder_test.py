@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+"""Tests for PushDecoder."""
+
+import unittest
+from serf.push_decoder import PushDecoder
+from serf.serializer import encodes, SerializationError
+
+VALUES = [42, {'name': u'Fred', 'tags': ['a', 'b']}, None, 'x' * 5000,
+          [i * 0.5 for i in range(100)]]
+
+class PushDecoderTest(unittest.TestCase):
+    def testWhole(self):
+        d = PushDecoder()
+        self.assertEqual(d.feed(''.join(map(encodes, VALUES))), VALUES)
+        self.assertFalse(d.pending())
+        self.assertEqual(d.close(), [])
+
+    def testBytewise(self):
+        d = PushDecoder()
+        data = ''.join(map(encodes, VALUES))
+        values = []
+        for c in data:
+            values.extend(d.feed(c))
+        self.assertEqual(values, VALUES)
+
+    def testChunks(self):
+        d = PushDecoder()
+        data = ''.join(map(encodes, VALUES))
+        self.assertEqual(d.feed(data[:1000]), VALUES[:3])
+        self.assertTrue(d.pending())
+        self.assertEqual(d.feed(data[1000:5000]), [])
+        self.assertEqual(d.feed(data[5000:]), VALUES[3:])
+        self.assertFalse(d.pending())
+
+    def testEmptyStrings(self):
+        for value in ['', u'', {'a': ''}, ['x', '']]:
+            d = PushDecoder()
+            self.assertEqual(d.feed(encodes(value)), [value])
+            self.assertEqual(d.feed(encodes(42)), [42])
+            values = []
+            for c in encodes(value) + encodes(1):
+                values.extend(d.feed(c))
+            self.assertEqual(values, [value, 1])
+
+    def testTruncated(self):
+        d = PushDecoder()
+        self.assertEqual(d.feed(encodes(1) + encodes('Fred')[:-1]), [1])
+        self.assertRaises(SerializationError, d.close)
+
+    def testBadData(self):
+        d = PushDecoder()
+        self.assertRaises(KeyError, d.feed, '!')
+        self.assertRaises(SerializationError, d.feed, encodes(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,27 @@
 """Another attempt to model persistence."""
 
+import inspect
+import itertools
+import random
+import threading
+import time
+import traceback
+import types
 import weakref
+from collections import deque
 from cStringIO import StringIO
-from serf.serializer import encode, decode, encodes, decodes, SerializationError, POD_TYPES
+from serf.serializer import encode, decode, decodeFrom, encodes, decodes, SerializationError, POD_TYPES, Schema
+from serf.serializer import COMPACT_ENCODER, UNIFORM_ENCODER, PACKED_ENCODER, INTERNED, compress
 from serf.ref import Ref
 from serf.synchronous import Synchronous
-from serf.util import randomString, rmap, importSymbol
+from serf.util import rmapShared, importSymbol
 from serf.proxy import Proxy
-from serf.storage import StorageCtx
+from serf.storage import StorageCtx, recordPlan, classPlan
 from serf.json_codec import JSON_CODEC
 from serf.bound_method import JCBoundMethod
+from serf.timer_wheel import TimerWheel
+from serf.rpc_stats import RPCStats
+from serf.call_limits import TooManyCalls
 
 
 # Most of what happens here is converting stuff, either for
@@ -51,6 +63,76 @@ class NoSuchObject(Exception):
 class NoSuchName(Exception):
     pass
 
+class CallTimeout(Exception):
+    pass
+
+CALL_TIMEOUT = 60 # default seconds before an unanswered call fails
+
+STREAM_CHUNK = 100 # items per chunk of a streamed result
+STREAM_WINDOW = 4 # chunks sent ahead of the receiver
+
+# Reply addresses are ints: a random per-process prefix above a per-handler
+# counter, so that replies meant for an earlier process are not mistaken
+# for replies to this one's calls. They stay below 2**53 so that
+# JavaScript clients can echo them back exactly. Peers which do not
+# support them (see transport.FEATURES) are sent '@' and the number.
+REPLY_PREFIX = random.getrandbits(20) << 32
+REPLY_MASK = (1 << 32) - 1
+
+# Special methods which may be called remotely. Other names starting
+# with '_' are private, as they are for Proxy.
+PUBLIC_SPECIAL = frozenset(['__call__', '__getitem__', '__setitem__', '__delitem__'])
+
+_methods = weakref.WeakKeyDictionary() # class -> {method name -> (classes, function), or None}
+
+def classMethod(cls, method):
+    """Returns the function implementing method for instances of cls.
+
+    The result is (classes, function) where classes runs along the mro
+    of cls up to the class whose __dict__ holds function. Returns None
+    when the method has to be looked up on each instance, e.g. because
+    it is not a plain function of the class.
+    """
+    if '__getattribute__' in cls.__dict__:
+        return None
+    mro = inspect.getmro(cls)
+    for i, owner in enumerate(mro):
+        if method in owner.__dict__:
+            func = owner.__dict__[method]
+            if type(func) is not types.FunctionType:
+                return None
+            return mro[:i + 1], func
+    return None
+
+def methodFor(obj, method):
+    """Returns the (unbound) function for obj.method, or None.
+
+    The lookup is cached per class and checked against the class
+    dictionaries on each use, so patched methods are picked up.
+    """
+    cls = obj.__class__
+    try:
+        entry = _methods[cls][method]
+    except KeyError:
+        entry = _methods.setdefault(cls, {})[method] = classMethod(cls, method)
+    if entry is None:
+        return None
+    classes, func = entry
+    for c in classes[:-1]:
+        if method in c.__dict__:
+            break
+    else:
+        if classes[-1].__dict__.get(method) is func:
+            classes = None
+    if classes is not None: # stale: the method was patched
+        entry = _methods[cls][method] = classMethod(cls, method)
+        if entry is None:
+            return None
+        func = entry[1]
+    if method in getattr(obj, '__dict__', ()):
+        return None
+    return func
+
 class SendErrorCb(object):
     def __init__(self, vat, sender_cb_id):
         self.vat = vat
@@ -59,6 +141,138 @@ class SendErrorCb(object):
     def failure(self, exc):
         self.vat.lput(self.cb_id, {'e': exc})
 
+def isIterator(value):
+    """Returns True if value is an iterator (e.g. a generator)."""
+    return (type(value) not in POD_TYPES and hasattr(value, 'next') and
+            hasattr(value, '__iter__'))
+
+class OutStream(object):
+    """The sending end of a streamed result."""
+    def __init__(self, path, items, node, reply_addr, stream_id, credit):
+        self.path = path
+        self.items = items
+        self.node = node
+        self.reply_addr = reply_addr
+        self.id = stream_id
+        self.credit = credit
+
+class ResultStream(object):
+    """Iterator over a result streamed in chunks.
+
+    Returned in place of the result of a remote method which returned
+    an iterator. Each chunk consumed earns the sender credit for one
+    more, so at most the sender's window of chunks is buffered.
+    """
+    def __init__(self, vat, node, stream_id, reply_addr, deadline):
+        self.vat = vat
+        self.node = node
+        self.stream_id = stream_id
+        self.reply_addr = reply_addr
+        self.deadline = deadline # moved on by each chunk
+        self.chunks = deque()
+        self.items = iter(())
+        self.ended = False
+        self.exc = None
+        self.waiter = None
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            for item in self.items:
+                return item
+            waiter = None
+            with self.lock:
+                if self.chunks:
+                    self.items = iter(self.chunks.popleft())
+                    credit = not self.ended
+                elif self.exc is not None:
+                    raise self.exc
+                elif self.ended:
+                    raise StopIteration
+                else:
+                    waiter = self.waiter = self.vat.thread_model.makeCallback()
+            if waiter is not None:
+                self._wait(waiter)
+            elif credit:
+                self.vat.send(self.node, self.stream_id, {'k': 1})
+
+    def _wait(self, waiter):
+        # Like RPCHandler.waitFor, waits until the stream's deadline.
+        try:
+            waiter.wait(max(self.deadline - time.time(), 0))
+            return
+        except:
+            with self.lock:
+                if self.waiter is waiter:
+                    self.waiter = None
+                if self.chunks or self.exc is not None:
+                    return
+            if time.time() < self.deadline:
+                raise
+        self.vat._expire(self.reply_addr)
+        self.vat._release(self.reply_addr)
+        self.failure(CallTimeout(self.reply_addr))
+
+    def close(self):
+        """Tells the sender that no more items are wanted."""
+        with self.lock:
+            ended, self.ended = self.ended, True
+            self.chunks.clear()
+            self.items = iter(())
+        if not ended:
+            self.vat.send(self.node, self.stream_id, {'k': 0, 'x': 1})
+
+    def chunk(self, items, end):
+        with self.lock:
+            if not self.ended:
+                self.chunks.append(items)
+                self.ended = end
+            waiter, self.waiter = self.waiter, None
+        if waiter is not None:
+            waiter.success(None)
+
+    def failure(self, exc):
+        with self.lock:
+            self.exc = exc
+            self.ended = True
+            waiter, self.waiter = self.waiter, None
+        if waiter is not None:
+            waiter.success(None)
+
+class BatchCb(object):
+    """Passes the results of a batch of calls to their callbacks."""
+    def __init__(self, cbs):
+        self.cbs = cbs
+
+    def success(self, results):
+        for cb, result in zip(self.cbs, results):
+            if 'r' in result:
+                cb.success(result['r'])
+            else:
+                exc = result['e']
+                cb.failure(decodeException(exc) if type(exc) is list else exc)
+
+    def failure(self, exc):
+        for cb in self.cbs:
+            cb.failure(exc)
+
+class ForwardedBatchCb(object):
+    """Passes the results of a forwarded batch on as done(i, result)."""
+    def __init__(self, done, indices):
+        self.done = done
+        self.indices = indices
+
+    def success(self, results):
+        for i, result in zip(self.indices, results):
+            self.done(i, result)
+
+    def failure(self, exc):
+        for i in self.indices:
+            self.done(i, {'e': encodeException(exc)})
+
 def encodeException(e):
     return [type(e).__name__] + list(e.args)
 
@@ -70,11 +284,12 @@ def decodeException(e):
 
 
 class RemoteCtx(object):
-    def __init__(self, vat, msg_data=None):
+    def __init__(self, vat, msg_data=None, schema=None):
         self.vat = weakref.ref(vat)
         self.node_id = vat.node_id
         self.safe = vat.safe
         self.msg_data = msg_data or {}
+        self.schema = schema
 
     def _safe_cls(self, cls):
         for prefix in self.safe:
@@ -85,7 +300,7 @@ class RemoteCtx(object):
     def custom(self, name, data):
         if name == 'ref':
             node = data['node']
-            if node == self.node_id:
+            if node == self.node_id and self.vat().ownsPath(data['path']):
                 return Ref(self.vat().storage, data['path'])
             if node == '-':
                 node = self.msg_data.get('from')
@@ -94,13 +309,13 @@ class RemoteCtx(object):
             return decodeException(data)
 
         if name == 'inst' and self._safe_cls(data['CLS']):
-            cls = importSymbol(data['CLS'])
+            plan = classPlan(data['CLS'])
             try:
-                args = [data[key.lstrip('_')] for key in cls.serialize]
+                args = [data[key] for key in plan.args]
             except KeyError:
                 raise SerializationError(name + ': ' + repr(data))
             else:
-                return cls(*args)
+                return plan.cls(*args)
 
         raise SerializationError(name)
 
@@ -118,12 +333,12 @@ class RemoteCtx(object):
             return 'ref', {'path': inst._path, 'node': inst._node}
 
         # Serialize instances without any capability members.
-        s_attrs = getattr(t, 'serialize', None)
-        if type(s_attrs) is tuple and not [a for a in s_attrs if a.startswith('_')]:
-            data = dict([(key.lstrip('_'), getattr(inst, key)) for key in s_attrs])
-            cls = inst.__class__
-            data['CLS'] = '%s.%s' % (cls.__module__, cls.__name__)
-            return 'inst', data
+        if type(getattr(t, 'serialize', None)) is tuple:
+            plan = recordPlan(t)
+            if not plan.private:
+                data = plan.getDict(inst)
+                data['CLS'] = plan.name
+                return 'inst', data
 
         raise SerializationError(str(t))
 
@@ -269,18 +484,81 @@ class RPCHandler(object):
     :param t_model: a thread model
     :param verbose: whether to print debugging output
     :param jc_opts: options for the JSONCodec
+    :param serf_opts: options for the serf protocol
+
+    Serf protocol options:
+
+    schemas: send each compound type descriptor only once per
+        connection, referring to it by id thereafter. The peer must
+        understand schema references.
+    compact: use the compact (varint) encoding for outgoing messages.
+        The peer must understand the compact encoding.
+    packed: write long lists of numbers as PACKED blocks. The peer
+        must understand PACKED, which the C++ serializer does not.
+        Implied by compact, uniform and intern.
+    uniform: encode lists and dicts whose items are all alike with a
+        single item codec. Takes precedence over compact.
+    intern: write each distinct dict key and short string once per
+        message. Takes precedence over uniform and compact.
+    compress: compress outgoing messages of at least this many bytes,
+        for peers whose transport handshake offered compression.
+
+    Calls handled are counted in stats (an RPCStats, or None to turn
+    counting off), which can be served with rpc_stats.StatsView.
+
+    Calls to each peer can be limited by setLimits (see CallLimits).
+
+    A method returning an iterator has its items sent in chunks of
+    stream_chunk items, with credit for stream_window chunks at a time,
+    and the caller receives a ResultStream.
+
+    Calls not answered within call_timeout seconds (or the time given
+    for the method in method_timeouts, or by the calling Proxy) fail
+    with CallTimeout. Deadlines are kept in a TimerWheel which is
+    advanced on each call and, where the thread model has callAfter,
+    every tick while calls are outstanding.
     """
-    def __init__(self, transport, storage, t_model=None, verbose=False, jc_opts=None):
+    def __init__(self, transport, storage, t_model=None, verbose=False, jc_opts=None,
+                 serf_opts=None):
         thread_model = Synchronous() if t_model is None else t_model
         self.storage = storage
         self.node_id = transport.node_id
         self.vat_id = transport.path
         self.node = transport
-        self.callbacks = {}
+        self.callbacks = {} # reply address -> callback
+        self.reply_ids = itertools.count()
+        self.reply_prefix = REPLY_PREFIX
+        self.shard = None # see setShard
+        self.call_timeout = CALL_TIMEOUT
+        self.method_timeouts = {}
+        self.timers = TimerWheel()
+        self.expiry_scheduled = False
+        self.stats = RPCStats()
+        self.limits = None # see setLimits
+        self.streams = {} # stream id -> OutStream
+        self.stream_chunk = STREAM_CHUNK
+        self.stream_window = STREAM_WINDOW
         self.thread_model = thread_model
+        # Thread models with callFor run calls to one object in order.
+        self.call_for = getattr(thread_model, 'callFor', None)
         self.verbose = verbose
         self.safe = []
+        serf_opts = serf_opts or {}
+        self.stream_schemas = serf_opts.get('schemas', False)
+        if serf_opts.get('uniform'):
+            self.encoders = UNIFORM_ENCODER
+        elif serf_opts.get('compact'):
+            self.encoders = COMPACT_ENCODER
+        elif serf_opts.get('packed'):
+            self.encoders = PACKED_ENCODER
+        else:
+            self.encoders = None
+        self.encoder = INTERNED if serf_opts.get('intern') else None
+        self.compress_min = serf_opts.get('compress')
+        self.out_schemas = {}
+        self.in_schemas = {}
         transport.subscribe('message', self.handle)
+        transport.subscribe('disconnected', self._dropSchemas)
         transport.subscribe('online', self._notifyNodeObserver)
         transport.subscribe('connected', self._notifyNodeObserver)
         self.refs = []
@@ -291,6 +569,7 @@ class RPCHandler(object):
             storage.setContextFactory(makeStorageCtx)
             # NOTE: this is for the node observer.
             storage.getRPC = lambda: rpc
+            storage.resources['#rpc_stats'] = self.stats
         self.remote_ctx = RemoteCtx(self)
         self.json_ctx = JSONCodecCtx(self, **(jc_opts or {}))
 
@@ -311,7 +590,8 @@ class RPCHandler(object):
 
         Messages are not encoded. They may be going from one
         RPCHandler to another so localize is called to convert Refs to
-        Proxies and vice-versa.
+        Proxies and vice-versa. Plain data is passed on without copying
+        (see rmapShared).
 
         Args:
             addr: instance to which message is addressed
@@ -320,7 +600,7 @@ class RPCHandler(object):
         self.thread_model.callFromThread(self._nhandle, addr, msg)
 
     def _nhandle(self, addr, msg):
-        msg = rmap(self.localize, msg)
+        msg = rmapShared(self.localize, msg)
         self._handle(addr, msg, self.node_id)
 
     def _peer_protocol(self, node):
@@ -333,87 +613,323 @@ class RPCHandler(object):
     def _rhandle(self, msg_data):
         from_ = msg_data['from']
         pcol = self._peer_protocol(from_)
+        begin = time.time()
         if pcol == 'json':
             msg = JSON_CODEC.decode(msg_data['message'], self.json_ctx)
             if self.verbose:
                 print getattr(self.node, 'client_ip', ''), 'In', msg
-        elif pcol == 'local':
-            msg = rmap(self.localize, msg_data['message'])
+        elif pcol == 'local' and self.shard is None:
+            msg = rmapShared(self.localize, msg_data['message'])
         else:
-            f = StringIO(msg_data['message'])
-            msg = decode(f, RemoteCtx(self, msg_data))
+            schema = self.in_schemas.get(from_)
+            if schema is None:
+                schema = self.in_schemas[from_] = Schema()
+            ctx = RemoteCtx(self, msg_data, schema)
+            msg = decodeFrom(msg_data['message'], 0, ctx)[0]
         addr = msg['o']
-        # Subtract transport path from incoming message.
-        assert(addr.startswith(self.node.path))
-        addr = addr[len(self.node.path):]
-        self._handle(addr, msg, from_)
-
-    def _handle(self, addr, msg, from_):
+        if isinstance(addr, basestring):
+            if addr[:1] == '@' and addr[1:].isdigit():
+                addr = int(addr[1:]) # reply address sent as a string
+            else:
+                # Subtract transport path from incoming message.
+                assert(addr.startswith(self.node.path))
+                addr = addr[len(self.node.path):]
+        received = None
+        if pcol != 'local':
+            received = len(msg_data['message']), time.time() - begin
+        self._handle(addr, msg, from_, received)
+
+    def _handle(self, addr, msg, from_, received=None):
         if 'm' in msg:
-            self.thread_model.call(self.handleCall, addr, msg, from_)
+            if self.call_for is not None:
+                self.call_for(addr, self.handleCall, addr, msg, from_, received)
+            else:
+                self.thread_model.call(self.handleCall, addr, msg, from_, received)
+        elif 'b' in msg:
+            self.thread_model.call(self.handleBatch, msg, from_)
+        elif 'k' in msg:
+            self.handleCredit(addr, msg)
+        elif 'C' in msg:
+            self.handleChunk(addr, msg, from_)
         else:
             self.handleReply(addr, msg)
 
     def handleReply(self, addr, msg):
         # TODO: make from-node part of the callbacks key and pass it through.
-        cb = self.callbacks.pop(addr)
-        if 'r' in msg:
-            cb.success(msg['r'])
-        else:
-            if type(msg['e']) is list:
-                msg['e'] = decodeException(msg['e'])
-            cb.failure(msg['e'])
+        cb = self.callbacks.pop(addr, None)
+        if cb is None:
+            return # expired
+        self.timers.remove(addr)
+        try:
+            if 'r' in msg:
+                cb.success(msg['r'])
+            else:
+                if type(msg['e']) is list:
+                    msg['e'] = decodeException(msg['e'])
+                cb.failure(msg['e'])
+        finally:
+            # Releasing may send queued calls.
+            self._release(addr)
 
     def localCall(self, addr, method, args):
-        result, exc = None, None
+        return self._localCall(addr, method, args)[:2]
+
+    def _localCall(self, addr, method, args):
+        result, exc, stats = None, None, None
         if addr:
             try:
                 obj = self.storage[addr]
             except KeyError:
                 exc = NoSuchObject(addr)
             else:
+                begin = time.time()
+                # Only methods found are counted, so that callers can't
+                # grow the stats with made-up names.
+                found = False
                 try:
-                    # FIXME: rpc_handler made _methods private. Should we?
                     if method == '__call__':
+                        found = True
                         result = obj(*args)
+                    elif method[:1] == '_' and method not in PUBLIC_SPECIAL:
+                        raise AttributeError(method)
                     else:
-                        result = getattr(obj, method)(*args)
+                        func = methodFor(obj, method)
+                        if func is None:
+                            func = getattr(obj, method)
+                            found = True
+                            result = func(*args)
+                        else:
+                            found = True
+                            result = func(obj, *args)
                 except Exception, exc:
                     pass
-        return result, exc
+                if found and self.stats is not None:
+                    stats = self.stats.entry(addr, obj, method)
+                    stats.record(time.time() - begin, exc is not None)
+        return result, exc, stats
 
-    def handleCall(self, addr, msg, reply_node):
+    def handleCall(self, addr, msg, reply_node, received=None):
         method = msg['m']
         args = msg['a']
-        result, exc = self.localCall(addr, method, args)
+        result, exc, stats = self._localCall(addr, method, args)
+        if stats is not None and received is not None:
+            stats.request_bytes += received[0]
+            stats.decode_time += received[1]
         try:
             reply_addr = msg['O']
         except KeyError:
             if exc is not None:
                 print 'Exc (no reply addr):', addr, msg, exc
             return
+        if exc is None and isIterator(result):
+            if self._peer_protocol(reply_node) != 'json':
+                return self._startStream(addr, result, reply_node, reply_addr)
+            result = list(result)
         if exc is None:
             msg = {'r': result}
         else:
             msg = {'e': encodeException(exc)}
+        begin = time.time()
         try:
             # serialization errors can occur here.
-            self.send(reply_node, reply_addr, msg)
+            size = self.send(reply_node, reply_addr, msg)
+        except SerializationError, exc:
+            size = self.send(reply_node, reply_addr, {'e': encodeException(exc)})
+        if stats is not None:
+            stats.encode_time += time.time() - begin
+            stats.reply_bytes += size or 0
+
+    def handleBatch(self, msg, reply_node):
+        prefix = len(self.node.path)
+        calls = [(addr[prefix:], method, args) for addr, method, args in msg['b']]
+        reply_addr = msg.get('O')
+        if self.call_for is not None or not all(self.ownsPath(call[0]) for call in calls):
+            return self._spreadBatch(calls, reply_addr, reply_node)
+        results = [self._batchResult(*call) for call in calls]
+        self._replyBatch(results, reply_addr, reply_node)
+
+    def _spreadBatch(self, calls, reply_addr, reply_node):
+        # Each call runs on the thread of its object, and calls to
+        # objects of other shards are passed on to them in one batch
+        # per shard; the last call to finish sends the reply.
+        results = [None] * len(calls)
+        remaining = [len(calls)]
+        lock = threading.Lock()
+        def done(i, result):
+            results[i] = result
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                self._replyBatch(results, reply_addr, reply_node)
+        def run(i, addr, method, args):
+            done(i, self._batchResult(addr, method, args))
+        others = {}
+        for i, (addr, method, args) in enumerate(calls):
+            if not self.ownsPath(addr):
+                others.setdefault(self.shard.owner(addr), []).append(i)
+            elif self.call_for is not None:
+                self.call_for(addr, run, i, addr, method, args)
+            else:
+                run(i, addr, method, args)
+        for indices in others.itervalues():
+            self._sendBatch(self.node_id, [list(calls[i]) for i in indices],
+                            ForwardedBatchCb(done, indices))
+
+    def _batchResult(self, addr, method, args):
+        result, exc = self.localCall(addr, method, args)
+        if exc is None and isIterator(result):
+            try:
+                result = list(result)
+            except Exception, exc:
+                return {'e': encodeException(exc)}
+        if exc is None:
+            return {'r': result}
+        return {'e': encodeException(exc)}
+
+    def _replyBatch(self, results, reply_addr, reply_node):
+        if reply_addr is None:
+            return
+        try:
+            self.send(reply_node, reply_addr, {'r': results})
         except SerializationError, exc:
             self.send(reply_node, reply_addr, {'e': encodeException(exc)})
 
+    def _startStream(self, path, items, node, reply_addr):
+        stream = OutStream(path, items, node, reply_addr, self._replyAddr(), self.stream_window)
+        self.streams[stream.id] = stream
+        self._setDeadline(stream.id, self.call_timeout)
+        self._pumpStream(stream)
+
+    def _pumpStream(self, stream, credit=0):
+        # Credit is added here, in the thread of the stream's object,
+        # so that grants are not lost.
+        stream.credit += credit
+        while stream.credit > 0 and stream.id in self.streams:
+            items, error = [], None
+            try:
+                for item in itertools.islice(stream.items, self.stream_chunk):
+                    items.append(item)
+            except Exception, error:
+                pass
+            msg = {'C': items, 'S': stream.id}
+            if error is None and len(items) < self.stream_chunk:
+                msg['E'] = 1
+                self._endStream(stream)
+            stream.credit -= 1
+            try:
+                if items or error is None:
+                    self.send(stream.node, stream.reply_addr, msg)
+            except SerializationError, error:
+                pass
+            if error is not None:
+                self._endStream(stream)
+                self.send(stream.node, stream.reply_addr, {'e': encodeException(error)})
+
+    def _endStream(self, stream):
+        self.streams.pop(stream.id, None)
+        self.timers.remove(stream.id)
+
+    def handleCredit(self, stream_id, msg):
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            return
+        if msg.get('x'):
+            self._endStream(stream)
+            self._closeStream(stream)
+            return
+        self._setDeadline(stream.id, self.call_timeout)
+        if self.call_for is not None:
+            self.call_for(stream.path, self._pumpStream, stream, msg['k'])
+        else:
+            self.thread_model.call(self._pumpStream, stream, msg['k'])
+
+    def _closeStream(self, stream):
+        close = getattr(stream.items, 'close', None)
+        if close is None:
+            pass
+        elif self.call_for is not None:
+            self.call_for(stream.path, close)
+        else:
+            self.thread_model.call(close)
+
+    def handleChunk(self, addr, msg, from_):
+        cb = self.callbacks.get(addr)
+        if cb is None:
+            # No longer wanted: stop the sender.
+            if 'E' not in msg:
+                self.send(from_, msg['S'], {'k': 0, 'x': 1})
+            return
+        deadline = time.time() + self.call_timeout
+        if type(cb) is not ResultStream:
+            stream = self.callbacks[addr] = ResultStream(self, from_, msg['S'], addr, deadline)
+            cb.success(stream)
+            cb = stream
+        end = 'E' in msg
+        if end:
+            self.callbacks.pop(addr, None)
+            self.timers.remove(addr)
+        else:
+            cb.deadline = deadline
+            self.timers.add(addr, deadline)
+        try:
+            cb.chunk(msg['C'], end)
+        finally:
+            if end:
+                self._release(addr)
+
     def send(self, node, addr, msg, errh=None):
         msg['o'] = addr
         pcol = self._peer_protocol(node)
+        if pcol == 'local' and self.shard is not None:
+            if self.shard.owns(addr):
+                return self.lput(addr, rmapShared(self.delocalize, msg))
+            pcol = 'serf' # another shard of this node
         if pcol == 'json':
             if self.verbose:
                 print getattr(self.node, 'client_ip', ''), 'Out', msg
             enc = JSON_CODEC.encode(msg, self.json_ctx)
         elif pcol == 'local':
-            enc = rmap(self.delocalize, msg)
+            enc = rmapShared(self.delocalize, msg)
+        elif self.stream_schemas:
+            return self._sendWithSchema(node, msg, errh)
         else:
-            enc = encodes(msg, self.remote_ctx)
+            enc = self._compress(node, encodes(msg, self.remote_ctx, self.encoder, self.encoders))
         self.node.send(node, enc, errh=errh)
+        if pcol != 'local':
+            return len(enc)
+
+    def _compress(self, node, enc):
+        if self.compress_min is None:
+            return enc
+        peerFeatures = getattr(self.node, 'peerFeatures', None)
+        if peerFeatures is None or 'Z' not in peerFeatures(node):
+            return enc
+        return compress(enc, self.compress_min)
+
+    def _sendWithSchema(self, node, msg, errh):
+        schema = self.out_schemas.get(node)
+        if schema is None:
+            schema = self.out_schemas[node] = Schema()
+        def failed(exc):
+            # The peer may have missed definitions: start afresh.
+            if self.out_schemas.get(node) is schema:
+                del self.out_schemas[node]
+            if errh is not None:
+                errh(exc)
+            else:
+                traceback.print_exc()
+        # Encode and send under the lock so that definitions are
+        # sent ahead of any references to them.
+        with schema.lock:
+            enc = encodes(msg, RemoteCtx(self, schema=schema), self.encoder, self.encoders)
+            enc = self._compress(node, enc)
+            self.node.send(node, enc, errh=failed)
+        return len(enc)
+
+    def _dropSchemas(self, ev, node):
+        self.out_schemas.pop(node, None)
+        self.in_schemas.pop(node, None)
 
     def provide(self, addr, obj):
         self.storage[addr] = obj
@@ -423,17 +939,152 @@ class RPCHandler(object):
         for addr, obj in d.iteritems():
             self.provide(addr, obj)
 
-    def call(self, node, addr, method, args):
+    def call(self, node, addr, method, args, timeout=None):
         cb = self.thread_model.makeCallback()
-        reply_addr = '@' + self.vat_id + '/' + randomString()
+        reply_addr = self._replyAddr()
         self.callbacks[reply_addr] = cb
+        if timeout is None:
+            timeout = self.method_timeouts.get(method, self.call_timeout)
+        cb.reply_addr = reply_addr
+        cb.deadline = self._setDeadline(reply_addr, timeout)
         msg = {'m': method,
                'a': args,
-               'O': reply_addr}
+               'O': self._sentReplyAddr(node, reply_addr)}
+        self._sendCall(node, addr, msg, reply_addr)
+        return cb
+
+    def waitFor(self, cb):
+        """Returns the result of a call made by call, once answered.
+
+        Raises CallTimeout, and forgets the call, if it is not answered
+        by its deadline.
+        """
+        try:
+            return cb.wait(max(cb.deadline - time.time(), 0))
+        except:
+            # Re-raise if answered or expired, or if the callback cannot
+            # wait (e.g. with Synchronous).
+            if (self.callbacks.get(cb.reply_addr) is not cb or
+                    time.time() < cb.deadline):
+                raise
+        self._expire(cb.reply_addr)
+        self._release(cb.reply_addr)
+        raise CallTimeout(cb.reply_addr)
+
+    def callBatch(self, node, calls, cbs):
+        """Sends calls, a list of [addr, method, args], in one message.
+
+        The calls are made in order at node and all answered by one
+        reply, whose results are passed to the corresponding cbs.
+        """
+        self._sendBatch(node, calls, BatchCb(cbs))
+
+    def _sendBatch(self, node, calls, batch_cb):
+        reply_addr = self._replyAddr()
+        self.callbacks[reply_addr] = batch_cb
+        self._setDeadline(reply_addr, self.call_timeout)
+        msg = {'b': calls, 'O': self._sentReplyAddr(node, reply_addr)}
+        self._sendCall(node, calls[0][0], msg, reply_addr)
+
+    def _sendCall(self, node, addr, msg, reply_addr):
         send_err_cb = SendErrorCb(self, reply_addr)
-        self.send(node, addr, msg, send_err_cb.failure)
+        if self.limits is None:
+            self.send(node, addr, msg, send_err_cb.failure)
+            return
+        def send():
+            if reply_addr not in self.callbacks:
+                return -1 # expired while waiting
+            try:
+                return self.send(node, addr, msg, send_err_cb.failure) or 0
+            except SerializationError, e:
+                # Queued calls are sent while handling other messages,
+                # so fail just this one.
+                cb = self.callbacks.pop(reply_addr, None)
+                self.timers.remove(reply_addr)
+                if cb is not None:
+                    cb.failure(e)
+                return -1
+        can_block = not getattr(self.thread_model, 'inDispatchThread', lambda: True)()
+        if not self.limits.submit(node, reply_addr, send, can_block):
+            cb = self.callbacks.pop(reply_addr, None)
+            self.timers.remove(reply_addr)
+            if cb is not None:
+                cb.failure(TooManyCalls(node))
+
+    def setLimits(self, limits):
+        """Limits the calls in flight to each peer (see CallLimits)."""
+        self.limits = limits
+        if self.stats is not None:
+            self.stats.limits = limits
+
+    def _replyAddr(self):
+        return self.reply_prefix | (self.reply_ids.next() & REPLY_MASK)
+
+    def _sentReplyAddr(self, node, reply_addr):
+        # Peers whose transport handshake did not offer int reply
+        # addresses (e.g. the C++ RPCHandler) get them as strings.
+        peerFeatures = getattr(self.node, 'peerFeatures', None)
+        if peerFeatures is None or 'I' in peerFeatures(node):
+            return reply_addr
+        return '@%d' % reply_addr
+
+    def ownsPath(self, path):
+        """Returns whether the object at path belongs to this handler."""
+        return self.shard is None or self.shard.owns(path)
+
+    def setShard(self, shard):
+        """Makes this handler one of the shards of its node.
+
+        Messages for objects owned by other shards are then sent, encoded,
+        via the transport (see shard.ShardRouter).
+        """
+        self.shard = shard
+        self.reply_prefix = shard.replyPrefix()
+        if hasattr(self.storage, 'setContextFactory'):
+            self.storage.shard = shard
+
+    def _setDeadline(self, reply_addr, timeout):
+        now = time.time()
+        self.expireCalls(now)
+        self.timers.add(reply_addr, now + timeout)
+        if not self.expiry_scheduled and hasattr(self.thread_model, 'callAfter'):
+            self.expiry_scheduled = True
+            self.thread_model.callAfter(self.timers.tick, self._expiryTick)
+        return now + timeout
+
+    def _expiryTick(self):
+        self.expireCalls()
+        if len(self.timers):
+            self.thread_model.callAfter(self.timers.tick, self._expiryTick)
+        else:
+            self.expiry_scheduled = False
+
+    def expireCalls(self, now=None):
+        """Fails the calls whose deadlines have passed."""
+        for reply_addr in self.timers.advance(time.time() if now is None else now):
+            cb = self._expire(reply_addr)
+            try:
+                if cb is not None:
+                    cb.failure(CallTimeout(reply_addr))
+            finally:
+                self._release(reply_addr)
+
+    def _expire(self, reply_addr):
+        """Forgets an unanswered call, returning its callback if any.
+
+        The call's room in self.limits is kept until _release.
+        """
+        cb = self.callbacks.pop(reply_addr, None)
+        self.timers.remove(reply_addr)
+        stream = self.streams.pop(reply_addr, None)
+        if stream is not None:
+            self._closeStream(stream)
         return cb
 
+    def _release(self, reply_addr):
+        if self.limits is not None:
+            self.limits.release(reply_addr)
+
     def localize(self, x):
         if isinstance(x, Exception):
             return x
@@ -441,17 +1092,18 @@ class RPCHandler(object):
         if typ in POD_TYPES:
             return x
         if typ is Proxy:
-            if x._node == self.node_id:
+            if x._node == self.node_id and self.ownsPath(x._path):
                 return Ref(self.storage, x._path)
             return Proxy(x._node, x._path, self)
         raise SerializationError('cannot localize type %s' % typ)
 
     def delocalize(self, x):
         # This is what we call for sending things to a different thread.
-        # It is only applied to leaf nodes (via rmap).
-        # rmap copies but it should actually be possible to change
-        # only the leaf nodes that need to change because while a call
-        # is in progress nothing can happen to variables referenced
+        # It is only applied to leaf nodes (via rmapShared).
+        # rmapShared copies only the containers on the path to a leaf
+        # that changes; plain data is shared with the receiver. This
+        # relies on a call's arguments not being touched while the call
+        # is in progress, since nothing can happen to variables referenced
         # only in the suspended stack-frame. If variables are added to
         # self then it would be possible for a call to access them
         # from the original vat's thread at the same time that they are
@@ -2,24 +2,50 @@
 
 """Tests for class RPCHandler."""
 
+import threading
+import time
 import unittest
 import weakref
-from serf.rpc_handler import RPCHandler, convert, makeBoundMethod
+from serf.rpc_handler import RPCHandler, convert, makeBoundMethod, CallTimeout
+from serf.rpc_handler import REPLY_PREFIX, _methods
 from serf.mock_net import MockNet, MockTransport
 from serf.proxy import Proxy
 from serf.ref import Ref
 from serf.po.data import Data
 from serf.test_object import TestObject
-from serf.serializer import SerializationError
+from serf.serializer import SerializationError, decodes, encodes
 from serf.test_time import Time
-from serf.worker import Worker
+from serf.worker import Worker, WorkerPool
 from serf.test_handler import TestHandler
 from serf.eventlet_thread import EventletThread
 from serf.storage import Storage, _str
 from serf.publisher import Publisher
 from serf.model import Model
+from serf.util import gather
 
 class RPCHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.held = [] # for things held only weakly, e.g. subscribers
+
+    def recordMessages(self, node, decode=lambda data: data):
+        """Returns a list to which the messages node receives are added."""
+        sent = []
+        def record(ev, msg):
+            sent.append(decode(msg['message']))
+        node.subscribe('message', record)
+        self.held.append(record)
+        return sent
+
+    def optionsPair(self, serf_opts):
+        """Returns (net, va, nb, sent) where va, with serf_opts, calls
+        objects in nb and sent has the messages nb's node receives."""
+        net = MockNet()
+        va = RPCHandler(net.addNode('A'), Storage({}), serf_opts=serf_opts)
+        nb, vb = net.addRPCHandler('B', '', {})
+        nb['addr'] = TestObject()
+        self.held.append(vb)
+        return net, va, nb, self.recordMessages(net.end['B'])
+
     def testCall(self):
         net = MockNet()
         nodea, va = net.addRPCHandler('A', '', {})
@@ -30,6 +56,59 @@ class RPCHandlerTest(unittest.TestCase):
         cb = vb.call('A', 'addr', 'incr', [1])
 
         self.assertEqual(cb.result, 2)
+        self.assertEqual(len(vb.timers), 0)
+
+    def testDispatch(self):
+        net = MockNet()
+        nodea, va = net.addRPCHandler('A', '', {})
+        nodeb, vb = net.addRPCHandler('B', '', {})
+
+        nodea['addr'] = TestObject()
+        nodea['data'] = Data({})
+
+        # Private methods can't be called remotely, but some specials can.
+        self.assertRaises(AttributeError, vb.call('A', 'addr', '_save', []).wait)
+        vb.call('A', 'data', '__setitem__', ['x', 1]).wait()
+        self.assertEqual(vb.call('A', 'data', '__getitem__', ['x']).wait(), 1)
+
+        self.assertEqual(vb.call('A', 'addr', 'incr', [1]).wait(), 2)
+        self.assertEqual(_methods[TestObject]['incr'][1], TestObject.incr.im_func)
+
+        # Instance attributes still take precedence.
+        obj = nodea['addr']
+        obj.incr = lambda n: n + 2
+        self.assertEqual(vb.call('A', 'addr', 'incr', [1]).wait(), 3)
+
+    def testPatchedMethod(self):
+        class Base(object):
+            def f(self):
+                return 'base'
+        class Sub(Base):
+            pass
+        net = MockNet()
+        nodea, va = net.addRPCHandler('A', '', {})
+        nodeb, vb = net.addRPCHandler('B', '', {})
+        obj = Sub()
+        va.storage.cache['obj'] = obj
+        self.assertEqual(vb.call('A', 'obj', 'f', []).wait(), 'base')
+
+        Base.f = lambda self: 'patched'
+        self.assertEqual(vb.call('A', 'obj', 'f', []).wait(), 'patched')
+        Sub.f = lambda self: 'sub'
+        self.assertEqual(vb.call('A', 'obj', 'f', []).wait(), 'sub')
+        del Sub.f
+        self.assertEqual(vb.call('A', 'obj', 'f', []).wait(), 'patched')
+
+    def testCallThroughProxy(self):
+        class Adder(object):
+            def __call__(self, a, b):
+                return a + b
+        net = MockNet()
+        nodea, va = net.addRPCHandler('A', '', {})
+        nodeb, vb = net.addRPCHandler('B', '', {})
+        adder = Adder()
+        va.storage.cache['adder'] = adder
+        self.assertEqual(vb.makeProxy('adder', 'A')(1, 2), 3)
 
     def testWithStorage(self):
         net = MockNet()
@@ -53,6 +132,193 @@ class RPCHandlerTest(unittest.TestCase):
         c2 = vb.call('A', 'TOB', '__getitem__', ['foo'])
         self.assertEqual([c1.wait(), c2.wait()], [None, 1])
 
+    def testSchemas(self):
+        net = MockNet()
+        sa = Storage({})
+        va = RPCHandler(net.addNode('A'), sa, serf_opts={'schemas': True})
+        nb, vb = net.addRPCHandler('B', '', {})
+
+        nb['addr'] = TestObject()
+        cb1 = va.call('B', 'addr', 'incr', [1])
+        cb2 = va.call('B', 'addr', 'incr', [5])
+        self.assertEqual([cb1.wait(), cb2.wait()], [2, 6])
+        self.assertTrue('B' in va.out_schemas)
+        self.assertTrue('A' in vb.in_schemas)
+
+        # A failed send discards the stream so definitions are resent.
+        cb = va.call('C', 'addr', 'incr', [1])
+        self.assertRaises(KeyError, cb.wait)
+        self.assertFalse('C' in va.out_schemas)
+
+        net.end['A'].notify('disconnected', 'B')
+        self.assertFalse('B' in va.out_schemas)
+
+    def testCompact(self):
+        net, va, nb, sent = self.optionsPair({'compact': True})
+        self.assertEqual(va.call('B', 'addr', 'incr', [1]).wait(), 2)
+        self.assertEqual(sent[0][0], 'm') # a VMAP
+
+    def testPacked(self):
+        net, va, nb, sent = self.optionsPair({'packed': True})
+        floats = [0.5] * 20
+        va.call('B', 'addr', 'setProxy', [floats]).wait()
+        self.assertTrue('Pd\x00\x00\x00\x14' in sent[0])
+        self.assertEqual(nb['addr'].proxy, floats)
+
+    def testUniform(self):
+        net, va, nb, sent = self.optionsPair({'uniform': True})
+        self.assertEqual(va.call('B', 'addr', 'incr', [1]).wait(), 2)
+        self.assertTrue('\x00\x01aLi\x00\x00\x00\x01' in sent[0]) # args as ARRAY(INT32)
+
+    def testIntern(self):
+        net, va, nb, sent = self.optionsPair({'intern': True})
+        self.assertEqual(va.call('B', 'addr', 'incr', [1]).wait(), 2)
+        self.assertEqual(sent[0][0], 'N')
+
+    def testCompress(self):
+        net, va, nb, sent = self.optionsPair({'compress': 100})
+        nb['d'] = Data({})
+        name = u'x' * 200
+        va.call('B', 'd', '__setitem__', ['a', name]).wait()
+        self.assertEqual(sent[-1][0], 'M') # B did not offer compression
+        net.end['A'].peerFeatures = lambda node: 'Z'
+        va.call('B', 'd', '__setitem__', ['b', name]).wait()
+        self.assertEqual(sent[-1][0], 'z')
+        self.assertEqual(nb['d']['b'], name)
+
+    def testStream(self):
+        closed = []
+        class Rows(object):
+            def rows(self, n, fail=False):
+                try:
+                    for i in xrange(n):
+                        yield i
+                    if fail:
+                        raise TypeError('no more')
+                finally:
+                    closed.append(n)
+        net = MockNet()
+        na, va = net.dictRPCHandler('A')
+        nb, vb = net.dictRPCHandler('B')
+        na['rows'] = Rows()
+        va.stream_chunk = 10
+        va.stream_window = 2
+        chunks = []
+        def count(ev, msg):
+            chunks.append(msg)
+        net.end['B'].subscribe('message', count)
+
+        p = Proxy('A', 'rows', vb)
+        rows = p.rows(95)
+        self.assertEqual(len(chunks), 2) # one window
+        self.assertEqual(list(rows), range(95))
+        self.assertEqual(len(chunks), 10)
+        self.assertEqual(va.streams, {})
+        self.assertEqual(vb.callbacks, {})
+
+        rows = p.rows(1000)
+        self.assertEqual([rows.next() for i in range(15)], range(15))
+        rows.close()
+        self.assertEqual(va.streams, {})
+        self.assertEqual(closed[-1], 1000)
+
+        rows = p.rows(25, True)
+        self.assertEqual([rows.next() for i in range(25)], range(25))
+        self.assertRaises(TypeError, rows.next)
+
+        self.assertEqual(list(p.rows(0)), [])
+
+        # An abandoned stream is closed when it expires.
+        rows = p.rows(500)
+        rows.next()
+        items = [stream.items for stream in va.streams.values()] # not freed
+        va.expireCalls(time.time() + va.call_timeout + 1)
+        self.assertEqual(va.streams, {})
+        self.assertEqual(closed[-1], 500)
+
+    def testStreamTimeout(self):
+        net = MockNet()
+        worker = Worker()
+        worker.start()
+        try:
+            vb = RPCHandler(net.addNode('B'), {}, t_model=worker)
+            net.addNode('C') # accepts messages but never replies
+            vb.call_timeout = 0.2
+            cb = vb.call('C', 'x', 'rows', [])
+            vb.handleChunk(cb.reply_addr, {'C': [1], 'S': 5}, 'C')
+            rows = cb.wait()
+            self.assertEqual(rows.next(), 1)
+            begin = time.time()
+            self.assertRaises(CallTimeout, rows.next) # no second chunk
+            self.assertTrue(time.time() - begin < 1)
+            self.assertEqual(vb.callbacks, {})
+        finally:
+            worker.stop()
+
+    def testCallTimeout(self):
+        net = MockNet()
+        nb, vb = net.addRPCHandler('B', '', {})
+        net.addNode('C') # accepts messages but never replies
+
+        now = time.time()
+        cb1 = vb.call('C', 'x', 'foo', [], 5)
+        cb2 = Proxy('C', 'x', vb)._withTimeout(20).foo_f()
+        vb.method_timeouts['slow'] = 50
+        cb3 = vb.call('C', 'x', 'slow', [])
+        self.assertEqual(len(vb.callbacks), 3)
+
+        vb.expireCalls(now + 10)
+        self.assertRaises(CallTimeout, cb1.wait)
+        self.assertEqual(len(vb.callbacks), 2)
+        vb.expireCalls(now + 30)
+        self.assertRaises(CallTimeout, cb2.wait)
+        vb.expireCalls(now + 60)
+        self.assertRaises(CallTimeout, cb3.wait)
+        self.assertEqual(vb.callbacks, {})
+        self.assertEqual(len(vb.timers), 0)
+
+    def testProxyTimeout(self):
+        net = MockNet()
+        worker = Worker()
+        worker.start()
+        try:
+            vb = RPCHandler(net.addNode('B'), {}, t_model=worker)
+            net.addNode('C') # accepts messages but never replies
+            vb.call_timeout = 0.2
+            begin = time.time()
+            self.assertRaises(CallTimeout, Proxy('C', 'x', vb).foo)
+            self.assertTrue(time.time() - begin < 1)
+            self.assertEqual(vb.callbacks, {})
+            self.assertEqual(len(vb.timers), 0)
+        finally:
+            worker.stop()
+
+    def testReplyAddr(self):
+        net = MockNet()
+        nb, vb = net.addRPCHandler('B', '', {})
+        net.addNode('C')
+        vb.call('C', 'x', 'foo', [])
+        vb.call('C', 'x', 'foo', [])
+        self.assertEqual(sorted(vb.callbacks), [REPLY_PREFIX, REPLY_PREFIX + 1])
+        self.assertTrue(REPLY_PREFIX + 1 < 2 ** 53)
+
+    def testStringReplyAddr(self):
+        net = MockNet()
+        na, va = net.addRPCHandler('A', '', {})
+        nb, vb = net.addRPCHandler('B', '', {})
+        na['addr'] = TestObject()
+        sent = self.recordMessages(net.end['A'], decodes)
+        net.end['B'].peerFeatures = lambda node: 'Z' # not 'I', e.g. C++
+        self.assertEqual(vb.call('A', 'addr', 'incr', [1]).wait(), 2)
+        self.assertEqual(sent[0]['O'], '@%d' % REPLY_PREFIX)
+        net.end['B'].peerFeatures = lambda node: 'ZI'
+        self.assertEqual(vb.call('A', 'addr', 'incr', [2]).wait(), 3)
+        self.assertEqual(sent[1]['O'], REPLY_PREFIX + 1)
+        self.assertEqual(vb.callbacks, {})
+
+        # Old-style string addresses are left as they are.
+        vb._rhandle({'from': 'A', 'message': encodes({'r': 1, 'o': '@vat/cb1'})})
+
     def testNonexistentNode(self):
         net = MockNet()
         na, va = net.addRPCHandler('A', '', {})
@@ -166,6 +432,51 @@ class RPCHandlerTest(unittest.TestCase):
         pb = rb.makeProxy('data', 'X')
         self.assertEqual(pb['name'], 'Tom')
 
+    def testWorkerPool(self):
+        class Where(object):
+            def thread(self):
+                return threading.currentThread().name
+        net = MockNet()
+        pa, pb = WorkerPool(4), WorkerPool(2)
+        va = RPCHandler(net.addNode('A'), {'x': Where(), 'y': Where()}, t_model=pa)
+        vb = RPCHandler(net.addNode('B'), {}, t_model=pb)
+        pa.start()
+        pb.start()
+        try:
+            px, py = Proxy('A', 'x', vb), Proxy('A', 'y', vb)
+            names = gather([px.thread_f() for i in range(5)])
+            self.assertEqual(len(set(names)), 1)
+            self.assertNotEqual(names[0], threading.currentThread().name)
+
+            with px._batch() as b:
+                fx = b.thread()
+                fy = b.on(py).thread()
+            self.assertEqual(fx.wait(), names[0])
+            self.assertEqual(fy.wait(), py.thread())
+        finally:
+            pa.stop()
+            pb.stop()
+
+    def testWorkerPoolNestedCall(self):
+        # An object blocked in a call gets the reply, although it and
+        # everything else in the pool share one worker.
+        net = MockNet()
+        pool, worker = WorkerPool(1), Worker()
+        va = RPCHandler(net.addNode('A'), {}, t_model=pool)
+        vb = RPCHandler(net.addNode('B'), {'y': TestObject()}, t_model=worker)
+        va.storage['x'] = TestObject(proxy=Proxy('B', 'y', va))
+        client = Worker()
+        vc = RPCHandler(net.addNode('C'), {}, t_model=client)
+        for w in pool, worker, client:
+            w.start()
+        try:
+            begin = time.time()
+            self.assertEqual(Proxy('A', 'x', vc).callIncr(5), 6)
+            self.assertTrue(time.time() - begin < 5)
+        finally:
+            for w in pool, worker, client:
+                w.stop()
+
     def testGC(self):
         h = RPCHandler(MockTransport('browser'), {})
         makeBoundMethod(h, {'o':'shared', 'm':'notify'})
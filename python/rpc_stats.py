@@ -0,0 +1,99 @@
+"""Per-method statistics of the calls handled by an RPCHandler."""
+
+import json
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the latency histogram buckets. The last
+# bucket counts everything slower.
+LATENCY_BOUNDS = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0]
+
+class MethodStats(object):
+    """Counters for calls of one method."""
+    __slots__ = ('calls', 'errors', 'time', 'histogram', 'decode_time',
+                 'encode_time', 'request_bytes', 'reply_bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.time = 0.0
+        self.histogram = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.decode_time = 0.0
+        self.encode_time = 0.0
+        self.request_bytes = 0
+        self.reply_bytes = 0
+
+    def record(self, latency, error):
+        self.calls += 1
+        self.time += latency
+        self.histogram[bisect_left(LATENCY_BOUNDS, latency)] += 1
+        if error:
+            self.errors += 1
+
+    def report(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+class RPCStats(object):
+    """Call statistics keyed by (class name, method).
+
+    Entries are created atomically, but their counters are not locked,
+    so with a multi-threaded thread model (e.g. WorkerPool) the counts
+    are approximate.
+
+    :param by_path: key by object path instead of class name
+    """
+    def __init__(self, by_path=False):
+        self.by_path = by_path
+        self.methods = {}
+        self.limits = None # the handler's CallLimits, if any
+
+    def entry(self, addr, obj, method):
+        """Returns the MethodStats for a call of method on obj at addr."""
+        key = (addr if self.by_path else type(obj).__name__, method)
+        try:
+            return self.methods[key]
+        except KeyError:
+            return self.methods.setdefault(key, MethodStats())
+
+    def report(self):
+        """Returns the statistics as a list of dicts, busiest first."""
+        items = []
+        for (name, method), stats in self.methods.items():
+            item = stats.report()
+            item['object'] = name
+            item['method'] = method
+            items.append(item)
+        items.sort(key=lambda item: -item['time'])
+        return items
+
+    def reset(self):
+        self.methods = {}
+
+    def peers(self):
+        """Returns the call limits and counters of each peer."""
+        return {} if self.limits is None else self.limits.report()
+
+    def dump(self, path):
+        """Writes the report to the file at path as JSON."""
+        with open(path, 'w') as out:
+            json.dump({'bounds': LATENCY_BOUNDS, 'methods': self.report(),
+                       'peers': self.peers()}, out, indent=2, sort_keys=True)
+            out.write('\n')
+
+class StatsView(object):
+    """Serf object for querying the stats of the RPCHandler it is served by."""
+    serialize = ('#rpc_stats',)
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def bounds(self):
+        return LATENCY_BOUNDS
+
+    def report(self):
+        return self.stats.report()
+
+    def peers(self):
+        return self.stats.peers()
+
+    def reset(self):
+        self.stats.reset()
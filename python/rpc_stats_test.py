@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+"""Tests for RPCStats."""
+
+import json
+import os
+import tempfile
+import unittest
+from serf.rpc_stats import RPCStats, MethodStats, StatsView, LATENCY_BOUNDS
+from serf.mock_net import MockNet
+from serf.proxy import Proxy
+from serf.test_object import TestObject
+
+class RPCStatsTest(unittest.TestCase):
+    def testMethodStats(self):
+        m = MethodStats()
+        m.record(0.00005, False)
+        m.record(0.002, True)
+        m.record(100, False)
+        self.assertEqual(m.calls, 3)
+        self.assertEqual(m.errors, 1)
+        self.assertEqual(m.histogram[0], 1)
+        self.assertEqual(m.histogram[LATENCY_BOUNDS.index(0.003)], 1)
+        self.assertEqual(m.histogram[-1], 1)
+
+    def testRPC(self):
+        net = MockNet()
+        na, va = net.addRPCHandler('A', '', {})
+        nb, vb = net.addRPCHandler('B', '', {})
+        va.provide('obj', TestObject())
+        va.provide('rpc_stats', StatsView(va.stats))
+
+        p = Proxy('A', 'obj', vb)
+        p.incr(1)
+        p.incr(2)
+        self.assertRaises(TypeError, p.incr, 'x')
+
+        report = Proxy('A', 'rpc_stats', vb).report()
+        incr = [r for r in report if r['method'] == 'incr'][0]
+        self.assertEqual(incr['object'], 'TestObject')
+        self.assertEqual(incr['calls'], 3)
+        self.assertEqual(incr['errors'], 1)
+        self.assertEqual(sum(incr['histogram']), 3)
+        self.assertTrue(incr['request_bytes'] > 0)
+        self.assertTrue(incr['reply_bytes'] > 0)
+
+        # Calls of missing or private methods are not counted.
+        self.assertRaises(AttributeError, p.noSuchMethod)
+        self.assertRaises(AttributeError, vb.call('A', 'obj', '_save', []).wait)
+        self.assertEqual(sorted(r['method'] for r in va.stats.report()), ['incr', 'report'])
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            va.stats.dump(path)
+            with open(path) as f:
+                dumped = json.load(f)
+            self.assertEqual(len(dumped['methods']), len(va.stats.report()))
+        finally:
+            os.remove(path)
+
+        va.stats = None # counting off
+        p.incr(1)
+
+    def testByPath(self):
+        stats = RPCStats(by_path=True)
+        self.assertTrue(stats.entry('a', None, 'f') is stats.entry('a', 1, 'f'))
+        self.assertEqual(stats.report()[0]['object'], 'a')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,34 @@ The main exported functions are encode and decode which write
 Variants encodes and decodes are also provided which return 
 (resp. accept) string encodings.
 
+decodeFrom decodes in place from a str, buffer, bytearray or
+memoryview starting at a given offset, returning the value and the
+offset following it. Codecs implement it as decodeFrom(buf, pos, ctx).
+
+decodeView returns an encoded MAP or STRUCT as a RecordView, which
+decodes each field only when it is accessed. Codecs support this via
+skipFrom(buf, pos, ctx), which returns the offset after a value
+without decoding it.
+
+Passing encoders=COMPACT_ENCODER selects the compact encoding, in
+which integers and all length prefixes are written as varints.
+Passing encoders=PACKED_ENCODER writes lists of PACK_MIN or more ints
+or floats as PACKED blocks, which only newer peers can decode.
+Passing encoders=UNIFORM_ENCODER instead checks the items of each list
+and dict once and, when they are all alike, encodes them with a single
+codec (e.g. ARRAY(INT32), or ARRAY(STRUCT(...)) for same-shaped dicts).
+Decoding needs no such option since every encoding is self-describing.
+
+encodes(value, ctx, encoder=INTERNED) writes each distinct dict key
+and short str once per message, referring back to it thereafter.
+Decoded strings are interned so that equal keys share one object. A
+ctx.strings StringTable, if present, is shared by a stream of messages
+(with the same ordering requirement as ctx.schema).
+
+compress(data, threshold) wraps an encoding of at least threshold
+bytes in a zlib-compressed envelope. Such envelopes are decoded
+transparently, but only by peers which know the COMPRESSED codec.
+
 Custom encodings and decodings may be enabled by passing an
 optional context object. It has three methods:
 
@@ -29,48 +57,128 @@ ctx.namedCodec(type_name)
     type id, in which case a message is produced. If it returns
     None, None then a record is produced using the type_name
     and the default encoder.
+
+ctx.packed_as (optional)
+    How PACKED numeric arrays are decoded: 'list' (the default),
+    'array' for an array.array or 'numpy' for a NumPy array.
+
+ctx.schema (optional)
+    A Schema shared by a stream of messages. When present, compound
+    type descriptors are written once and then referred to by id.
+    Encoder and decoder must each use their own Schema, seeing the
+    messages of the stream in the same order.
 """
 
+import array
 import datetime
 import struct
+import sys
+import threading
+import weakref
+import zlib
 from cStringIO import StringIO
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 POD_TYPES = [type(None), bool, int, long, str, unicode, float, list, dict, tuple]
 
 class SerializationError(Exception):
     pass
 
+class CannotSize(SerializationError):
+    """Raised by encodedSize for values it could only size by encoding."""
+    pass
+
+def _slice(buf, i, j):
+    """Materializes buf[i:j] as a str, for any supported buffer type."""
+    if j > len(buf):
+        raise SerializationError('truncated data')
+    data = buf[i:j]
+    if type(data) is not str:
+        data = data.tobytes() # memoryview
+    return data
+
 class Codec(object):
     def decodeType(self, f, ctx):
         return self
+    def decodeTypeFrom(self, buf, pos, ctx):
+        return self, pos
     def encodeType(self, f):
         f.write(self.type_byte)
+    def decodeFrom(self, buf, pos, ctx):
+        # Fallback for codecs only implementing decode.
+        f = StringIO(buf[pos:])
+        value = self.decode(f, ctx)
+        return value, pos + f.tell()
+    def skipFrom(self, buf, pos, ctx):
+        return self.decodeFrom(buf, pos, ctx)[1]
+    def sizeOf(self, value, ctx):
+        raise CannotSize(type(self).__name__)
+    def encodeInto(self, buf, pos, value, ctx):
+        # Fallback for codecs only implementing encode.
+        f = StringIO()
+        self.encode(f, value, ctx)
+        data = f.getvalue()
+        end = pos + len(data)
+        buf[pos:end] = data
+        return end
 
 class NoneCodec(Codec):
     type_byte = '-'
     def decode(self, f, ctx):
         return None
+    def decodeFrom(self, buf, pos, ctx):
+        return None, pos
     def encode(self, f, value, ctx):
         pass
+    def sizeOf(self, value, ctx):
+        return 0
+    def encodeInto(self, buf, pos, value, ctx):
+        return pos
 NULL = NoneCodec()
 
 class BoolCodec(Codec):
     type_byte = 'b'
+    fixed_format = '?'
     def decode(self, f, ctx):
         return f.read(1) != '\x00'
+    def decodeFrom(self, buf, pos, ctx):
+        return buf[pos] != '\x00', pos + 1
+    def skipFrom(self, buf, pos, ctx):
+        return pos + 1
     def encode(self, f, value, ctx):
         f.write('\x01' if value else '\x00')
+    def sizeOf(self, value, ctx):
+        return 1
+    def encodeInto(self, buf, pos, value, ctx):
+        buf[pos] = 1 if value else 0
+        return pos + 1
 BOOL = BoolCodec()
 
 class IntCodec(Codec):
     def __init__(self, width, format, type_byte):
         self.width = width
         self.format = format
+        self.fixed_format = format[1:]
         self.type_byte = type_byte
+        self.unpack_from = struct.Struct(format).unpack_from
+        self.pack_into = struct.Struct(format).pack_into
     def decode(self, f, ctx):
         return struct.unpack(self.format, f.read(self.width))[0]
+    def decodeFrom(self, buf, pos, ctx):
+        return self.unpack_from(buf, pos)[0], pos + self.width
+    def skipFrom(self, buf, pos, ctx):
+        return pos + self.width
     def encode(self, f, value, ctx):
         f.write(struct.pack(self.format, value))
+    def sizeOf(self, value, ctx):
+        return self.width
+    def encodeInto(self, buf, pos, value, ctx):
+        self.pack_into(buf, pos, value)
+        return pos + self.width
 
 BYTE  = IntCodec(1, '>B', 'B')
 INT16 = IntCodec(2, '>h', 'h')
@@ -78,6 +186,77 @@ INT32 = IntCodec(4, '>i', 'i')
 INT64 = IntCodec(8, '>q', 'q')
 FLOAT = IntCodec(8, '>d', 'd') 
 
+class VarIntCodec(Codec):
+    """Variable-length integer, 7 bits per byte, low-order bits first.
+
+    Each byte but the last has its top bit set. Signed values are
+    zig-zag mapped so that numbers of small magnitude stay short.
+    """
+    def __init__(self, type_byte=None, signed=True):
+        self.type_byte = type_byte
+        self.signed = signed
+    def _value(self, n):
+        if self.signed:
+            return (n >> 1) ^ -(n & 1)
+        return n
+    def decode(self, f, ctx):
+        n = shift = 0
+        while True:
+            c = f.read(1)
+            if not c:
+                raise SerializationError('truncated data')
+            b = ord(c)
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return self._value(n)
+            shift += 7
+    def decodeFrom(self, buf, pos, ctx):
+        n = shift = 0
+        while True:
+            if pos >= len(buf):
+                raise SerializationError('truncated data')
+            b = ord(buf[pos])
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return self._value(n), pos
+            shift += 7
+    def _unsigned(self, value):
+        if self.signed:
+            return value << 1 if value >= 0 else ((-value) << 1) - 1
+        if value < 0:
+            raise SerializationError('negative length')
+        return value
+    def sizeOf(self, value, ctx):
+        value = self._unsigned(value)
+        n = 1
+        while value >= 0x80:
+            value >>= 7
+            n += 1
+        return n
+    def encodeInto(self, buf, pos, value, ctx):
+        value = self._unsigned(value)
+        while value >= 0x80:
+            buf[pos] = 0x80 | (value & 0x7f)
+            value >>= 7
+            pos += 1
+        buf[pos] = value
+        return pos + 1
+    def encode(self, f, value, ctx):
+        value = self._unsigned(value)
+        if value < 0x80:
+            f.write(chr(value))
+            return
+        out = []
+        while value >= 0x80:
+            out.append(chr(0x80 | (value & 0x7f)))
+            value >>= 7
+        out.append(chr(value))
+        f.write(''.join(out))
+
+VARINT = VarIntCodec('v')
+UVARINT = VarIntCodec(signed=False) # for length prefixes only
+
 class StrCodec(Codec):
     def __init__(self, type_byte, len_type=INT32):
         self.type_byte = type_byte
@@ -85,24 +264,59 @@ class StrCodec(Codec):
     def decode(self, f, ctx):
         n = self.len_type.decode(f, ctx)
         return f.read(n)
+    def decodeFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        return _slice(buf, pos, pos + n), pos + n
+    def skipFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        return pos + n
     def encode(self, f, value, ctx):
         self.len_type.encode(f, len(value), ctx)
         f.write(value)
+    def sizeOf(self, value, ctx):
+        return self.len_type.sizeOf(len(value), ctx) + len(value)
+    def encodeInto(self, buf, pos, value, ctx):
+        pos = self.len_type.encodeInto(buf, pos, len(value), ctx)
+        end = pos + len(value)
+        buf[pos:end] = value
+        return end
 
 DATA = StrCodec('r')
 TOKEN = StrCodec('k', len_type=INT16)
 ASCII = StrCodec('a')
 
+DATA_V = StrCodec('x', len_type=UVARINT)
+TOKEN_V = StrCodec('K', len_type=UVARINT)
+ASCII_V = StrCodec('s', len_type=UVARINT)
+
 class TextCodec(Codec):
-    type_byte = 'u'
+    def __init__(self, type_byte='u', len_type=INT32):
+        self.type_byte = type_byte
+        self.len_type = len_type
     def decode(self, f, ctx):
-        n = INT32.decode(f, ctx)
+        n = self.len_type.decode(f, ctx)
         return f.read(n).decode('utf8')
+    def decodeFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        return _slice(buf, pos, pos + n).decode('utf8'), pos + n
+    def skipFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        return pos + n
     def encode(self, f, value, ctx):
         data = value.encode('utf8')
-        INT32.encode(f, len(data), ctx)
+        self.len_type.encode(f, len(data), ctx)
         f.write(data)
+    def sizeOf(self, value, ctx):
+        n = len(value.encode('utf8'))
+        return self.len_type.sizeOf(n, ctx) + n
+    def encodeInto(self, buf, pos, value, ctx):
+        data = value.encode('utf8')
+        pos = self.len_type.encodeInto(buf, pos, len(data), ctx)
+        end = pos + len(data)
+        buf[pos:end] = data
+        return end
 TEXT = TextCodec()
+TEXT_V = TextCodec('w', len_type=UVARINT)
 
 EPOCH_BEGIN = datetime.datetime(1970, 1, 1)
 SEC_PER_DAY = 3600 * 24
@@ -118,16 +332,42 @@ class TimeCodec(Codec):
     type_byte = 't'
     def decode(self, f, ctx):
         return toDateTime(INT64.decode(f, ctx))
+    def decodeFrom(self, buf, pos, ctx):
+        t, pos = INT64.decodeFrom(buf, pos, ctx)
+        return toDateTime(t), pos
+    def skipFrom(self, buf, pos, ctx):
+        return pos + 8
     def encode(self, f, value, ctx):
         INT64.encode(f, toEpochUSec(value), ctx)
+    def sizeOf(self, value, ctx):
+        return 8
+    def encodeInto(self, buf, pos, value, ctx):
+        return INT64.encodeInto(buf, pos, toEpochUSec(value), ctx)
 TIME = TimeCodec()
 
 class AnyCodec(Codec):
+    """Codec for a value of any type, written with its type descriptor.
+
+    encoders is the table used to choose encodings for values (see
+    encode); the type byte is the same whichever table is used.
+    """
     type_byte = 'A'
+    def __init__(self, encoders=None):
+        self.encoders = encoders
     def decode(self, f, ctx):
         return decode(f, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+        return codec.decodeFrom(buf, pos, ctx)
+    def skipFrom(self, buf, pos, ctx):
+        codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+        return codec.skipFrom(buf, pos, ctx)
     def encode(self, f, value, ctx):
-        encode(f, value, ctx)
+        encode(f, value, ctx, None, self.encoders)
+    def sizeOf(self, value, ctx):
+        return encodedSize(value, ctx, None, self.encoders)
+    def encodeInto(self, buf, pos, value, ctx):
+        return encodeInto(buf, pos, value, ctx, None, self.encoders)
 ANY = AnyCodec()
 
 class Record(object):
@@ -148,6 +388,15 @@ class RecordCodec(Codec):
     def decode(self, f, ctx):
         name = TOKEN.decode(f, ctx)
         body = ANY.decode(f, ctx)
+        return self._make(name, body, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        name, pos = TOKEN.decodeFrom(buf, pos, ctx)
+        body, pos = ANY.decodeFrom(buf, pos, ctx)
+        return self._make(name, body, ctx), pos
+    def skipFrom(self, buf, pos, ctx):
+        pos = TOKEN.skipFrom(buf, pos, ctx)
+        return ANY.skipFrom(buf, pos, ctx)
+    def _make(self, name, body, ctx):
         if ctx is not None:
             result = ctx.custom(name, body)
             if result is not None:
@@ -166,6 +415,22 @@ class MessageCodec(Codec):
         if codec is None:
             return Record('@', tmp.getvalue(), type_id)
         value = codec.decode(tmp, ctx)
+        return self._make(type_name, value, type_id, codec, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        type_id, pos = INT32.decodeFrom(buf, pos, ctx)
+        n, pos = INT32.decodeFrom(buf, pos, ctx)
+        end = pos + n
+        codec = None
+        if ctx is not None:
+            codec, type_name = ctx.codec(type_id)
+        if codec is None:
+            return Record('@', _slice(buf, pos, end), type_id), end
+        # The message body is decoded in place, without copying it out.
+        value = codec.decodeFrom(buf, pos, ctx)[0]
+        return self._make(type_name, value, type_id, codec, ctx), end
+    def skipFrom(self, buf, pos, ctx):
+        return DATA.skipFrom(buf, pos + 4, ctx)
+    def _make(self, type_name, value, type_id, codec, ctx):
         result = ctx.custom(type_name, value)
         if result is not None:
             return result
@@ -176,41 +441,197 @@ class TypeCodec(Codec):
     type_byte = 'Y'
     def encode(self, f, value, ctx):
         value.encodeType(f)
+    def sizeOf(self, value, ctx):
+        f = StringIO()
+        value.encodeType(f)
+        return f.tell()
     def decode(self, f, ctx):
         factory = DECODER[f.read(1)]
         return factory.decodeType(f, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        factory = DECODER[buf[pos]]
+        return factory.decodeTypeFrom(buf, pos + 1, ctx)
 
 TYPE = TypeCodec()
 
+def compileFields(codecs):
+    """Compiles a sequence of codecs into a pair of closures.
+
+    Adjacent fixed-width codecs (those having a fixed_format) are
+    merged into a single precompiled struct.Struct so that a run of
+    numeric fields costs one pack / unpack and one write / read.
+
+    Returns encode(f, values, ctx), decode(f, ctx) and
+    decodeFrom(buf, pos, ctx), which encode (resp. decode) a sequence
+    of values, one for each codec.
+    """
+    plan = [] # [(struct, n) or (codec, None),...]
+    run = []
+    for c in list(codecs) + [None]:
+        fmt = getattr(c, 'fixed_format', None)
+        if fmt is not None:
+            run.append(fmt)
+            continue
+        if run:
+            plan.append((struct.Struct('>' + ''.join(run)), len(run)))
+            run = []
+        if c is not None:
+            plan.append((c, None))
+
+    if len(plan) == 1 and plan[0][1] is not None:
+        # All fixed-width: a single pack / unpack does everything.
+        packer = plan[0][0]
+        def encode(f, values, ctx):
+            f.write(packer.pack(*values))
+        def decode(f, ctx):
+            return list(packer.unpack(f.read(packer.size)))
+        def decodeFrom(buf, pos, ctx):
+            return list(packer.unpack_from(buf, pos)), pos + packer.size
+        return encode, decode, decodeFrom
+
+    def encode(f, values, ctx):
+        i = 0
+        for step, n in plan:
+            if n is None:
+                step.encode(f, values[i], ctx)
+                i += 1
+            else:
+                f.write(step.pack(*values[i:i + n]))
+                i += n
+    def decode(f, ctx):
+        values = []
+        for step, n in plan:
+            if n is None:
+                values.append(step.decode(f, ctx))
+            else:
+                values.extend(step.unpack(f.read(step.size)))
+        return values
+    def decodeFrom(buf, pos, ctx):
+        values = []
+        for step, n in plan:
+            if n is None:
+                value, pos = step.decodeFrom(buf, pos, ctx)
+                values.append(value)
+            else:
+                values.extend(step.unpack_from(buf, pos))
+                pos += step.size
+        return values, pos
+    return encode, decode, decodeFrom
+
+class FieldsCodec(Codec):
+    """Base for codecs which encode a fixed sequence of sub-codecs.
+
+    Subclasses implement fieldCodecs. The compiled closures are built
+    on first use and cached on the instance.
+    """
+    _compiled = None
+    def fieldCodecs(self):
+        raise NotImplementedError
+    def compile(self):
+        if self._compiled is None:
+            self._compiled = compileFields(self.fieldCodecs())
+        return self._compiled
+    def skipFrom(self, buf, pos, ctx):
+        for c in self.fieldCodecs():
+            pos = c.skipFrom(buf, pos, ctx)
+        return pos
+    def fieldValues(self, value):
+        return value
+    def sizeOf(self, value, ctx):
+        size = 0
+        for c, v in zip(self.fieldCodecs(), self.fieldValues(value)):
+            size += c.sizeOf(v, ctx)
+        return size
+    def encodeInto(self, buf, pos, value, ctx):
+        for c, v in zip(self.fieldCodecs(), self.fieldValues(value)):
+            pos = c.encodeInto(buf, pos, v, ctx)
+        return pos
+
 class ARRAY(Codec):
     type_byte = 'L'
+    len_type = INT32
     def __init__(self, item_codec):
         self.item_codec = item_codec
     def decode(self, f, ctx):
-        n = INT32.decode(f, ctx)
+        n = self.len_type.decode(f, ctx)
         return [self.item_codec.decode(f, ctx) for i in xrange(n)]
+    def decodeFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        item_codec = self.item_codec
+        fmt = getattr(item_codec, 'fixed_format', None)
+        if fmt is not None:
+            fmt = '>%d%s' % (n, fmt)
+            return list(struct.unpack_from(fmt, buf, pos)), pos + struct.calcsize(fmt)
+        value = []
+        for i in xrange(n):
+            item, pos = item_codec.decodeFrom(buf, pos, ctx)
+            value.append(item)
+        return value, pos
+    def skipFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        item_codec = self.item_codec
+        fmt = getattr(item_codec, 'fixed_format', None)
+        if fmt is not None:
+            return pos + struct.calcsize('>%d%s' % (n, fmt))
+        for i in xrange(n):
+            pos = item_codec.skipFrom(buf, pos, ctx)
+        return pos
     def encode(self, f, value, ctx):
-        INT32.encode(f, len(value), ctx)
+        self.len_type.encode(f, len(value), ctx)
         for v in value:
             self.item_codec.encode(f, v, ctx)
+    def sizeOf(self, value, ctx):
+        n = len(value)
+        size = self.len_type.sizeOf(n, ctx)
+        item_codec = self.item_codec
+        fmt = getattr(item_codec, 'fixed_format', None)
+        if fmt is not None:
+            return size + struct.calcsize('>%d%s' % (n, fmt))
+        for v in value:
+            size += item_codec.sizeOf(v, ctx)
+        return size
+    def encodeInto(self, buf, pos, value, ctx):
+        n = len(value)
+        pos = self.len_type.encodeInto(buf, pos, n, ctx)
+        item_codec = self.item_codec
+        fmt = getattr(item_codec, 'fixed_format', None)
+        if fmt is not None:
+            fmt = '>%d%s' % (n, fmt)
+            struct.pack_into(fmt, buf, pos, *value)
+            return pos + struct.calcsize(fmt)
+        for v in value:
+            pos = item_codec.encodeInto(buf, pos, v, ctx)
+        return pos
     def encodeType(self, f):
         f.write(self.type_byte)
         self.item_codec.encodeType(f)
-    @staticmethod
-    def decodeType(f, ctx):
+    @classmethod
+    def decodeType(cls, f, ctx):
         item_codec = TYPE.decode(f, ctx)
-        return ARRAY(item_codec)
+        return cls(item_codec)
+    @classmethod
+    def decodeTypeFrom(cls, buf, pos, ctx):
+        item_codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+        return cls(item_codec), pos
 LIST = ARRAY(ANY)
 
-class TUPLE(Codec):
+class VARRAY(ARRAY):
+    """An ARRAY with a varint length prefix."""
+    type_byte = 'l'
+    len_type = UVARINT
+
+class TUPLE(FieldsCodec):
     type_byte = 'T'
     def __init__(self, *codecs):
         self.codecs = codecs
+    def fieldCodecs(self):
+        return self.codecs
     def decode(self, f, ctx):
-        return [c.decode(f, ctx) for c in self.codecs]
+        return self.compile()[1](f, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        return self.compile()[2](buf, pos, ctx)
     def encode(self, f, value, ctx):
-        for c, v in zip(self.codecs, value):
-            c.encode(f, v, ctx)
+        self.compile()[0](f, value, ctx)
     def encodeType(self, f):
         f.write(self.type_byte)
         INT32.encode(f, len(self.codecs), None)
@@ -220,18 +641,32 @@ class TUPLE(Codec):
     def decodeType(f, ctx):
         n = INT32.decode(f, ctx)
         return TUPLE(*[TYPE.decode(f, ctx) for i in xrange(n)])
+    @staticmethod
+    def decodeTypeFrom(buf, pos, ctx):
+        n, pos = INT32.decodeFrom(buf, pos, ctx)
+        codecs = []
+        for i in xrange(n):
+            codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+            codecs.append(codec)
+        return TUPLE(*codecs), pos
 
-class VECTOR(Codec):
+class VECTOR(FieldsCodec):
     type_byte = 'V'
     def __init__(self, item_codec, size):
         self.item_codec = item_codec
         self.size = size
+    def fieldCodecs(self):
+        return [self.item_codec] * self.size
     def decode(self, f, ctx):
-        return [self.item_codec.decode(f, ctx) for i in xrange(self.size)]
+        return self.compile()[1](f, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        return self.compile()[2](buf, pos, ctx)
+    def fieldValues(self, value):
+        assert(len(value) == self.size)
+        return value
     def encode(self, f, value, ctx):
         assert(len(value) == self.size)
-        for v in value:
-            self.item_codec.encode(f, v, ctx)
+        self.compile()[0](f, value, ctx)
     def encodeType(self, f):
         f.write(self.type_byte)
         self.item_codec.encodeType(f)
@@ -241,33 +676,87 @@ class VECTOR(Codec):
         item_codec = TYPE.decode(f, ctx)
         n = INT32.decode(f, ctx)
         return VECTOR(item_codec, n)
+    @staticmethod
+    def decodeTypeFrom(buf, pos, ctx):
+        item_codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+        n, pos = INT32.decodeFrom(buf, pos, ctx)
+        return VECTOR(item_codec, n), pos
 
 class MAP(Codec):
     type_byte = 'M'
+    len_type = INT32
     def __init__(self, key_type, value_type):
         self.key_type = key_type
         self.value_type = value_type
     def decode(self, f, ctx):
         value = {}
-        n = INT32.decode(f, ctx)
+        n = self.len_type.decode(f, ctx)
         for i in xrange(n):
             k = self.key_type.decode(f, ctx)
             value[k] = self.value_type.decode(f, ctx)
         return value
+    def decodeFrom(self, buf, pos, ctx):
+        value = {}
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        key_type, value_type = self.key_type, self.value_type
+        for i in xrange(n):
+            k, pos = key_type.decodeFrom(buf, pos, ctx)
+            value[k], pos = value_type.decodeFrom(buf, pos, ctx)
+        return value, pos
+    def skipFrom(self, buf, pos, ctx):
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        key_type, value_type = self.key_type, self.value_type
+        for i in xrange(n):
+            pos = key_type.skipFrom(buf, pos, ctx)
+            pos = value_type.skipFrom(buf, pos, ctx)
+        return pos
+    def scanFrom(self, buf, pos, ctx):
+        """Returns {key: (codec, pos)} for each value, and the end offset."""
+        fields = {}
+        n, pos = self.len_type.decodeFrom(buf, pos, ctx)
+        key_type, value_type = self.key_type, self.value_type
+        for i in xrange(n):
+            k, pos = key_type.decodeFrom(buf, pos, ctx)
+            fields[k] = (value_type, pos)
+            pos = value_type.skipFrom(buf, pos, ctx)
+        return fields, pos
     def encode(self, f, value, ctx):
-        INT32.encode(f, len(value), ctx)
+        self.len_type.encode(f, len(value), ctx)
         for k, v in value.iteritems():
             self.key_type.encode(f, k, ctx)
             self.value_type.encode(f, v, ctx)
+    def sizeOf(self, value, ctx):
+        size = self.len_type.sizeOf(len(value), ctx)
+        key_type, value_type = self.key_type, self.value_type
+        for k, v in value.iteritems():
+            size += key_type.sizeOf(k, ctx) + value_type.sizeOf(v, ctx)
+        return size
+    def encodeInto(self, buf, pos, value, ctx):
+        pos = self.len_type.encodeInto(buf, pos, len(value), ctx)
+        key_type, value_type = self.key_type, self.value_type
+        for k, v in value.iteritems():
+            pos = key_type.encodeInto(buf, pos, k, ctx)
+            pos = value_type.encodeInto(buf, pos, v, ctx)
+        return pos
     def encodeType(self, f):
         f.write(self.type_byte)
         self.key_type.encodeType(f)
         self.value_type.encodeType(f)
-    @staticmethod
-    def decodeType(f, ctx):
+    @classmethod
+    def decodeType(cls, f, ctx):
         key_type = TYPE.decode(f, ctx)
         value_type = TYPE.decode(f, ctx)
-        return MAP(key_type, value_type)
+        return cls(key_type, value_type)
+    @classmethod
+    def decodeTypeFrom(cls, buf, pos, ctx):
+        key_type, pos = TYPE.decodeFrom(buf, pos, ctx)
+        value_type, pos = TYPE.decodeFrom(buf, pos, ctx)
+        return cls(key_type, value_type), pos
+
+class VMAP(MAP):
+    """A MAP with a varint length prefix."""
+    type_byte = 'm'
+    len_type = UVARINT
 
 DICT = MAP(TOKEN, ANY)
 DICT_FOR_KEY = {
@@ -279,24 +768,126 @@ DICT_ANY_KEY = MAP(ANY, ANY)
 
 FIELD_SPEC = ARRAY(TUPLE(TOKEN, TYPE))
 
-class STRUCT(Codec):
+class STRUCT(FieldsCodec):
     type_byte = 'S'
     def __init__(self, fields):
         self.fields = fields # [[key, type],...]
+        self.keys = [k for k, c in fields]
+    def fieldCodecs(self):
+        return [c for k, c in self.fields]
     def decode(self, f, ctx):
-        value = {}
+        return dict(zip(self.keys, self.compile()[1](f, ctx)))
+    def decodeFrom(self, buf, pos, ctx):
+        values, pos = self.compile()[2](buf, pos, ctx)
+        return dict(zip(self.keys, values)), pos
+    def scanFrom(self, buf, pos, ctx):
+        """Returns {key: (codec, pos)} for each field, and the end offset."""
+        fields = {}
         for k, c in self.fields:
-            value[k] = c.decode(f, ctx)
-        return value
+            fields[k] = (c, pos)
+            pos = c.skipFrom(buf, pos, ctx)
+        return fields, pos
+    def fieldValues(self, value):
+        return [value[k] for k in self.keys]
     def encode(self, f, value, ctx):
-        for k, c in self.fields:
-            c.encode(f, value[k], ctx)
+        self.compile()[0](f, [value[k] for k in self.keys], ctx)
     def encodeType(self, f):
         f.write(self.type_byte)
         FIELD_SPEC.encode(f, self.fields, None)
     @staticmethod
     def decodeType(f, ctx):
         return STRUCT(FIELD_SPEC.decode(f, ctx))
+    @staticmethod
+    def decodeTypeFrom(buf, pos, ctx):
+        fields, pos = FIELD_SPEC.decodeFrom(buf, pos, ctx)
+        return STRUCT(fields), pos
+
+def arrayTypecode(fmt):
+    """Finds the array module typecode for a struct format character."""
+    size = struct.calcsize('>' + fmt)
+    candidates = {'B': 'B', 'h': 'h', 'i': 'il', 'q': 'lq', 'd': 'd'}[fmt]
+    for code in candidates:
+        try:
+            if array.array(code).itemsize == size:
+                return code
+        except ValueError:
+            pass
+    return None
+
+class PACKED(Codec):
+    """A homogeneous array of fixed-width numbers packed as one block.
+
+    The item count is followed by the big-endian items, written and
+    read in a single call. Decodes to a list unless ctx.packed_as
+    asks for an array.array or a NumPy array.
+    """
+    type_byte = 'P'
+    def __init__(self, item_codec):
+        self.item_codec = item_codec
+        fmt = item_codec.fixed_format
+        self.typecode = arrayTypecode(fmt)
+        self.dtype = '>' + fmt
+        self.width = struct.calcsize(self.dtype)
+        self.format = '>%d' + fmt
+    def encode(self, f, value, ctx):
+        INT32.encode(f, len(value), ctx)
+        f.write(self._pack(value))
+    def sizeOf(self, value, ctx):
+        return 4 + len(value) * self.width
+    def encodeInto(self, buf, pos, value, ctx):
+        pos = INT32.encodeInto(buf, pos, len(value), ctx)
+        end = pos + len(value) * self.width
+        buf[pos:end] = self._pack(value)
+        return end
+    def _pack(self, value):
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            return value.astype(self.dtype).tostring()
+        if self.typecode is None:
+            return struct.pack(self.format % len(value), *value)
+        a = array.array(self.typecode, value)
+        if sys.byteorder == 'little':
+            a.byteswap()
+        return a.tostring()
+    def decode(self, f, ctx):
+        n = INT32.decode(f, ctx)
+        data = f.read(n * self.width)
+        return self._unpack(data, 0, n, ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        n, pos = INT32.decodeFrom(buf, pos, ctx)
+        end = pos + n * self.width
+        if end > len(buf):
+            raise SerializationError('truncated data')
+        return self._unpack(buf, pos, n, ctx), end
+    def skipFrom(self, buf, pos, ctx):
+        n, pos = INT32.decodeFrom(buf, pos, ctx)
+        return pos + n * self.width
+    def _unpack(self, buf, pos, n, ctx):
+        packed_as = getattr(ctx, 'packed_as', None)
+        if packed_as == 'numpy':
+            if numpy is None:
+                raise SerializationError('numpy is not available')
+            return numpy.frombuffer(buf, self.dtype, n, pos)
+        if packed_as == 'array' and self.typecode is not None:
+            a = array.array(self.typecode)
+            a.fromstring(_slice(buf, pos, pos + n * self.width))
+            if sys.byteorder == 'little':
+                a.byteswap()
+            return a
+        return list(struct.unpack_from(self.format % n, buf, pos))
+    def encodeType(self, f):
+        f.write(self.type_byte)
+        self.item_codec.encodeType(f)
+    @classmethod
+    def decodeType(cls, f, ctx):
+        return cls(TYPE.decode(f, ctx))
+    @classmethod
+    def decodeTypeFrom(cls, buf, pos, ctx):
+        item_codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+        return cls(item_codec), pos
+
+PACKED_INT32 = PACKED(INT32)
+PACKED_INT64 = PACKED(INT64)
+PACKED_FLOAT = PACKED(FLOAT)
 
 class CONST(Codec):
     type_byte = 'C'
@@ -304,14 +895,24 @@ class CONST(Codec):
         self.value = value
     def decode(self, f, ctx):
         return self.value
+    def decodeFrom(self, buf, pos, ctx):
+        return self.value, pos
     def encode(self, f, value, ctx):
         pass
+    def sizeOf(self, value, ctx):
+        return 0
+    def encodeInto(self, buf, pos, value, ctx):
+        return pos
     def encodeType(self, f):
         f.write(self.type_byte)
         ANY.encode(f, self.value, None)
     @staticmethod
     def decodeType(f, ctx):
         return CONST(ANY.decode(f, ctx))
+    @staticmethod
+    def decodeTypeFrom(buf, pos, ctx):
+        value, pos = ANY.decodeFrom(buf, pos, ctx)
+        return CONST(value), pos
 
 ENUM_DICT = MAP(TOKEN, INT16)
 
@@ -328,14 +929,260 @@ class ENUM(Codec):
     @staticmethod
     def decodeType(f, ctx):
         return ENUM(ENUM_DICT.decode(f, ctx))
+    @staticmethod
+    def decodeTypeFrom(buf, pos, ctx):
+        k_to_int, pos = ENUM_DICT.decodeFrom(buf, pos, ctx)
+        return ENUM(k_to_int), pos
     def encode(self, f, value, ctx):
         INT16.encode(f, self.k_to_int[value], ctx)
+    def sizeOf(self, value, ctx):
+        return 2
+    def encodeInto(self, buf, pos, value, ctx):
+        return INT16.encodeInto(buf, pos, self.k_to_int[value], ctx)
     def decode(self, f, ctx):
         return self.int_to_k[INT16.decode(f, ctx)]
+    def decodeFrom(self, buf, pos, ctx):
+        i, pos = INT16.decodeFrom(buf, pos, ctx)
+        return self.int_to_k[i], pos
+    def skipFrom(self, buf, pos, ctx):
+        return pos + 2
 
-def fallbackEncode(f, value, ctx):
-    """Provides encoding for Records and all custom serializables."""
+class Schema(object):
+    """Type descriptors shared between the messages of one stream.
+
+    The first time a compound type is encoded it is written as a
+    definition, '=' id descriptor, and thereafter as a reference,
+    '#' id. The decoding end records definitions as it sees them.
+    Descriptors shorter than SHARE_MIN bytes, no longer than a reference,
+    are always written inline.
+
+    The lock may be used to serialize encoding and sending so that
+    definitions reach the peer before references to them.
+    """
+    SHARE_MIN = 4
+    MAX_ID = 32767
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descs = weakref.WeakKeyDictionary() # codec -> descriptor
+        self.out_ids = {} # descriptor -> id
+        self.in_types = {} # id -> codec
+
+    def encodeType(self, f, codec):
+        try:
+            desc = self.descs[codec]
+        except KeyError:
+            tmp = StringIO()
+            codec.encodeType(tmp)
+            desc = self.descs[codec] = tmp.getvalue()
+        if len(desc) < self.SHARE_MIN:
+            f.write(desc)
+            return
+        type_id = self.out_ids.get(desc)
+        if type_id is not None:
+            f.write('#')
+            INT16.encode(f, type_id, None)
+            return
+        type_id = len(self.out_ids)
+        if type_id > self.MAX_ID:
+            f.write(desc)
+            return
+        self.out_ids[desc] = type_id
+        f.write('=')
+        INT16.encode(f, type_id, None)
+        f.write(desc)
+
+    def define(self, type_id, codec):
+        self.in_types[type_id] = codec
+        return codec
+
+    def lookup(self, type_id):
+        try:
+            return self.in_types[type_id]
+        except KeyError:
+            raise SerializationError('undefined schema type %d' % type_id)
+
+def getSchema(ctx):
+    schema = getattr(ctx, 'schema', None)
+    if schema is None:
+        raise SerializationError('schema type without a stream context')
+    return schema
+
+class SchemaDefCodec(Codec):
+    """Decodes a type definition: '=' id descriptor."""
+    type_byte = '='
+    def decodeType(self, f, ctx):
+        type_id = INT16.decode(f, ctx)
+        return getSchema(ctx).define(type_id, TYPE.decode(f, ctx))
+    def decodeTypeFrom(self, buf, pos, ctx):
+        type_id, pos = INT16.decodeFrom(buf, pos, ctx)
+        codec, pos = TYPE.decodeFrom(buf, pos, ctx)
+        return getSchema(ctx).define(type_id, codec), pos
+SCHEMA_DEF = SchemaDefCodec()
+
+class SchemaRefCodec(Codec):
+    """Decodes a reference to a previously defined type: '#' id."""
+    type_byte = '#'
+    def decodeType(self, f, ctx):
+        return getSchema(ctx).lookup(INT16.decode(f, ctx))
+    def decodeTypeFrom(self, buf, pos, ctx):
+        type_id, pos = INT16.decodeFrom(buf, pos, ctx)
+        return getSchema(ctx).lookup(type_id), pos
+SCHEMA_REF = SchemaRefCodec()
+
+COMPRESS_MIN = 1024 # shorter encodings are not worth compressing
+
+class CompressedCodec(Codec):
+    """Envelope holding the zlib-compressed encoding of a value."""
+    type_byte = 'z'
+    def __init__(self, level=6):
+        self.level = level
+    def encode(self, f, value, ctx):
+        DATA.encode(f, zlib.compress(encodes(value, ctx), self.level), ctx)
+    def decode(self, f, ctx):
+        return decodes(self.inflate(DATA.decode(f, ctx)), ctx)
+    def decodeFrom(self, buf, pos, ctx):
+        data, pos = DATA.decodeFrom(buf, pos, ctx)
+        return decodes(self.inflate(data), ctx), pos
+    def skipFrom(self, buf, pos, ctx):
+        return DATA.skipFrom(buf, pos, ctx)
+    def inflate(self, data):
+        try:
+            return zlib.decompress(data)
+        except zlib.error, e:
+            raise SerializationError('bad compressed data: %s' % e)
+COMPRESSED = CompressedCodec()
+
+def compress(data, threshold=COMPRESS_MIN, level=6):
+    """Wraps an encoding in a COMPRESSED envelope.
+
+    Encodings shorter than threshold, or which do not shrink, are
+    returned unchanged. Either way the result decodes to the same value.
+    """
+    if len(data) < threshold:
+        return data
+    packed = zlib.compress(data, level)
+    if len(packed) + 5 >= len(data):
+        return data
+    return 'z' + struct.pack('>i', len(packed)) + packed
+
+STRINGS_MAX = 65536 # strings held by a StringTable
+
+class StringTable(object):
+    """Strings seen so far in a message or stream, for back-references.
+
+    The encoder and the decoder each keep their own table, adding
+    strings in the same order, so an index means the same string to
+    both. Once full, no more strings are added.
+    """
+    def __init__(self):
+        self.index = {} # str -> position (encoding)
+        self.strings = [] # position -> str (decoding)
+    def find(self, s):
+        return self.index.get(s)
+    def add(self, s):
+        if len(self.index) < STRINGS_MAX:
+            self.index[s] = len(self.index)
+    def append(self, s):
+        if len(self.strings) < STRINGS_MAX:
+            self.strings.append(s)
+    def lookup(self, i):
+        try:
+            return self.strings[i]
+        except IndexError:
+            raise SerializationError('undefined string reference %d' % i)
+
+def getStrings(ctx):
+    strings = getattr(ctx, 'strings', None)
+    if strings is None:
+        raise SerializationError('interned string without a string table')
+    return strings
 
+class InternCodec(Codec):
+    """A str written once per string table and referred to thereafter.
+
+    A varint n > 0 refers to the (n-1)th string of the table. Zero is
+    followed by a varint length and the string itself, which is added
+    to the table. Decoded strings are interned.
+    """
+    type_byte = 'n'
+    def encode(self, f, value, ctx):
+        strings = getStrings(ctx)
+        i = strings.find(value)
+        if i is None:
+            f.write('\x00')
+            UVARINT.encode(f, len(value), ctx)
+            f.write(value)
+            strings.add(value)
+        else:
+            UVARINT.encode(f, i + 1, ctx)
+    def decode(self, f, ctx):
+        i = UVARINT.decode(f, ctx)
+        if i:
+            return getStrings(ctx).lookup(i - 1)
+        value = intern(f.read(UVARINT.decode(f, ctx)))
+        getStrings(ctx).append(value)
+        return value
+    def decodeFrom(self, buf, pos, ctx):
+        i, pos = UVARINT.decodeFrom(buf, pos, ctx)
+        if i:
+            return getStrings(ctx).lookup(i - 1), pos
+        n, pos = UVARINT.decodeFrom(buf, pos, ctx)
+        value = intern(_slice(buf, pos, pos + n))
+        getStrings(ctx).append(value)
+        return value, pos + n
+INTERN_STR = InternCodec()
+
+class StringsCtx(object):
+    """Wraps a context (which may be None), adding a string table."""
+    def __init__(self, ctx, strings):
+        self.ctx = ctx
+        self.strings = strings
+    def __getattr__(self, name):
+        return getattr(self.ctx, name)
+    def custom(self, name, value):
+        if self.ctx is None:
+            return None
+        return self.ctx.custom(name, value)
+    def codec(self, type_id):
+        if self.ctx is None:
+            return None, None
+        return self.ctx.codec(type_id)
+    def namedCodec(self, type_name):
+        if self.ctx is None:
+            return None, None
+        return self.ctx.namedCodec(type_name)
+    def record(self, any):
+        if self.ctx is None:
+            raise SerializationError(type(any).__name__)
+        return self.ctx.record(any)
+
+class InternedCodec(Codec):
+    """Envelope for a value whose strings share a string table.
+
+    The table is ctx.strings if there is one, so that it can be shared
+    by a stream of messages, and otherwise a new one for this value.
+    """
+    type_byte = 'N'
+    def withStrings(self, ctx):
+        if getattr(ctx, 'strings', None) is not None:
+            return ctx
+        return StringsCtx(ctx, StringTable())
+    def encode(self, f, value, ctx):
+        encode(f, value, self.withStrings(ctx), None, INTERN_ENCODER)
+    def decode(self, f, ctx):
+        return decode(f, self.withStrings(ctx))
+    def decodeFrom(self, buf, pos, ctx):
+        return ANY.decodeFrom(buf, pos, self.withStrings(ctx))
+INTERNED = InternedCodec()
+
+def recordParts(value, ctx):
+    """Converts a Record or custom serializable for encoding.
+
+    Returns type_name, body, codec and type_id. The codec is DATA for
+    an undecoded message, None for a record or else the registered
+    codec for a message.
+    """
     # If not a record, try to convert it to one.
     if type(value) is not Record:
         try:
@@ -350,21 +1197,31 @@ def fallbackEncode(f, value, ctx):
         type_name, body = value.type_name, value.value
 
     if type_name == '@':
-        f.write('@')
-        INT32.encode(f, value.type_id, ctx)
-        DATA.encode(f, body, ctx)
-        return
+        return type_name, body, DATA, value.type_id
 
     # Check if there is a registered codec for this type_name.
     if ctx is None:
-        codec = None
-    else:
-        codec, type_id = ctx.namedCodec(type_name)
+        return type_name, body, None, None
+    codec, type_id = ctx.namedCodec(type_name)
+    return type_name, body, codec, type_id
+
+def isStateful(ctx):
+    """True if encoding with ctx changes its schema or string table."""
+    return (getattr(ctx, 'schema', None) is not None or
+            getattr(ctx, 'strings', None) is not None)
+
+def fallbackEncode(f, value, ctx, encoders=None):
+    """Provides encoding for Records and all custom serializables."""
+    type_name, body, codec, type_id = recordParts(value, ctx)
 
     if codec is None:
         f.write('R')
         TOKEN.encode(f, type_name, ctx)
-        ANY.encode(f, body, ctx)
+        encode(f, body, ctx, None, encoders)
+    elif codec is DATA:
+        f.write('@')
+        INT32.encode(f, type_id, ctx)
+        DATA.encode(f, body, ctx)
     else:
         f.write('@')
         INT32.encode(f, type_id, ctx)
@@ -372,6 +1229,38 @@ def fallbackEncode(f, value, ctx):
         codec.encode(tmp, body, ctx)
         DATA.encode(f, tmp.getvalue(), ctx)
 
+def fallbackSize(value, ctx, encoders=None):
+    """The size of the encoding written by fallbackEncode.
+
+    Only Records without a codec, and raw '@' Records, can be sized.
+    Other custom values would need ctx.record calling, or their message
+    body encoding, once to size them and again to encode them.
+    """
+    if type(value) is not Record:
+        raise CannotSize(value.__class__.__name__)
+    type_name, body, codec, type_id = recordParts(value, ctx)
+    if codec is None:
+        return 1 + TOKEN.sizeOf(type_name, ctx) + encodedSize(body, ctx, None, encoders)
+    if codec is DATA:
+        return 5 + DATA.sizeOf(body, ctx)
+    raise CannotSize(type_name)
+
+def fallbackEncodeInto(buf, pos, value, ctx, encoders=None):
+    """Writes the encoding written by fallbackEncode into buf at pos."""
+    type_name, body, codec, type_id = recordParts(value, ctx)
+    if codec is None:
+        buf[pos] = 'R'
+        pos = TOKEN.encodeInto(buf, pos + 1, type_name, ctx)
+        return encodeInto(buf, pos, body, ctx, None, encoders)
+    buf[pos] = '@'
+    pos = INT32.encodeInto(buf, pos + 1, type_id, ctx)
+    if codec is DATA:
+        return DATA.encodeInto(buf, pos, body, ctx)
+    start = pos + 4
+    end = codec.encodeInto(buf, start, body, ctx)
+    INT32.encodeInto(buf, pos, end - start, ctx)
+    return end
+
 class Registry(object):
     """Provides a usable implementation of the context interface."""
     def __init__(self):
@@ -403,31 +1292,203 @@ ENCODER = {}
 def register(factory, type_byte=None):
     DECODER[type_byte or factory.type_byte] = factory
 
-def encode(f, value, ctx=None, encoder=None):
+def encode(f, value, ctx=None, encoder=None, encoders=None):
+    """Writes value, preceded by its type descriptor, to f.
+
+    The encoder is found by looking up the type of value in encoders,
+    which defaults to ENCODER, unless one is given explicitly.
+    """
     if encoder is None:
-        if type(value) in ENCODER:
-            encoder = ENCODER[type(value)](value)
+        if encoders is None:
+            encoders = ENCODER
+        if type(value) in encoders:
+            encoder = encoders[type(value)](value)
         elif isinstance(value, Codec):
             encoder = TYPE
         else:
-            return fallbackEncode(f, value, ctx)
-    encoder.encodeType(f)
+            return fallbackEncode(f, value, ctx, encoders)
+    schema = getattr(ctx, 'schema', None)
+    if schema is None:
+        encoder.encodeType(f)
+    else:
+        schema.encodeType(f, encoder)
     encoder.encode(f, value, ctx)
 
+def findEncoder(value, encoders=None):
+    """Returns the codec for value from encoders, or None for fallbackEncode."""
+    if encoders is None:
+        encoders = ENCODER
+    if type(value) in encoders:
+        return encoders[type(value)](value)
+    if isinstance(value, Codec):
+        return TYPE
+    return None
+
+def typeBytes(codec):
+    """Returns the type descriptor of codec, caching it on the codec."""
+    try:
+        return codec.__dict__['_type_bytes']
+    except KeyError:
+        f = StringIO()
+        codec.encodeType(f)
+        codec._type_bytes = f.getvalue()
+        return codec._type_bytes
+
+def encodedSize(value, ctx=None, encoder=None, encoders=None):
+    """Returns len(encodes(value, ...)), found without encoding value.
+
+    Raises CannotSize if value contains custom values other than plain
+    Records (see fallbackSize). The context may not have a schema or
+    string table.
+    """
+    if isStateful(ctx):
+        raise SerializationError('cannot size an encoding with a stream context')
+    if encoder is None:
+        encoder = findEncoder(value, encoders)
+        if encoder is None:
+            return fallbackSize(value, ctx, encoders)
+    return len(typeBytes(encoder)) + encoder.sizeOf(value, ctx)
+
+def encodeInto(buf, pos, value, ctx=None, encoder=None, encoders=None):
+    """Writes the encoding of value into the bytearray buf at pos.
+
+    buf must have room for encodedSize(value, ...) bytes from pos.
+    Returns the offset just past the encoding.
+    """
+    if encoder is None:
+        encoder = findEncoder(value, encoders)
+        if encoder is None:
+            return fallbackEncodeInto(buf, pos, value, ctx, encoders)
+    type_bytes = typeBytes(encoder)
+    end = pos + len(type_bytes)
+    buf[pos:end] = type_bytes
+    return encoder.encodeInto(buf, end, value, ctx)
+
+def encodeb(value, ctx=None, encoder=None, encoders=None, head=0, tail=0):
+    """Encodes value into a new bytearray, allocated once at its full size.
+
+    The encoding is preceded by head and followed by tail spare bytes,
+    for the caller to fill in, e.g. with a length prefix. A stream
+    context, or a value which cannot be sized, is encoded via encodes,
+    costing an extra copy.
+    """
+    if not isStateful(ctx):
+        try:
+            size = encodedSize(value, ctx, encoder, encoders)
+        except CannotSize:
+            pass
+        else:
+            buf = bytearray(head + size + tail)
+            end = encodeInto(buf, head, value, ctx, encoder, encoders)
+            assert(end == len(buf) - tail)
+            return buf
+    data = encodes(value, ctx, encoder, encoders)
+    buf = bytearray(head + len(data) + tail)
+    buf[head:head + len(data)] = data
+    return buf
+
 def decode(f, ctx=None):
     codec = TYPE.decode(f, ctx)
     return codec.decode(f, ctx)
 
-def encodes(value, ctx=None, encoder=None):
+def decodeFrom(buf, offset=0, ctx=None):
+    """Decodes a value in place from a buffer, starting at offset.
+
+    buf may be a str, buffer, bytearray or memoryview. Scalars are
+    unpacked directly from buf; only DATA, ASCII, TOKEN and TEXT
+    values are copied out as new strings.
+
+    Returns the value and the offset just past its encoding.
+    """
+    if type(buf) is bytearray:
+        buf = buffer(buf)
+    return ANY.decodeFrom(buf, offset, ctx)
+
+class RecordView(object):
+    """Read-only dict-like view of an encoded MAP or STRUCT.
+
+    The positions of the values are found by a single scan of the
+    encoding. Each value is decoded when first accessed.
+    """
+    def __init__(self, buf, fields, ctx=None):
+        self._buf = buf
+        self._fields = fields # {key: (codec, pos)}
+        self._ctx = ctx
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        codec, pos = self._fields[key]
+        value = self._values[key] = codec.decodeFrom(self._buf, pos, self._ctx)[0]
+        return value
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return self._fields.keys()
+
+    def values(self):
+        return [self[k] for k in self._fields]
+
+    def items(self):
+        return [(k, self[k]) for k in self._fields]
+
+    def toDict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if type(other) is RecordView:
+            other = other.toDict()
+        return self.toDict() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'RecordView(%r)' % self.toDict()
+
+def decodeView(buf, ctx=None):
+    """Decodes buf lazily if it encodes a MAP or STRUCT.
+
+    Returns a RecordView of a MAP or STRUCT, otherwise the decoded value.
+    """
+    if type(buf) is bytearray:
+        buf = buffer(buf)
+    codec, pos = TYPE.decodeFrom(buf, 0, ctx)
+    scanFrom = getattr(codec, 'scanFrom', None)
+    if scanFrom is None:
+        value, pos = codec.decodeFrom(buf, pos, ctx)
+    else:
+        fields, pos = scanFrom(buf, pos, ctx)
+        value = RecordView(buf, fields, ctx)
+    if pos != len(buf):
+        raise SerializationError('expected %d bytes, got %d' % (pos, len(buf)))
+    return value
+
+def encodes(value, ctx=None, encoder=None, encoders=None):
     f = StringIO()
-    encode(f, value, ctx, encoder)
+    encode(f, value, ctx, encoder, encoders)
     return f.getvalue()
 
 def decodes(s, ctx=None, check=True):
-    f = StringIO(s)
-    value = decode(f, ctx)
+    value, pos = decodeFrom(s, 0, ctx)
     if check:
-        assert(f.read() == '')
+        assert(pos == len(s))
     return value
 
 register(NULL)  # -
@@ -438,11 +1499,16 @@ register(INT16) # h
 register(INT32) # i
 register(INT64) # q
 register(FLOAT) # d
+register(VARINT) # v
 
 register(DATA)  # r
 register(ASCII) # a
 register(TEXT)  # u
 register(TOKEN) # k
+register(DATA_V)  # x
+register(ASCII_V) # s
+register(TEXT_V)  # w
+register(TOKEN_V) # K
 
 register(TIME)  # t
 
@@ -452,17 +1518,63 @@ register(MESSAGE) # @
 register(TYPE)    # Y
 
 register(ARRAY)  # L
+register(VARRAY) # l
 register(TUPLE)  # T
 register(VECTOR) # V
 register(MAP)    # M
+register(VMAP)   # m
+register(PACKED) # P
 register(STRUCT) # S
 register(CONST)  # C
 register(ENUM)   # E
 
+register(SCHEMA_DEF) # =
+register(SCHEMA_REF) # #
+register(COMPRESSED) # z
+register(INTERN_STR) # n
+register(INTERNED)   # N
+
 def findIntEncoder(value):
     if -2147483648 <= value <= 2147483647:
         return INT32
     return INT64
+PACK_MIN = 16 # shorter lists are not worth checking
+
+def findPackedEncoder(value):
+    """Returns a PACKED codec for a list of all floats or all ints, or None."""
+    types = set(map(type, value))
+    if types == set([float]):
+        return PACKED_FLOAT
+    if types and types <= set([int, long]):
+        lo, hi = min(value), max(value)
+        if -2147483648 <= lo and hi <= 2147483647:
+            return PACKED_INT32
+        if -9223372036854775808 <= lo and hi <= 9223372036854775807:
+            return PACKED_INT64
+    return None
+
+def findArrayEncoder(value):
+    typecode = value.typecode
+    if typecode in 'fd':
+        return PACKED_FLOAT
+    if typecode in 'cu' or (typecode in 'IL' and value.itemsize >= 8):
+        return LIST # not numbers, or may not fit in an INT64
+    if value.itemsize < 4 or typecode == 'i':
+        return PACKED_INT32
+    return PACKED_INT64
+
+def findNDArrayEncoder(value):
+    if value.ndim == 1:
+        if value.dtype.kind == 'f':
+            return PACKED_FLOAT
+        if value.dtype.kind in 'iu':
+            if value.dtype.itemsize < 4 or value.dtype.str[1:] == 'i4':
+                return PACKED_INT32
+            if value.dtype.str[1:] == 'u8' and len(value) and value.max() >= 1 << 63:
+                raise SerializationError('uint64 value too large for INT64')
+            return PACKED_INT64
+    raise SerializationError('cannot encode array %s' % value.dtype)
+
 def findStringEncoder(value):
     try:
         value.decode('ascii') # will succeed if ascii
@@ -470,16 +1582,20 @@ def findStringEncoder(value):
     except UnicodeDecodeError:
         return DATA
 
-def findDictEncoder(value):
+def dictKeyType(value):
+    """The type of all keys of a dict (str if empty), or None if mixed."""
     key_types = set(map(type, value))
     if long in key_types:
         key_types.discard(long)
         key_types.add(int)
     if not key_types:
-        return DICT
+        return str
     if len(key_types) == 1:
-        return DICT_FOR_KEY.get(list(key_types)[0], DICT_ANY_KEY)
-    return DICT_ANY_KEY
+        return list(key_types)[0]
+    return None
+
+def findDictEncoder(value):
+    return DICT_FOR_KEY.get(dictKeyType(value), DICT_ANY_KEY)
 
 ENCODER[type(None)] = lambda v: NULL
 ENCODER[bool] = lambda v: BOOL
@@ -488,7 +1604,205 @@ ENCODER[long] = findIntEncoder
 ENCODER[float] = lambda v: FLOAT
 ENCODER[list] = lambda v: LIST
 ENCODER[tuple] = lambda v: LIST
+ENCODER[array.array] = findArrayEncoder
+if numpy is not None:
+    ENCODER[numpy.ndarray] = findNDArrayEncoder
 ENCODER[str] = findStringEncoder
 ENCODER[unicode] = lambda v: TEXT
 ENCODER[dict] = findDictEncoder
 ENCODER[datetime.datetime] = lambda v: TIME
+
+# The packed encoding is the default one except that numeric lists are
+# written as PACKED blocks (see findPackedEncoder). It is not the default
+# since peers from before PACKED (including the C++ serializer) cannot
+# decode them. The compact, uniform and interning encodings pack too.
+
+ANY_P = AnyCodec()
+LIST_P = ARRAY(ANY_P)
+DICT_P_FOR_KEY = {
+    str: MAP(TOKEN, ANY_P),
+    unicode: MAP(TEXT, ANY_P),
+    int: MAP(INT64, ANY_P),
+}
+DICT_P_ANY_KEY = MAP(ANY_P, ANY_P)
+
+def findPackedListEncoder(value):
+    if len(value) >= PACK_MIN:
+        return findPackedEncoder(value) or LIST_P
+    return LIST_P
+
+def findPackedDictEncoder(value):
+    return DICT_P_FOR_KEY.get(dictKeyType(value), DICT_P_ANY_KEY)
+
+PACKED_ENCODER = dict(ENCODER)
+PACKED_ENCODER[list] = findPackedListEncoder
+PACKED_ENCODER[tuple] = findPackedListEncoder
+PACKED_ENCODER[dict] = findPackedDictEncoder
+ANY_P.encoders = PACKED_ENCODER
+
+# The compact encoding writes all integers and length prefixes as varints.
+
+ANY_V = AnyCodec()
+LIST_V = VARRAY(ANY_V)
+DICT_V = VMAP(TOKEN_V, ANY_V)
+DICT_V_FOR_KEY = {
+    str: DICT_V,
+    unicode: VMAP(TEXT_V, ANY_V),
+    int: VMAP(VARINT, ANY_V),
+}
+DICT_V_ANY_KEY = VMAP(ANY_V, ANY_V)
+
+def findCompactStringEncoder(value):
+    try:
+        value.decode('ascii') # will succeed if ascii
+        return ASCII_V
+    except UnicodeDecodeError:
+        return DATA_V
+
+def findCompactListEncoder(value):
+    if len(value) >= PACK_MIN:
+        return findPackedEncoder(value) or LIST_V
+    return LIST_V
+
+def findCompactDictEncoder(value):
+    return DICT_V_FOR_KEY.get(dictKeyType(value), DICT_V_ANY_KEY)
+
+COMPACT_ENCODER = dict(ENCODER)
+COMPACT_ENCODER[int] = lambda v: VARINT
+COMPACT_ENCODER[long] = lambda v: VARINT
+COMPACT_ENCODER[list] = findCompactListEncoder
+COMPACT_ENCODER[tuple] = findCompactListEncoder
+COMPACT_ENCODER[str] = findCompactStringEncoder
+COMPACT_ENCODER[unicode] = lambda v: TEXT_V
+COMPACT_ENCODER[dict] = findCompactDictEncoder
+ANY_V.encoders = COMPACT_ENCODER
+
+# The uniform encoding checks the items of each list, and the values of
+# each dict, once. When they are all alike it encodes them with a single
+# codec such as ARRAY(INT32), MAP(TOKEN, FLOAT) or, for a list of dicts
+# all having the same str keys, ARRAY(STRUCT(...)). Otherwise it falls
+# back to ANY, as the default encoding does.
+
+ANY_U = AnyCodec()
+LIST_U = ARRAY(ANY_U)
+DICT_U_ANY_KEY = MAP(ANY_U, ANY_U)
+KEY_CODEC_U = {str: TOKEN, unicode: TEXT, int: INT64}
+
+SCALAR_CODEC = {
+    type(None): NULL,
+    bool: BOOL,
+    float: FLOAT,
+    unicode: TEXT,
+    datetime.datetime: TIME,
+}
+
+UNIFORM_MAX = 1000 # compound codecs cached before the cache is reset
+_uniform_codecs = {}
+
+def uniformCompound(key, make):
+    """Returns a cached compound codec, so equal shapes share one instance."""
+    try:
+        return _uniform_codecs[key]
+    except KeyError:
+        if len(_uniform_codecs) >= UNIFORM_MAX:
+            _uniform_codecs.clear()
+        codec = _uniform_codecs[key] = make()
+        return codec
+
+def uniformCodec(values):
+    """Returns a single codec which can encode each of values, or None."""
+    types = set(map(type, values))
+    if types == set([int, long]):
+        types = set([int])
+    if len(types) != 1:
+        return None
+    t = types.pop()
+    if t in SCALAR_CODEC:
+        return SCALAR_CODEC[t]
+    if t is int or t is long:
+        lo, hi = min(values), max(values)
+        if -2147483648 <= lo and hi <= 2147483647:
+            return INT32
+        if -9223372036854775808 <= lo and hi <= 9223372036854775807:
+            return INT64
+        return None
+    if t is str:
+        try:
+            ''.join(values).decode('ascii')
+            return ASCII
+        except UnicodeDecodeError:
+            return DATA
+    if t is list or t is tuple:
+        item = uniformCodec([x for v in values for x in v])
+        if item is None:
+            return None
+        return uniformCompound(('L', item), lambda: ARRAY(item))
+    if t is dict:
+        keys = values[0].viewkeys()
+        if not keys or [k for k in keys if type(k) is not str]:
+            return None
+        for v in values:
+            if v.viewkeys() != keys:
+                return None
+        fields = tuple([(k, uniformCodec([v[k] for v in values]) or ANY_U)
+                        for k in sorted(keys)])
+        return uniformCompound(('S', fields), lambda: STRUCT(list(fields)))
+    return None
+
+def findUniformListEncoder(value):
+    if len(value) >= PACK_MIN:
+        packed = findPackedEncoder(value)
+        if packed is not None:
+            return packed
+    item = uniformCodec(value)
+    if item is None:
+        return LIST_U
+    return uniformCompound(('L', item), lambda: ARRAY(item))
+
+def findUniformDictEncoder(value):
+    key = KEY_CODEC_U.get(dictKeyType(value))
+    if key is None:
+        return DICT_U_ANY_KEY
+    item = uniformCodec(value.values()) or ANY_U
+    return uniformCompound(('M', key, item), lambda: MAP(key, item))
+
+UNIFORM_ENCODER = dict(ENCODER)
+UNIFORM_ENCODER[list] = findUniformListEncoder
+UNIFORM_ENCODER[tuple] = findUniformListEncoder
+UNIFORM_ENCODER[dict] = findUniformDictEncoder
+ANY_U.encoders = UNIFORM_ENCODER
+
+# The interning encoding writes dict keys, and short str values, as
+# INTERN_STR so that each distinct string is written only once. It is
+# used inside an INTERNED envelope, which provides the string table.
+
+INTERN_MAX = 64 # longer str values are not interned
+
+ANY_I = AnyCodec()
+LIST_I = ARRAY(ANY_I)
+DICT_I_FOR_KEY = {
+    str: MAP(INTERN_STR, ANY_I),
+    unicode: MAP(TEXT, ANY_I),
+    int: MAP(INT64, ANY_I),
+}
+DICT_I_ANY_KEY = MAP(ANY_I, ANY_I)
+
+def findInternStringEncoder(value):
+    if len(value) <= INTERN_MAX:
+        return INTERN_STR
+    return findStringEncoder(value)
+
+def findInternListEncoder(value):
+    if len(value) >= PACK_MIN:
+        return findPackedEncoder(value) or LIST_I
+    return LIST_I
+
+def findInternDictEncoder(value):
+    return DICT_I_FOR_KEY.get(dictKeyType(value), DICT_I_ANY_KEY)
+
+INTERN_ENCODER = dict(ENCODER)
+INTERN_ENCODER[str] = findInternStringEncoder
+INTERN_ENCODER[list] = findInternListEncoder
+INTERN_ENCODER[tuple] = findInternListEncoder
+INTERN_ENCODER[dict] = findInternDictEncoder
+ANY_I.encoders = INTERN_ENCODER
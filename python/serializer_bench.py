@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+"""Benchmark the serializer against other codecs.
+
+Synopsis:
+    serializer_bench [-n number] [-r repeat] [-s seed] [-z size] [-c corpus,...] [-o file]
+
+Each corpus is a reproducible list of representative values: RPC call
+messages, table records, DataLog entries and large lists. Each codec
+encodes and decodes every value of every corpus and the report gives,
+per corpus and codec:
+
+    encode_ops, decode_ops: values per second (best of repeat runs)
+    bytes: mean encoded bytes per value
+
+Codecs which cannot handle a corpus report the error instead.
+
+The report is written to stdout (or the -o file) as JSON.
+"""
+
+import datetime
+import json
+import marshal
+import random
+import sys
+import time
+import cPickle as pickle
+from serf.serializer import encodes, decodes, COMPACT_ENCODER, UNIFORM_ENCODER, INTERNED
+from serf.json_codec import JSON_CODEC
+from serf.util import getOptions
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november']
+
+def rpcCalls(rnd, size):
+    """Messages as sent by RPCHandler.call."""
+    return [{'m': rnd.choice(WORDS),
+             'a': [rnd.randint(0, 1000), rnd.choice(WORDS), rnd.random()],
+             'O': (rnd.getrandbits(20) << 32) + i,
+             'o': 'obj%d' % rnd.randint(0, 100)}
+            for i in xrange(size)]
+
+def tableRecords(rnd, size):
+    """Flat records of the kind kept in a tables.Table."""
+    return [{'id': i,
+             'name': u' '.join(rnd.sample(WORDS, 2)).title(),
+             'email': '%s@example.com' % rnd.choice(WORDS),
+             'age': rnd.randint(18, 90),
+             'score': round(rnd.uniform(0, 100), 2),
+             'active': rnd.random() < 0.5,
+             'tags': rnd.sample(WORDS, 3)}
+            for i in xrange(size)]
+
+def logEntries(rnd, size):
+    """DataLog entries: timestamped events with a small payload."""
+    t0 = datetime.datetime(2014, 1, 1)
+    return [{'t': t0 + datetime.timedelta(seconds=i * 7),
+             'ev': rnd.choice(['login', 'logout', 'update', 'delete']),
+             'user': rnd.choice(WORDS),
+             'data': {'n': rnd.randint(0, 10), 'path': '/'.join(rnd.sample(WORDS, 3))}}
+            for i in xrange(size)]
+
+def largeLists(rnd, size):
+    """A few long homogeneous lists."""
+    n = max(size, 1) * 10
+    return [[rnd.randint(-10**6, 10**6) for i in xrange(n)],
+            [rnd.random() for i in xrange(n)],
+            [rnd.choice(WORDS) for i in xrange(n)]]
+
+CORPORA = [
+    ('rpc', rpcCalls),
+    ('table', tableRecords),
+    ('log', logEntries),
+    ('lists', largeLists),
+]
+
+def makeCorpora(seed=0, size=100, names=None):
+    """Returns [(name, values)] generated reproducibly from seed."""
+    corpora = []
+    for name, fn in CORPORA:
+        if names is None or name in names:
+            corpora.append((name, fn(random.Random(seed), size)))
+    return corpora
+
+CODECS = [
+    ('serf', encodes, decodes),
+    ('serf-compact', lambda v: encodes(v, encoders=COMPACT_ENCODER), decodes),
+    ('serf-uniform', lambda v: encodes(v, encoders=UNIFORM_ENCODER), decodes),
+    ('serf-interned', lambda v: encodes(v, encoder=INTERNED), decodes),
+    ('json', JSON_CODEC.encode, JSON_CODEC.decode),
+    ('pickle', lambda v: pickle.dumps(v, 2), pickle.loads),
+    ('marshal', marshal.dumps, marshal.loads),
+]
+
+def bestTime(fn, args, number, repeat):
+    """Returns the least time taken to apply fn to each of args number times."""
+    best = None
+    for r in xrange(repeat):
+        begin = time.time()
+        for i in xrange(number):
+            for a in args:
+                fn(a)
+        elapsed = time.time() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchCodec(values, enc, dec, number=10, repeat=3):
+    """Returns the measurements of one codec on one corpus."""
+    try:
+        encoded = [enc(v) for v in values]
+        decoded = [dec(e) for e in encoded]
+    except Exception, e:
+        return {'error': '%s: %s' % (type(e).__name__, e)}
+    count = float(len(values) * number)
+    t_enc = bestTime(enc, values, number, repeat)
+    t_dec = bestTime(dec, encoded, number, repeat)
+    return {
+        'encode_ops': count / t_enc if t_enc else None,
+        'decode_ops': count / t_dec if t_dec else None,
+        'bytes': float(sum(len(e) for e in encoded)) / len(values),
+        'round_trip': decoded == values,
+    }
+
+def benchmark(corpora, codecs=CODECS, number=10, repeat=3):
+    """Returns a report of every codec on every corpus."""
+    results = {}
+    for name, values in corpora:
+        results[name] = dict(
+            (cname, benchCodec(values, enc, dec, number, repeat))
+            for cname, enc, dec in codecs)
+    return {
+        'python': sys.version.split()[0],
+        'number': number,
+        'repeat': repeat,
+        'sizes': dict((name, len(values)) for name, values in corpora),
+        'results': results,
+    }
+
+def main():
+    opt, args = getOptions('hn:r:s:c:z:o:')
+    corpus = opt('-c')
+    corpora = makeCorpora(int(opt('-s', 0)), int(opt('-z', 100)),
+                          corpus and corpus.split(','))
+    report = benchmark(corpora, number=int(opt('-n', 10)), repeat=int(opt('-r', 3)))
+    out = open(opt('-o'), 'w') if opt('-o') else sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+if __name__ == '__main__':
+    main()
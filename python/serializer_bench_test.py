@@ -0,0 +1,29 @@
+#!/usr/bin/python
+
+"""Tests for serializer_bench."""
+
+import unittest
+from serf.serializer_bench import makeCorpora, benchmark, CODECS
+
+class SerializerBenchTest(unittest.TestCase):
+    def testCorpora(self):
+        a = makeCorpora(seed=1, size=5)
+        self.assertEqual([name for name, values in a], ['rpc', 'table', 'log', 'lists'])
+        self.assertEqual(a, makeCorpora(seed=1, size=5))
+        self.assertNotEqual(a, makeCorpora(seed=2, size=5))
+        self.assertEqual(len(makeCorpora(size=5, names=['log'])), 1)
+
+    def testBenchmark(self):
+        report = benchmark(makeCorpora(size=3), number=1, repeat=1)
+        self.assertEqual(report['sizes']['rpc'], 3)
+        results = report['results']
+        self.assertEqual(sorted(results['table']), sorted(c[0] for c in CODECS))
+        serf = results['table']['serf']
+        self.assertTrue(serf['round_trip'])
+        self.assertTrue(serf['bytes'] > 0)
+        self.assertTrue(serf['encode_ops'] > 0)
+        # marshal cannot handle datetimes.
+        self.assertTrue('error' in results['log']['marshal'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -135,6 +135,310 @@ class SerializationTest(unittest.TestCase):
         msg3 = decodes(m_enc, ctx=REG)
         self.assertEqual(msg3.value, val1)
 
+    def testCompiled(self):
+        # Runs of fixed-width fields are packed together, giving the
+        # same encoding as encoding each field separately.
+        s = STRUCT([('id', INT32), ('ok', BOOL), ('x', FLOAT),
+                    ('name', TEXT), ('n', INT64), ('b', BYTE)])
+        val = {'id': -7, 'ok': True, 'x': 1.5, 'name': u'Fred', 'n': 2**40, 'b': 9}
+        enc = encodes(val, encoder=s)
+        f = StringIO()
+        for k, c in s.fields:
+            c.encode(f, val[k], None)
+        self.assertTrue(enc.endswith(f.getvalue()))
+        self.assertEqual(decodes(enc), val)
+        self.assertEqual(type(decodes(enc)['ok']), bool)
+        self.assertTrue(s._compiled is not None)
+
+        t = TUPLE(INT16, INT16, ASCII, BOOL)
+        self.assertEqual(encodes([1, 2, 'a', False], encoder=t),
+                         'T\x00\x00\x00\x04hhab\x00\x01\x00\x02\x00\x00\x00\x01a\x00')
+        self.assertEqual(decodes(encodes([1, 2, 'a', False], encoder=t)), [1, 2, 'a', False])
+
+        v = VECTOR(FLOAT, 3)
+        self.assertEqual(decodes(encodes([1.0, 2.5, -3.0], encoder=v)), [1.0, 2.5, -3.0])
+        self.assertEqual(v.compile(), v.compile()) # cached
+
+    def testDecodeFrom(self):
+        val = {'name': u'Fred', 'tags': ['a', 'b'], 'n': [1, 2, 3], 'x': 1.5}
+        enc = encodes(val)
+        for buf in (enc, buffer(enc), bytearray(enc), memoryview(enc)):
+            self.assertEqual(decodeFrom(buf), (val, len(enc)))
+
+        # Decoding can start at any offset; the end offset is returned.
+        pair = 'xx' + encodes(42) + encodes('Fred')
+        n, pos = decodeFrom(pair, 2)
+        self.assertEqual((n, pos), (42, 7))
+        self.assertEqual(decodeFrom(buffer(pair), pos), ('Fred', len(pair)))
+
+        s = STRUCT([('id', INT32), ('name', ASCII), ('ok', BOOL)])
+        enc = encodes({'id': 1, 'name': 'a', 'ok': False}, encoder=s)
+        self.assertEqual(decodeFrom(memoryview(enc))[0], {'id': 1, 'name': 'a', 'ok': False})
+
+        # Messages are decoded in place from the enclosing buffer.
+        REG.register('point', 5, TUPLE(INT32, INT32))
+        enc = encodes(Record('point', [3, 4]), ctx=REG)
+        self.assertEqual(decodeFrom(buffer(enc), 0, REG)[0].value, [3, 4])
+        self.assertEqual(decodeFrom(enc)[0], Record('@', '\x00\x00\x00\x03\x00\x00\x00\x04', 5))
+
+        self.assertRaises(SerializationError, decodes, 'a\x00\x00\x00\x04Fr')
+
+    def testSchema(self):
+        class StreamCtx(object):
+            def __init__(self):
+                self.schema = Schema()
+        s = STRUCT([('name', TEXT), ('dob', TIME), ('level', INT16)])
+        val = {'name': u'Fred', 'dob': datetime.datetime(1973,4,22), 'level': 3}
+        out = StreamCtx()
+        enc1 = encodes(val, out, encoder=s)
+        enc2 = encodes(val, out, encoder=s)
+        # The first message defines the type, the second refers to it.
+        plain = encodes(val, encoder=s)
+        f = StringIO()
+        s.encodeType(f)
+        self.assertEqual(enc1, '=\x00\x00' + plain)
+        self.assertEqual(enc2, '#\x00\x00' + plain[len(f.getvalue()):])
+
+        # Short descriptors are always written inline.
+        self.assertEqual(encodes({'a': 1}, out), encodes({'a': 1}))
+
+        inp = StreamCtx()
+        self.assertEqual(decodes(enc1, inp), val)
+        self.assertEqual(decodes(enc2, inp), val)
+        self.assertEqual(decode(StringIO(enc2), inp), val)
+
+        # A reference cannot be decoded without the stream's definitions.
+        self.assertRaises(SerializationError, decodes, enc2)
+        self.assertRaises(SerializationError, decodes, enc2, StreamCtx())
+
+    def testVarInt(self):
+        for n in (0, 1, -1, 63, -64, 64, 300, -300, 2**31, -2**63, 2**70):
+            enc = encodes(n, encoder=VARINT)
+            self.assertEqual(decodes(enc), n)
+            self.assertEqual(decodeFrom(buffer(enc)), (n, len(enc)))
+        self.assertEqual(encodes(0, encoder=VARINT), 'v\x00')
+        self.assertEqual(encodes(-1, encoder=VARINT), 'v\x01')
+        self.assertEqual(encodes(1, encoder=VARINT), 'v\x02')
+        self.assertEqual(encodes(64, encoder=VARINT), 'v\x80\x01')
+        self.assertRaises(SerializationError, decodes, 'v\x80')
+
+    def testCompact(self):
+        val = {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5}
+        enc = encodes(val, encoders=COMPACT_ENCODER)
+        self.assertEqual(len(enc), 24)
+        self.assertEqual(len(encodes(val)), 47)
+        self.assertEqual(decodes(enc), val)
+
+        val = [u'Fr\xe9d', 'Fred', '\x81', -7, 2**40, 1.5, None, True,
+               {u'x': [1]}, {1: 'a'}, {1: 'a', 'b': 2}, (3, 4)]
+        enc = encodes(val, encoders=COMPACT_ENCODER)
+        self.assertEqual(enc[:3], 'lA\x0c')
+        self.assertEqual(decodes(enc), [u'Fr\xe9d', 'Fred', '\x81', -7, 2**40, 1.5,
+                                        None, True, {u'x': [1]}, {1: 'a'},
+                                        {1: 'a', 'b': 2}, [3, 4]])
+        self.assertEqual(decode(StringIO(enc)), decodes(enc))
+
+        # Records embedded in compact values have compact bodies.
+        REG.register('custom', 4, ANY)
+        REG.addCustom('custom', Custom.construct)
+        enc = encodes([Custom(1, 2)], ctx=REG, encoders=COMPACT_ENCODER)
+        self.assertEqual(decodes(enc, ctx=REG), [Custom(1, 2)])
+
+    def testPacked(self):
+        floats = [i * 0.5 for i in range(20)]
+        enc = encodes(floats, encoders=PACKED_ENCODER)
+        self.assertEqual(enc[:6], 'Pd\x00\x00\x00\x14')
+        self.assertEqual(len(enc), 6 + 20 * 8)
+        self.assertEqual(decodes(enc), floats)
+        self.assertEqual(decode(StringIO(enc)), floats)
+
+        # The default encoding does not pack.
+        self.assertEqual(encodes(floats)[:2], 'LA')
+
+        def packed(value):
+            return encodes(value, encoders=PACKED_ENCODER)
+        ints = range(-10, 10)
+        self.assertEqual(packed(ints)[:2], 'Pi')
+        self.assertEqual(decodes(packed(ints)), ints)
+        self.assertEqual(packed(ints + [2**40])[:2], 'Pq')
+        self.assertEqual(decodes(packed(tuple(ints) + (2**40,))), ints + [2**40])
+        self.assertTrue('Pi' in packed({'a': [ints]}))
+
+        # Mixed and short lists are not packed.
+        self.assertEqual(packed(ints[:-1] + [1.0])[:2], 'LA')
+        self.assertEqual(packed(ints[:-1] + [True])[:2], 'LA')
+        self.assertEqual(packed([1.0, 2.0])[:2], 'LA')
+        self.assertEqual(encodes(floats, encoders=COMPACT_ENCODER)[:2], 'Pd')
+
+        class Ctx(object):
+            packed_as = 'array'
+        a = decodes(enc, Ctx())
+        self.assertEqual(type(a), array.array)
+        self.assertEqual(a.tolist(), floats)
+        self.assertEqual(decodeFrom(buffer(enc), 0, Ctx())[0], a)
+        self.assertEqual(decodes(encodes(a)), floats)
+        self.assertEqual(decodes(encodes(array.array('h', [1, -2]))), [1, -2])
+        self.assertEqual(decodes(encodes(array.array('c', 'ab'))), ['a', 'b'])
+        self.assertEqual(decodes(encodes(array.array('u', u'ab'))), [u'a', u'b'])
+        big = array.array('L', [1, 2 ** 63 - 1])
+        self.assertEqual(decodes(encodes(big)), [1, 2 ** 63 - 1])
+        big.append(2 ** 63)
+        self.assertRaises(Exception, encodes, big) # not wrapped around
+
+    def testRecordView(self):
+        rec = {'name': 'fred', 'age': 42, 'tags': ['x', 'y'], 'addr': {'city': 'Paris'}}
+        view = decodeView(encodes(rec))
+        self.assertEqual(type(view), RecordView)
+        self.assertEqual(view._values, {})
+        self.assertEqual(view['age'], 42)
+        self.assertEqual(view._values, {'age': 42})
+        self.assertEqual(view['addr']['city'], 'Paris')
+        self.assertEqual(view.get('missing', 1), 1)
+        self.assertTrue('tags' in view)
+        self.assertEqual(sorted(view), sorted(rec))
+        self.assertEqual(view, rec)
+
+        s = STRUCT([('name', TEXT), ('dob', TIME), ('tags', ARRAY(TOKEN))])
+        val = {'name': u'Fred', 'dob': datetime.datetime(1973,4,22), 'tags': ['a']}
+        view = decodeView(encodes(val, encoder=s))
+        self.assertEqual(view['tags'], ['a'])
+        self.assertEqual(view, val)
+
+        # Other values are decoded as usual.
+        self.assertEqual(decodeView(encodes([1, 'a'])), [1, 'a'])
+
+        # Trailing garbage is rejected.
+        self.assertRaises(SerializationError, decodeView, encodes(rec) + 'x')
+
+    def testSkip(self):
+        values = [None, True, 5, 1 << 40, 1.5, 'abc', u'\u00e9', [1, 'a'],
+                  range(20), {'a': [1]}, Record('r', {'x': 1}),
+                  datetime.datetime(2001,1,1), 'x' * 300]
+        for v in values:
+            for encoders in (None, COMPACT_ENCODER):
+                enc = encodes(v, encoders=encoders) + 'tail'
+                codec, pos = TYPE.decodeFrom(enc, 0, None)
+                self.assertEqual(enc[codec.skipFrom(enc, pos, None):], 'tail')
+
+    def testCompressed(self):
+        value = {'rows': [{'name': u'row %d' % i, 'ok': True} for i in range(50)]}
+        enc = encodes(value)
+        self.assertEqual(compress(enc, len(enc) + 1), enc) # under threshold
+        self.assertEqual(compress('abcdefgh', 1), 'abcdefgh') # does not shrink
+        z = compress(enc, 100)
+        self.assertEqual(z[0], 'z')
+        self.assertTrue(len(z) < len(enc) / 4)
+        self.assertEqual(decodes(z), value)
+        self.assertEqual(decode(StringIO(z)), value)
+        self.assertEqual(decodes(encodes([z], encoder=None)), [z])
+        self.assertEqual(decodes(encodes(value, encoder=COMPRESSED)), value)
+        self.assertEqual(COMPRESSED.skipFrom(z + 'x', 1, None), len(z))
+        self.assertRaises(SerializationError, decodes, 'z\x00\x00\x00\x02xx')
+
+    def testUniform(self):
+        def enc(value):
+            return encodes(value, encoders=UNIFORM_ENCODER)
+        self.assertEqual(enc([1, 2, 3]), encodes([1, 2, 3], encoder=ARRAY(INT32)))
+        self.assertEqual(enc(['a', 'b']), encodes(['a', 'b'], encoder=ARRAY(ASCII)))
+        self.assertEqual(enc({'x': 1.5, 'y': 2.0}),
+                         encodes({'x': 1.5, 'y': 2.0}, encoder=MAP(TOKEN, FLOAT)))
+        rows = [{'id': i, 'name': u'row', 'v': [i, 'x']} for i in range(3)]
+        shape = STRUCT([('id', INT32), ('name', TEXT), ('v', ANY_U)])
+        self.assertEqual(enc(rows), encodes(rows, encoder=ARRAY(shape)))
+        self.assertTrue(len(enc(rows)) < len(encodes(rows)))
+        # Shapes are shared.
+        self.assertTrue(findUniformListEncoder(rows) is findUniformListEncoder(rows[1:]))
+        # Mixed items fall back to ANY.
+        self.assertEqual(enc([1, 'a']), encodes([1, 'a'], encoder=LIST_U))
+        self.assertEqual(enc([{'a': 1}, {'b': 1}])[:2], 'LA')
+        self.assertEqual(enc([1, 1 << 40]), encodes([1, 1 << 40], encoder=ARRAY(INT64)))
+        self.assertEqual(enc(range(20))[0], 'P')
+        nested = [[{'a': 1}, {'a': 2}], [], [1, None], {1: [u'a', u'b']}]
+        for value in nested + [rows, []]:
+            self.assertEqual(decodes(enc(value)), value)
+
+    def testInterned(self):
+        rows = [{'name': 'fred', 'id': i, 'note': 'x' * 100} for i in range(10)]
+        enc = encodes(rows, encoder=INTERNED)
+        self.assertEqual(enc.count('name'), 1)
+        self.assertEqual(enc.count('fred'), 1)
+        self.assertEqual(enc.count('x' * 100), 10) # too long to intern
+        self.assertTrue(len(enc) < len(encodes(rows)))
+        dec = decodes(enc)
+        self.assertEqual(dec, rows)
+        keys = [[k for k in row if k == 'name'][0] for row in dec]
+        self.assertTrue(keys[0] is keys[-1] is intern('name'))
+
+        # Records and custom values still go through the context.
+        rec = Record('r', {'k': 'v'})
+        self.assertEqual(decodes(encodes([rec, rec], encoder=INTERNED)), [rec, rec])
+        self.assertRaises(SerializationError, encodes, object(), encoder=INTERNED)
+
+        # A stream shares its table between messages.
+        class Ctx(object):
+            pass
+        out_ctx, in_ctx = Ctx(), Ctx()
+        out_ctx.strings, in_ctx.strings = StringTable(), StringTable()
+        m1 = encodes({'key': 1}, out_ctx, encoder=INTERNED)
+        m2 = encodes({'key': 2}, out_ctx, encoder=INTERNED)
+        self.assertTrue('key' not in m2)
+        self.assertEqual(decodes(m1, in_ctx), {'key': 1})
+        self.assertEqual(decodes(m2, in_ctx), {'key': 2})
+        self.assertRaises(SerializationError, decodes, m2, Ctx())
+        self.assertRaises(SerializationError, decodes, 'n\x01')
+
+    def testEncodedSize(self):
+        REG.register('custom', 4, ANY)
+        REG.register('point', 5, TUPLE(INT32, INT32))
+        REG.addCustom('custom', Custom.construct)
+        values = [None, True, 42, -5, 1 << 40, 1.5, 'abc', '\x81', u'caf\u00e9',
+                  datetime.datetime(2001, 1, 1), [1, 'a', None], range(20),
+                  {'a': [1.0, 2.0], 'b': {u'c': 'd'}, 'e': ()}, {1: 2, 'x': 3},
+                  Record('@', 'raw', 7),
+                  INT32, ARRAY(TEXT)]
+        # Values which could only be sized by encoding them are not.
+        unsized = [Custom(1, 2), [Record('point', [1, 2])]]
+        for value in values + unsized:
+            for encoders in (None, COMPACT_ENCODER, UNIFORM_ENCODER):
+                enc = encodes(value, REG, encoders=encoders)
+                if value in unsized:
+                    self.assertRaises(CannotSize, encodedSize, value, REG, encoders=encoders)
+                else:
+                    self.assertEqual(encodedSize(value, REG, encoders=encoders), len(enc))
+                self.assertEqual(str(encodeb(value, REG, encoders=encoders)), enc)
+        codecs = [(VECTOR(BYTE, 3), [1, 2, 3]), (ENUM({'a': 1}), 'a'),
+                  (CONST(5), 5), (STRUCT([('x', BOOL), ('y', TEXT)]), {'x': True, 'y': u'y'})]
+        for codec, value in codecs:
+            enc = encodes(value, encoder=codec)
+            self.assertEqual(encodedSize(value, encoder=codec), len(enc))
+            self.assertEqual(str(encodeb(value, encoder=codec)), enc)
+        for codec, value in [(INTERNED, {'k': ['k', 'k']}), (COMPRESSED, 'x' * 100)]:
+            self.assertRaises(CannotSize, encodedSize, value, encoder=codec)
+            self.assertEqual(str(encodeb(value, encoder=codec)), encodes(value, encoder=codec))
+
+        buf = encodeb([1, 2], head=4, tail=2)
+        self.assertEqual(len(buf), len(encodes([1, 2])) + 6)
+        self.assertEqual(str(buf[4:-2]), encodes([1, 2]))
+
+        class Ctx(object):
+            schema = Schema()
+        self.assertRaises(SerializationError, encodedSize, [1], Ctx())
+        self.assertEqual(decodes(str(encodeb([1], Ctx())), Ctx()), [1])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def testPackedNumpy(self):
+        class Ctx(object):
+            packed_as = 'numpy'
+        floats = [i * 0.5 for i in range(20)]
+        a = decodes(encodes(floats, encoders=PACKED_ENCODER), Ctx())
+        self.assertEqual(type(a), numpy.ndarray)
+        self.assertEqual(a.tolist(), floats)
+        self.assertEqual(decodes(encodes(a)), floats)
+        self.assertEqual(decodes(encodes(numpy.arange(5))), range(5))
+        big = numpy.array([1, 2 ** 63], dtype=numpy.uint64)
+        self.assertRaises(SerializationError, encodes, big)
+        self.assertEqual(decodes(encodes(big[:1])), [1])
+
     def testConst(self):
         lucky = CONST(3)
         f = StringIO('')
@@ -0,0 +1,287 @@
+"""Spreading a node's objects over several processes.
+
+A ShardRouter owns the node's Transport. Each of its shards is a
+process (see startShards) with its own RPCHandler and Storage, holding
+the objects whose paths it owns (see Shard.owner). The router passes
+messages between the transport and the shards over socket pairs,
+choosing the shard for each message by its 'o' address, and passes
+messages between shards in the same way.
+
+All the shards have the node's id, so the Proxies and Refs they hand
+out refer to the node as a whole and keep working whichever shard
+holds the object.
+
+A batch of calls (see RPCHandler.callBatch) goes to the shard owning
+the path of its first call, which passes calls to objects of other
+shards on to them. The calls of a batch are then run in order within
+each shard, but not across shards.
+
+The router also tells the shards which transport features (see
+transport.FEATURES) each peer supports, so they can tell which peers
+accept int reply addresses and compressed messages.
+
+Limitations: peers must not stream schemas to a sharded node (the
+'schemas' serf option), since definitions would be split between
+shards; each shard has its own name store; and a shard is not told
+when the router fails to deliver one of its messages, so such calls
+fail only when they time out.
+"""
+
+import json
+import multiprocessing
+import random
+import socket
+import struct
+import threading
+import traceback
+import zlib
+from serf.publisher import Publisher
+from serf.serializer import decodeView, decodes, SerializationError
+from serf.transport import FEATURES
+
+MSG = 0
+EVENT = 1
+FEATURES_OF = 2 # the data is the transport features of node
+
+HEADER = struct.Struct('>bHI')
+
+class Shard(object):
+    """One of count shards of the object paths of a node.
+
+    Reply addresses (see RPCHandler.call) are owned by the shard whose
+    reply prefix they carry.
+
+    :param index: number of this shard
+    :param count: number of shards
+    :param base: reply prefix number of shard 0
+    """
+    def __init__(self, index, count, base):
+        self.index = index
+        self.count = count
+        self.base = base
+
+    def owner(self, addr):
+        """Returns the number of the shard owning addr."""
+        if isinstance(addr, basestring):
+            if addr[:1] != '@' or not addr[1:].isdigit():
+                return (zlib.crc32(addr) & 0xffffffff) % self.count
+            addr = int(addr[1:]) # a reply address, as sent to older peers
+        return (addr >> 32) - self.base
+
+    def owns(self, addr):
+        return self.owner(addr) == self.index
+
+    def replyPrefix(self):
+        return (self.base + self.index) << 32
+
+def writeFrame(sock, kind, node, data):
+    """Writes a message (or event) to or from node on a shard socket."""
+    sock.sendall(HEADER.pack(kind, len(node), len(data)) + node)
+    if data:
+        sock.sendall(data)
+
+def readAll(sock, n):
+    buf = []
+    while n:
+        data = sock.recv(min(n, 65536))
+        if not data:
+            return None
+        buf.append(data)
+        n -= len(data)
+    return ''.join(buf)
+
+def readFrame(sock):
+    """Returns (kind, node, data), or (None, None, None) at end of input."""
+    header = readAll(sock, HEADER.size)
+    if header is None:
+        return None, None, None
+    kind, node_len, data_len = HEADER.unpack(header)
+    node = readAll(sock, node_len) if node_len else ''
+    data = readAll(sock, data_len) if data_len else ''
+    if node is None or data is None:
+        return None, None, None
+    return kind, node, data
+
+class RouteCtx(object):
+    """Decoding context for finding a message's address."""
+    def custom(self, name, data):
+        return data
+
+    def codec(self, type_id):
+        return None, None
+
+    def namedCodec(self, type_name):
+        return None, None
+
+ROUTE_CTX = RouteCtx()
+
+# Peers whose messages are JSON (see RPCHandler._peer_protocol).
+JSON_PEERS = ('server', 'browser')
+
+def messageAddr(data, from_=None):
+    """Returns the 'o' address of an encoded message from node from_."""
+    if from_ in JSON_PEERS:
+        return json.loads(data)['o']
+    try:
+        return decodeView(data, ROUTE_CTX)['o']
+    except (SerializationError, KeyError, TypeError):
+        # e.g. compressed or interned: decode the lot.
+        return decodes(data, ROUTE_CTX)['o']
+
+class PipeTransport(Publisher):
+    """Implements Transport for a shard, over a socket to its router."""
+    def __init__(self, sock, node_id):
+        Publisher.__init__(self)
+        self.sock = sock
+        self.node_id = node_id
+        self.path = ''
+        self.lock = threading.Lock()
+        self.features = {node_id: FEATURES} # the other shards
+
+    def send(self, node, msg, errh=None):
+        try:
+            with self.lock:
+                writeFrame(self.sock, MSG, node, msg)
+        except Exception, e:
+            if errh is not None:
+                errh(e)
+            else:
+                traceback.print_exc()
+
+    def peerFeatures(self, node):
+        """Returns the FEATURES supported by a node, as told by the router."""
+        return self.features.get(node, '')
+
+    def run(self):
+        """Delivers incoming messages until the router goes away."""
+        while True:
+            kind, node, data = readFrame(self.sock)
+            if kind is None:
+                break
+            if kind == MSG:
+                self.notify('message', {'from': node, 'message': data})
+            elif kind == FEATURES_OF:
+                self.features[node] = data
+            else:
+                if data == 'disconnected':
+                    self.features.pop(node, None)
+                self.notify(data, node)
+
+class ShardRouter(object):
+    """Passes messages between a node's transport and its shards.
+
+    :param transport: the node's Transport
+    :param socks: the router's ends of the shard sockets, in shard order
+    :param base: reply prefix number of shard 0
+    """
+    def __init__(self, transport, socks, base):
+        self.transport = transport
+        self.socks = socks
+        self.locks = [threading.Lock() for sock in socks]
+        self.shard = Shard(None, len(socks), base)
+        self.threads = []
+        self.told = set() # nodes whose features the shards know
+        self.told_lock = threading.Lock()
+        transport.subscribe('message', self.fromNode)
+        for ev in ('connected', 'disconnected'):
+            transport.subscribe(ev, self.event)
+
+    def start(self):
+        for sock in self.socks:
+            thread = threading.Thread(target=self.fromShard, args=(sock,))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for sock in self.socks:
+            sock.shutdown(socket.SHUT_RDWR)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _write(self, index, kind, node, data):
+        with self.locks[index]:
+            writeFrame(self.socks[index], kind, node, data)
+
+    def route(self, from_, data):
+        try:
+            index = self.shard.owner(messageAddr(data, from_))
+        except Exception:
+            traceback.print_exc()
+            return
+        if 0 <= index < len(self.socks):
+            self._write(index, MSG, from_, data)
+
+    def fromNode(self, ev, msg):
+        if msg['from'] not in self.told:
+            self.tellFeatures(msg['from']) # connected before we started
+        self.route(msg['from'], msg['message'])
+
+    def tellFeatures(self, node):
+        # Without peerFeatures the transport is taken to offer none,
+        # except int reply addresses, as RPCHandler does.
+        peerFeatures = getattr(self.transport, 'peerFeatures', None)
+        features = 'I' if peerFeatures is None else peerFeatures(node)
+        with self.told_lock:
+            self.told.add(node)
+            for index in xrange(len(self.socks)):
+                self._write(index, FEATURES_OF, node, features)
+
+    def fromShard(self, sock):
+        node_id = self.transport.node_id
+        while True:
+            kind, node, data = readFrame(sock)
+            if kind is None:
+                break
+            if node == node_id:
+                self.route(node_id, data)
+            else:
+                self.transport.send(node, data)
+
+    def event(self, ev, node):
+        if ev == 'connected':
+            self.tellFeatures(node)
+        else:
+            with self.told_lock:
+                self.told.discard(node)
+        for index in xrange(len(self.socks)):
+            self._write(index, EVENT, node, ev)
+
+def runShard(shard, sock, node_id, setup):
+    """Runs a shard until its router goes away.
+
+    setup(shard, transport) is called to make the shard's RPCHandler.
+    """
+    transport = PipeTransport(sock, node_id)
+    rpc = setup(shard, transport)
+    rpc.setShard(shard)
+    transport.run()
+
+def _shardMain(shard, sock, node_id, setup, others):
+    # Let the router see when other shards go away.
+    for other in others:
+        other.close()
+    runShard(shard, sock, node_id, setup)
+
+def startShards(transport, count, setup):
+    """Starts count shard processes and returns their router.
+
+    Each shard calls setup(shard, transport) in its own process to make
+    its RPCHandler, typically with a Storage over a store of its own
+    such as FSDict(root + '/%d' % shard.index).
+    """
+    base = random.randrange((1 << 20) - count)
+    socks = []
+    for index in xrange(count):
+        ours, theirs = socket.socketpair()
+        proc = multiprocessing.Process(
+            target=_shardMain,
+            args=(Shard(index, count, base), theirs, transport.node_id, setup, socks + [ours]))
+        proc.daemon = True
+        proc.start()
+        theirs.close()
+        socks.append(ours)
+    router = ShardRouter(transport, socks, base)
+    router.start()
+    return router
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+"""Tests for sharding a node across processes."""
+
+import socket
+import threading
+import time
+import unittest
+from serf.shard import Shard, ShardRouter, PipeTransport, runShard, writeFrame, readFrame, messageAddr, MSG
+from serf.transport import FEATURES
+from serf.mock_net import MockNet
+from serf.rpc_handler import RPCHandler, RemoteException
+from serf.storage import Storage
+from serf.serializer import encodes
+from serf.json_codec import JSON_CODEC
+from serf.proxy import Proxy
+from serf.test_object import TestObject
+from serf.worker import Worker
+from serf.eventlet_thread import EventletThread
+
+def ownedPath(shard, index):
+    for i in xrange(100):
+        path = 'obj%d' % i
+        if shard.owner(path) == index:
+            return path
+
+class ShardTest(unittest.TestCase):
+    def testShard(self):
+        s0, s1 = Shard(0, 2, 100), Shard(1, 2, 100)
+        for path in ['a', 'b', 'c/d', 'node_observer']:
+            self.assertTrue(s0.owns(path) != s1.owns(path))
+        self.assertEqual(s1.replyPrefix(), 101 << 32)
+        self.assertTrue(s1.owns((101 << 32) + 5))
+        self.assertFalse(s0.owns((101 << 32) + 5))
+        self.assertTrue(s1.owns('@%d' % ((101 << 32) + 5)))
+        self.assertTrue(s0.owns('@vat/cb1') != s1.owns('@vat/cb1')) # old style
+
+    def testFrames(self):
+        a, b = socket.socketpair()
+        writeFrame(a, MSG, 'node', 'data')
+        writeFrame(a, MSG, '', '')
+        self.assertEqual(readFrame(b), (MSG, 'node', 'data'))
+        self.assertEqual(readFrame(b), (MSG, '', ''))
+        a.close()
+        self.assertEqual(readFrame(b), (None, None, None))
+
+    def testMessageAddr(self):
+        self.assertEqual(messageAddr(encodes({'m': 'f', 'a': [1], 'o': 'x'})), 'x')
+        self.assertEqual(messageAddr(encodes({'r': None, 'o': 5 << 32})), 5 << 32)
+        call = JSON_CODEC.encode({'m': 'f', 'a': [1], 'O': 'cb1', 'o': 'x'})
+        self.assertEqual(messageAddr(call, 'browser'), 'x')
+        reply = JSON_CODEC.encode({'r': None, 'o': 5 << 32})
+        self.assertEqual(messageAddr(reply, 'server'), 5 << 32)
+
+    def testFeatures(self):
+        net = MockNet()
+        node = net.addNode('A')
+        node.peerFeatures = {'B': 'Z', 'C': ''}.get
+        ours, theirs = socket.socketpair()
+        router = ShardRouter(node, [ours], 7)
+        pipe = PipeTransport(theirs, 'A')
+        events = []
+        def connected(ev, node):
+            events.append(node)
+        pipe.subscribe('connected', connected) # subscriptions are weak
+        thread = threading.Thread(target=pipe.run)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            node.notify('connected', 'B')
+            net.addNode('C').send('A', encodes({'r': 1, 'o': 7 << 32}))
+            for i in xrange(100):
+                if events and 'C' in pipe.features:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(pipe.peerFeatures('B'), 'Z')
+            self.assertEqual(pipe.peerFeatures('C'), '')
+            self.assertEqual(pipe.peerFeatures('D'), '')
+            self.assertEqual(pipe.peerFeatures('A'), FEATURES)
+        finally:
+            ours.shutdown(socket.SHUT_RDWR)
+            thread.join()
+
+    def testRouter(self):
+        net = MockNet()
+        base = 7
+        socks, threads, workers = [], [], []
+        def setup(shard, transport):
+            worker = EventletThread()
+            worker.start(True)
+            workers.append(worker)
+            storage = Storage({})
+            storage[ownedPath(shard, shard.index)] = TestObject()
+            return RPCHandler(transport, storage, t_model=worker)
+        for index in range(2):
+            ours, theirs = socket.socketpair()
+            socks.append(ours)
+            thread = threading.Thread(
+                target=runShard, args=(Shard(index, 2, base), theirs, 'A', setup))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        router = ShardRouter(net.addNode('A'), socks, base)
+        router.start()
+
+        client = Worker()
+        client.start()
+        vb = RPCHandler(net.addNode('B'), {}, t_model=client)
+        try:
+            shard = Shard(None, 2, base)
+            px = Proxy('A', ownedPath(shard, 0), vb)
+            py = Proxy('A', ownedPath(shard, 1), vb)
+            self.assertEqual(px.incr(1), 2)
+            self.assertEqual(py.incr(2), 3)
+
+            # x (in shard 0) calls y (in shard 1) via the router.
+            px.setProxy(py)
+            self.assertEqual(px.callIncr(5), 6)
+
+            # A batch spanning both shards.
+            with px._batch() as batch:
+                fx = batch.incr(10)
+                fy = batch.on(py).incr(20)
+                fz = batch.on('nothing').incr(1)
+            self.assertEqual(fx.wait(), 11)
+            self.assertEqual(fy.wait(), 21)
+            self.assertRaises(RemoteException, fz.wait)
+
+            # JSON from a browser is routed too.
+            browser = net.addNode('browser')
+            replies = []
+            def record(ev, msg):
+                replies.append(JSON_CODEC.decode(msg['message']))
+            browser.subscribe('message', record)
+            browser.send('A', JSON_CODEC.encode(
+                {'m': 'incr', 'a': [3], 'O': 'cb1', 'o': ownedPath(shard, 1)}))
+            for i in xrange(100):
+                if replies:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(replies, [{'r': 4, 'o': 'cb1'}])
+        finally:
+            router.stop()
+            for thread in threads:
+                thread.join()
+            for worker in workers + [client]:
+                worker.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 """Dictionary of persistent objects."""
 
+import threading
 import weakref
-from serf.serializer import encodes, decodes, SerializationError
+from collections import deque
+from serf.serializer import encodes, decodes, compress, SerializationError, TUPLE, ANY
 from serf.po.file import File
 from serf.ref import Ref
 from serf.proxy import Proxy
@@ -25,6 +27,111 @@ def save_fn(that):
 class NoSuchName(Exception):
     pass
 
+class RecordPlan(object):
+    """What encoding and decoding instances of a serializable class needs.
+
+    Plans are made once per class by recordPlan or classPlan.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = '%s.%s' % (cls.__module__, cls.__name__)
+        self.attrs = [(key, key.lstrip('_')) for key in cls.serialize
+                      if not key.startswith('#')]
+        self.stored = tuple([name for key, name in self.attrs])
+        self.args = [key.lstrip('_') for key in cls.serialize]
+        self.private = bool([key for key in cls.serialize if key.startswith('_')])
+        self.version = getattr(cls, '_version', 0)
+        self.has_save = hasattr(cls, '_save')
+
+    def getDict(self, inst):
+        return dict([(name, getattr(inst, key)) for key, name in self.attrs])
+
+_plans = {} # class -> RecordPlan
+_plans_by_name = {} # 'module.Class' -> RecordPlan
+
+def recordPlan(cls):
+    """Returns the RecordPlan for a class having a serialize tuple."""
+    try:
+        return _plans[cls]
+    except KeyError:
+        plan = _plans[cls] = RecordPlan(cls)
+        return plan
+
+def classPlan(name):
+    """Returns the RecordPlan for the class with the given full name."""
+    try:
+        return _plans_by_name[name]
+    except KeyError:
+        plan = _plans_by_name[name] = recordPlan(importSymbol(name))
+        return plan
+
+TYPES_PATH = '.types'
+
+class ClassIds(object):
+    """Numeric type ids for the serializable classes kept in a store.
+
+    Each id stands for a class name, a version and the names of the
+    stored attributes, so that an instance can be written as an '@'
+    message holding just its attribute values. The table is kept in
+    the store itself, at TYPES_PATH.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.entries = None # [(name, version, stored)], indexed by id - 1
+        self.ids = {}
+        self.codecs = {}
+        self.lock = threading.Lock() # held by _load and _add callers
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = []
+        try:
+            saved = decodes(self.store[TYPES_PATH])
+        except KeyError:
+            saved = []
+        for name, version, stored in saved:
+            self._add((name, version, tuple(stored)))
+
+    def _add(self, entry):
+        self.entries.append(entry)
+        type_id = len(self.entries)
+        self.ids[entry] = type_id
+        self.codecs[type_id] = TUPLE(*[ANY] * len(entry[2]))
+        return type_id
+
+    def idFor(self, plan):
+        """Returns the id for instances of the class of plan."""
+        entry = (plan.name, plan.version, plan.stored)
+        with self.lock:
+            self._load()
+            try:
+                return self.ids[entry]
+            except KeyError:
+                type_id = self._add(entry)
+                self.store[TYPES_PATH] = encodes([list(e) for e in self.entries])
+                return type_id
+
+    def entry(self, type_id):
+        with self.lock:
+            self._load()
+            if not 0 < type_id <= len(self.entries):
+                raise SerializationError('unknown type id %d' % type_id)
+            return self.entries[type_id - 1]
+
+    def codec(self, type_id):
+        with self.lock:
+            self._load()
+            return self.codecs.get(type_id)
+
+def hasTypes(store):
+    """Returns whether store has a ClassIds table."""
+    try:
+        store[TYPES_PATH]
+    except KeyError:
+        return False
+    return True
+
 class StorageCtx(object):
     def __init__(self, storage, path=None):
         self.storage = weakref.ref(storage)
@@ -41,24 +148,47 @@ class StorageCtx(object):
         if name == 'ref':
             return Ref(storage, data['path'], data.get('facet'))
         if name == 'inst':
-            cls = importSymbol(storage.map_class(data['CLS']))
+            plan = classPlan(storage.map_class(data['CLS']))
+            cls = plan.cls
             data['#vat'] = storage
             data.update(storage.resources)
             # Check for version change.
             data_version = data.get('$version', 0)
-            cls_version = getattr(cls, '_version', 0)
-            if cls_version != data_version:
+            if plan.version != data_version:
                 cls._upgrade(data, data_version)
-            args = [data.get(key.lstrip('_')) for key in cls.serialize]
-            inst = cls(*args)
-            if cls_version != data_version:
+            inst = cls(*[data.get(key) for key in plan.args])
+            if plan.version != data_version:
                 # Ensure new nested serializables get correct _save hook.
                 encodes(inst, self)
-            if hasattr(cls, '_save'):
+            if plan.has_save:
                 inst._save = self.save
             return inst
+        if name.startswith('inst:'):
+            return self._instance(storage, int(name[5:]), data)
         raise SerializationError(name)
 
+    def _instance(self, storage, type_id, values):
+        name, version, stored = storage.class_ids.entry(type_id)
+        plan = classPlan(storage.map_class(name))
+        if plan.version != version or plan.stored != stored:
+            data = dict(zip(stored, values))
+            data['CLS'] = name
+            data['$version'] = version
+            return self.custom('inst', data)
+        values = iter(values)
+        args = []
+        for key in plan.args:
+            if key == '#vat':
+                args.append(storage)
+            elif key.startswith('#'):
+                args.append(storage.resources.get(key))
+            else:
+                args.append(values.next())
+        inst = plan.cls(*args)
+        if plan.has_save:
+            inst._save = self.save
+        return inst
+
     def record(self, inst):
         cls = type(inst)
         # Replace any instance having a slot somewhere with its Ref.
@@ -71,42 +201,87 @@ class StorageCtx(object):
                 data['facet'] = inst._facet
             return 'ref', data
         if type(getattr(cls, 'serialize', None)) is tuple:
-            data = getDict(inst)
-            data['CLS'] = '%s.%s' % (cls.__module__, cls.__name__)
-            version = getattr(cls, '_version', None)
-            if version:
-                data['$version'] = version
-            if hasattr(cls, '_save'):
+            plan = recordPlan(cls)
+            class_ids = self.storage().class_ids
+            if class_ids is not None:
+                if plan.has_save:
+                    inst._save = self.save
+                values = [getattr(inst, key) for key, name in plan.attrs]
+                return 'inst:%d' % class_ids.idFor(plan), values
+            data = plan.getDict(inst)
+            data['CLS'] = plan.name
+            if plan.version:
+                data['$version'] = plan.version
+            if plan.has_save:
                 inst._save = self.save
             return 'inst', data
         raise SerializationError(str(cls))
 
     def codec(self, type_id):
+        class_ids = self.storage().class_ids
+        if class_ids is not None:
+            codec = class_ids.codec(type_id)
+            if codec is not None:
+                return codec, 'inst:%d' % type_id
         return None, None
 
     def namedCodec(self, type_name):
+        if type_name.startswith('inst:'):
+            type_id = int(type_name[5:])
+            return self.storage().class_ids.codec(type_id), type_id
         return None, None
 
 
 class Storage(object):
-    def __init__(self, store, cx_factory=None):
+    """Dictionary of persistent objects, kept encoded in store.
+
+    With class_ids, instances are written as '@' messages whose type id
+    (see ClassIds) replaces the class name and attribute names. A store
+    which already has a type table (at TYPES_PATH) always uses them, so
+    that its instances can be read back.
+
+    Objects are cached while referenced elsewhere. With keep_alive, the
+    Storage also references the last keep_alive objects it decoded, so
+    that an object used by successive calls (but not held between
+    them) is not decoded again for each one.
+
+    A Storage may be used from several threads (e.g. by the workers of
+    a WorkerPool): an object is only decoded by one thread at a time so
+    that all threads share the same instance.
+    """
+    def __init__(self, store, cx_factory=None, compress_min=None, class_ids=False,
+                 keep_alive=0):
         self.store = store # stuff on disk
+        self.compress_min = compress_min # compress larger encodings
+        if class_ids or hasTypes(store):
+            self.class_ids = ClassIds(store)
+        else:
+            self.class_ids = None
         self.cache = weakref.WeakValueDictionary()
+        self.recent = deque(maxlen=keep_alive) # last decoded objects, kept cached
         self.resources = {}
         self.make_context = StorageCtx if cx_factory is None else cx_factory
         self.node_id = None
         self.map_class = lambda c: c
+        self.shard = None # new paths must be owned by this shard
+        self.lock = threading.RLock() # held while decoding into the cache
 
     def __getitem__(self, path):
         # we get instantiated values
-        if path in self.cache:
-            return self.cache[path]
-        ctx = self.make_context(self, path)
-        obj = decodes(self.store[path], ctx)
-        self._addRef(path, obj)
-        if type(getattr(obj, 'ref', None)) is Ref:
-            self.cache[path] = obj
-        return obj
+        obj = self.cache.get(path)
+        if obj is not None:
+            return obj
+        with self.lock:
+            obj = self.cache.get(path)
+            if obj is not None:
+                return obj
+            ctx = self.make_context(self, path)
+            obj = decodes(self.store[path], ctx)
+            self._addRef(path, obj)
+            if type(getattr(obj, 'ref', None)) is Ref:
+                self.cache[path] = obj
+                self.recent.append(obj)
+            return obj
 
     def _addRef(self, path, svalue):
         if type(getattr(svalue, 'serialize', None)) is tuple:
@@ -125,20 +300,22 @@ class Storage(object):
         if type(ref) is Ref:
             if ref._path != path:
                 svalue = ref
-            self.cache[path] = svalue
+            with self.lock:
+                self.cache[path] = svalue
 
     def save(self, path, svalue=Unique):
         if svalue is Unique:
             svalue = self.cache[path]
         ctx = self.make_context(self, path)
-        self.store[path] = encodes(svalue, ctx)
+        data = encodes(svalue, ctx)
+        if self.compress_min is not None:
+            data = compress(data, self.compress_min)
+        self.store[path] = data
 
     def __delitem__(self, path):
         del self.store[path]
-        try:
-            del self.cache[path]
-        except KeyError:
-            pass
+        with self.lock:
+            self.cache.pop(path, None)
 
     def __contains__(self, path):
         return path in self.store
@@ -146,14 +323,20 @@ class Storage(object):
     def getRef(self, path):
         return Ref(self, path)
 
+    def _newPath(self):
+        path = randomString()
+        while self.shard is not None and not self.shard.owns(path):
+            path = randomString()
+        return path
+
     def makeRef(self, svalue=None, vat_id=None):
-        ref = Ref(self, randomString())
+        ref = Ref(self, self._newPath())
         if svalue is not None:
             ref._set(svalue)
         return ref
 
     def makeFile(self, ref=False):
-        file = File(self, randomString())
+        file = File(self, self._newPath())
         if ref:
             r = Ref(self, file.path)
             r._set(file)
@@ -205,8 +388,7 @@ class NameStore(object):
         del self.store[name]
 
 def getDict(inst):
-    return dict([(key.lstrip('_'), getattr(inst, key)) for key in inst.serialize
-                 if not key.startswith('#')])
+    return recordPlan(type(inst)).getDict(inst)
 
 def _str(inst, lev=0):
     ind = '  ' * lev
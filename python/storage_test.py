@@ -2,9 +2,12 @@
 
 """Tests for Storage."""
 
+import threading
+import time
 import unittest
 from serf.util import EqualityMixin, Capture
 from serf.storage import Storage, NameStore, fcat, _str, NoSuchName, save_fn
+from serf.storage import recordPlan, classPlan, ClassIds
 from serf.po.data import Data
 from serf.ref import Ref
 from serf.test_person import Person
@@ -58,6 +61,15 @@ class StorageTest(unittest.TestCase):
         self.assertEqual(
             o, TestObject({'name': 'Fred'}, [TestObject('sub', [])]))
 
+    def testCompress(self):
+        store = {}
+        s = Storage(store, compress_min=200)
+        s['small'] = Data({'name': 'Fred'})
+        s['big'] = Data({'names': ['Fred'] * 100})
+        self.assertEqual(store['small'][0], 'R')
+        self.assertEqual(store['big'][0], 'z')
+        self.assertEqual(s['big']['names'].value, ['Fred'] * 100)
+
     def testData(self):
         store = Storage({})
         store['people/data/tom'] = Data({})
@@ -149,6 +161,36 @@ class StorageTest(unittest.TestCase):
         self.assertEqual(type(store['aref']), Ref)
         self.assertEqual(store['a']['foo'], 42)
 
+    def testKeepAlive(self):
+        store = Storage({}, keep_alive=1)
+        store['a'] = Data({'n': 1})
+        store['b'] = Data({'n': 2})
+        self.assertEqual(store.cache.values(), [])
+
+        a_id = id(store['a'])
+        self.assertEqual(id(store['a']), a_id) # not decoded again
+        self.assertEqual(len(store.cache), 1)
+
+        store['b'] # pushes out a
+        self.assertEqual(store.cache.keys(), ['b'])
+
+    def testThreads(self):
+        class SlowStore(dict):
+            def __getitem__(self, key):
+                time.sleep(0.01) # let the other thread in
+                return dict.__getitem__(self, key)
+        s = Storage(SlowStore())
+        s['a'] = Data({})
+        found = []
+        def get():
+            found.append(s['a'])
+        threads = [threading.Thread(target=get) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(found[0] is found[1])
+
     def testUnnesting(self):
         store = Storage({})
         data = Data({})
@@ -205,6 +247,80 @@ class StorageTest(unittest.TestCase):
         ns = NameStore(s, {})
         self.assertRaises(NoSuchName, ns.getn, 'bimbo')
 
+    def testRecordPlan(self):
+        plan = recordPlan(NewV)
+        self.assertTrue(recordPlan(NewV) is plan)
+        self.assertTrue(classPlan(plan.name) is plan)
+        self.assertEqual(plan.args, ['info'])
+        self.assertEqual(plan.version, 1)
+        self.assertFalse(plan.has_save)
+        self.assertEqual(plan.getDict(NewV('x')), {'info': 'x'})
+        self.assertTrue(recordPlan(Obj).has_save)
+
+    def testClassIds(self):
+        store = {}
+        s = Storage(store, class_ids=True)
+        s['a'] = TestObject({'name': 'Fred'}, [TestObject('sub', [])])
+        s['o'] = Obj({'x': 1})
+        self.assertEqual(store['a'][0], '@')
+        self.assertTrue('.types' in store)
+
+        plain = {}
+        Storage(plain)['a'] = TestObject({'name': 'Fred'}, [TestObject('sub', [])])
+        self.assertTrue(len(store['a']) < len(plain['a']))
+
+        s2 = Storage(store, class_ids=True)
+        o = s2['a']
+        del o.ref
+        self.assertEqual(o, TestObject({'name': 'Fred'}, [TestObject('sub', [])]))
+        s2['o']['y'] = 2
+        self.assertEqual(Storage(store, class_ids=True)['o'].data, {'x': 1, 'y': 2})
+
+        # The store's type table turns class ids on when not asked for.
+        self.assertEqual(Storage(store)['o'].data, {'x': 1, 'y': 2})
+        self.assertEqual(Storage(plain).class_ids, None)
+
+    def testClassIdsThreads(self):
+        class SlowStore(dict):
+            # Let other threads in while loading and saving.
+            def __getitem__(self, key):
+                time.sleep(0.001)
+                return dict.__getitem__(self, key)
+            def __setitem__(self, key, value):
+                time.sleep(0.001)
+                dict.__setitem__(self, key, value)
+        class Plan(object):
+            def __init__(self, name):
+                self.name, self.version, self.stored = name, 0, ('x',)
+        store = SlowStore()
+        ClassIds(store).idFor(Plan('Old'))
+        ids = ClassIds(store)
+        found = {}
+        def run(i):
+            for j in range(5):
+                found[i, j] = ids.idFor(Plan('C%d.%d' % (i, j)))
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(found.values()), range(2, 22))
+        reloaded = ClassIds(store)
+        self.assertEqual(reloaded.entry(1)[0], 'Old')
+        for (i, j), type_id in found.items():
+            self.assertEqual(reloaded.entry(type_id)[0], 'C%d.%d' % (i, j))
+
+    def testClassIdsVersioning(self):
+        store = {}
+        s = Storage(store, class_ids=True)
+        s['v'] = V('info')
+
+        s2 = Storage(store, class_ids=True)
+        s2.map_class = lambda c: c.replace('.V', '.NewV')
+        v = s2['v']
+        self.assertEqual(type(v), NewV)
+        self.assertEqual(v.info, 'info-updated')
+
     def testVersioning(self):
         s = Storage({})
         s['v'] = V('info')
@@ -14,7 +14,7 @@ class Result(object):
         self.exc = exc
         self.called = True
 
-    def wait(self):
+    def wait(self, timeout=None):
         if not self.called:
             raise Exception('Callback not called.')
         if self.exc is not None:
@@ -28,6 +28,9 @@ class Synchronous(object):
     def call(self, func, *args):
         func(*args)
 
+    def inDispatchThread(self):
+        return True # replies are handled by whichever thread calls
+
     def makeCallback(self):
         return Result()
 
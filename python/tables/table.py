@@ -6,7 +6,7 @@ import sys
 from itertools import islice
 
 from serf.publisher import Publisher
-from serf.serializer import decodes, encodes
+from serf.serializer import decodes, decodeView, encodes
 
 from query import getMember, setMember, checkField, QTerm
 
@@ -211,7 +211,7 @@ class Indexer(object):
         self.fold_case = self.type.endswith('-i')
 
     def index_r(self, rec):
-        return self.index(decodes(rec))
+        return self.index(decodeView(rec))
 
     def index(self, rec):
         field = getMember(rec, self.col)
@@ -236,7 +236,7 @@ class ColsIndexer(object):
 
     def index_r(self, raw_rec):
         try:
-            return self.index(decodes(raw_rec))
+            return self.index(decodeView(raw_rec))
         except:
             return '\0'
 
@@ -323,7 +323,7 @@ class Query(object):
     def filter(self, iter):
         for kv in iter:
             try:
-                rec = decodes(kv.value)
+                rec = decodeView(kv.value)
             except:
                 # Ignore/reject records which cannot be decoded.
                 continue
@@ -366,15 +366,17 @@ class Table(Publisher):
         self._pkey = pkey or 0
         self._indexers = {}
 
-    def select_r(self, filter=None):
+    def _select_r(self, filter=None):
         gen, filters = genFilters(filter)
         result = gen.generate(self)
         for f in filters:
             if not hasattr(f, 'filter'):
                 f = Query(f) # assume it's a query
             result = f.filter(result)
-        # Should we return an iterator?
-        return list(result)
+        return result
+
+    def select_r(self, filter=None):
+        return list(self._select_r(filter))
 
     def select(self, filter=None):
         kvl = self.select_r(filter)
@@ -382,6 +384,15 @@ class Table(Publisher):
             kv.value = decodes(kv.value)
         return kvl
 
+    def iselect(self, filter=None):
+        """Like select but returns an iterator.
+
+        Called remotely, the results are streamed to the caller.
+        """
+        for kv in self._select_r(filter):
+            kv.value = decodes(kv.value)
+            yield kv
+
     def _selectAll(self):
         return [KeyValue(pkey, data)
                 for pkey, data in sorted(self._primary.iteritems())]
@@ -298,6 +298,8 @@ class TableTest(unittest.TestCase):
         self.assertEqual(self.table.maxPK(), 12)
         results = self.table.select()
         self.assertEqual(len(results), 3)
+        self.assertEqual([kv.value for kv in self.table.iselect()],
+                         [kv.value for kv in results])
 
     def testSelectKey(self):
         self._insertTestData()
@@ -31,6 +31,12 @@ class ThreadModel(object):
         """Runs func(*args) in a thread. May be called from any thread."""
         pass
 
+    def inDispatchThread(self):
+        """Returns whether the current thread is one which delivers replies.
+
+        Such a thread must not block waiting for a reply."""
+        pass
+
     def makeCallback(self):
         """Make an object for passing a result or exception between threads.
 
@@ -0,0 +1,63 @@
+"""Hashed timer wheel for expiring large numbers of deadlines."""
+
+import threading
+
+class TimerWheel(object):
+    """Keeps a deadline for each of a set of keys.
+
+    Deadlines are hashed into slots of tick seconds each, so that adding
+    and removing a key is O(1) and advance only looks at the slots whose
+    time has passed.
+
+    :param tick: resolution in seconds
+    :param slots: number of slots in the wheel
+    """
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [set() for i in xrange(slots)]
+        self.deadlines = {} # key -> (deadline, slot index)
+        self.current = None # ticks before this one have been advanced past
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, key, deadline):
+        """Sets the deadline (in seconds since the epoch) for key."""
+        with self.lock:
+            self._remove(key)
+            t = int(deadline / self.tick)
+            if self.current is not None and t < self.current:
+                t = self.current
+            index = t % len(self.slots)
+            self.deadlines[key] = deadline, index
+            self.slots[index].add(key)
+
+    def remove(self, key):
+        """Forgets the deadline for key, if any."""
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.deadlines.pop(key, None)
+        if entry is not None:
+            self.slots[entry[1]].discard(key)
+
+    def advance(self, now):
+        """Removes and returns the keys whose deadlines are before now."""
+        expired = []
+        with self.lock:
+            tick = int(now / self.tick)
+            if self.current is not None and tick < self.current:
+                return expired
+            n = len(self.slots)
+            first = tick - n + 1 if self.current is None else max(self.current, tick - n + 1)
+            for t in xrange(first, tick + 1):
+                slot = self.slots[t % n]
+                for key in [k for k in slot if self.deadlines[k][0] <= now]:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+            # Keys due later in this tick are looked at next time.
+            self.current = tick
+        return expired
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+"""Tests for TimerWheel."""
+
+import unittest
+from serf.timer_wheel import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    def test(self):
+        w = TimerWheel(tick=1.0, slots=8)
+        w.add('a', 100.5)
+        w.add('b', 102.0)
+        w.add('c', 120.0) # more than one turn of the wheel away
+        self.assertEqual(len(w), 3)
+
+        self.assertEqual(w.advance(100.0), [])
+        self.assertEqual(w.advance(101.0), ['a'])
+        self.assertEqual(w.advance(101.0), [])
+        self.assertEqual(w.advance(110.0), ['b'])
+        self.assertEqual(w.advance(119.9), [])
+        self.assertEqual(w.advance(500.0), ['c'])
+        self.assertEqual(len(w), 0)
+
+    def testRemove(self):
+        w = TimerWheel()
+        w.add('a', 10.0)
+        w.add('b', 10.0)
+        w.remove('a')
+        w.remove('x') # not there: ignored
+        self.assertEqual(w.advance(11.0), ['b'])
+
+    def testLateAdd(self):
+        w = TimerWheel(tick=1.0, slots=8)
+        w.add('a', 10.0)
+        self.assertEqual(w.advance(20.0), ['a'])
+        w.add('b', 5.0) # already past
+        w.add('a', 30.0)
+        w.add('a', 21.0) # moves the deadline
+        self.assertEqual(w.advance(21.0), ['b', 'a'])
+
+    def testFarFirst(self):
+        w = TimerWheel(tick=1.0, slots=8)
+        w.advance(0.0)
+        w.add('far', 50.0)
+        w.add('near', 5.0)
+        self.assertEqual(w.advance(10.0), ['near'])
+        self.assertEqual(w.advance(60.0), ['far'])
+
+if __name__ == '__main__':
+    unittest.main()
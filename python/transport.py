@@ -22,10 +22,19 @@ SSL_CHOICE = 4
 
 SSL_OPTS = ['keyfile', 'certfile', 'cert_reqs', 'ssl_version', 'ca_certs']
 
+# Optional protocol features, offered alongside the SSL options.
+# Z: the peer can decode compressed (serializer.COMPRESSED) messages.
+# I: the peer accepts int reply addresses (see rpc_handler.REPLY_PREFIX).
+FEATURES = 'ZI'
+
 # The SSL/plain handshake. On connection the server sends the client
 # a list of supported options. The client sends back an SSL choice
 # choosing one of the options. If the choice is SSL, both ends then
 # upgrade to SSL before continuing.
+#
+# The server also lists the FEATURES it supports. The client appends
+# to its choice those it supports too; older servers offer none so
+# get a bare choice, and older clients ignore the extra options.
 
 TEMPNODE_RE = re.compile('\d+@\d+(\.\d+){3}:\d+')
 
@@ -61,6 +70,7 @@ class Transport(Publisher):
         self.verbose = verbose
         self.ssl = ssl
         self.conn_num = 0
+        self.features = {}
 
     def readall(self, socket, n):
         """Defragment and read n bytes."""
@@ -101,22 +111,27 @@ class Transport(Publisher):
         # detail of the server and does not affect the protocol.
         ssl_opts = 'SP' if self.ssl else 'P'
 
-        self.write(socket, SSL_OPTIONS, ssl_opts)
+        self.write(socket, SSL_OPTIONS, ssl_opts + FEATURES)
         what, choice = self.read(socket)
         if what == DISCONNECTED:
             return
-        if what != SSL_CHOICE or len(choice) != 1 or (choice not in ssl_opts):
+        if what != SSL_CHOICE or not choice or (choice[0] not in ssl_opts) or (
+            [c for c in choice[1:] if c not in FEATURES]):
             if self.verbose:
                 print 'invalid response to SSL_OPTIONS from', address
             return
-        if choice == 'S':
+        if choice[0] == 'S':
             socket = ssl.wrap_socket(socket, server_side=True, **self.ssl)
         # Could use timestamp rather than conn_num to make node id's
         # forever unique.
         self.conn_num += 1
-        self.process(socket, address, '%%d@%s:%s' % address % self.conn_num)
+        self.process(socket, address, '%%d@%s:%s' % address % self.conn_num, choice[1:])
+
+    def peerFeatures(self, node):
+        """Returns the FEATURES supported by a connected node."""
+        return self.features.get(node, '')
 
-    def process(self, sock, address, node):
+    def process(self, sock, address, node, features=''):
         """Handler for all established connections.
 
         This processes all incoming messages, including the node-name
@@ -140,6 +155,7 @@ class Transport(Publisher):
                     else:
                         print self.node_id, '%s %s connected (unverified)' % (node, address)
                 self.nodes[node] = sock
+                self.features[node] = features
                 self.notify('connected', node)
             elif what == MSG:
                 self.notify('message', {'from': node, 'message': msg})
@@ -211,17 +227,19 @@ class Transport(Publisher):
         if what != SSL_OPTIONS or (
             'S' not in ssl_opts and 'P' not in ssl_opts):
             raise Exception('%s gave no acceptable SSL options' % node)
+        features = ''.join([c for c in FEATURES if c in ssl_opts])
         # We could make this more flexible, having preferences based
         # on the IP range of the server etc.
         if 'S' in ssl_opts:
-            self.write(sock, SSL_CHOICE, 'S')
+            self.write(sock, SSL_CHOICE, 'S' + features)
             sock = ssl.wrap_socket(sock)
         else:
-            self.write(sock, SSL_CHOICE, 'P')
+            self.write(sock, SSL_CHOICE, 'P' + features)
         self.write(sock, NODE_NAME, self.node_id)
         self.nodes[node] = sock
+        self.features[node] = features
         self.notify('connected', node)
-        eventlet.spawn(self.process, sock, address, node)
+        eventlet.spawn(self.process, sock, address, node, features)
         return sock
 
     def sendDisconnect(self, node):
@@ -231,6 +249,7 @@ class Transport(Publisher):
         if node in self.nodes:
             sock = self.nodes.pop(node)
             sock.close()
+        self.features.pop(node, None)
         if not self.nodes:
             self._nobodyConnected()
 
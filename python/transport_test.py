@@ -82,6 +82,8 @@ class TransportTest(unittest.TestCase):
         self.assertEqual(handler.received, ['hi'])
 
         c_node = handler.node_conn
+        self.assertEqual(server.peerFeatures(c_node), FEATURES)
+        self.assertEqual(client.peerFeatures(SERV), FEATURES)
 
         with c_handler.expect(1):
             server.send(c_node, 'hello')
@@ -141,6 +143,14 @@ class TransportTest(unittest.TestCase):
         client.write(sock, SSL_CHOICE, 'R') # no such choice
         reply = sock.recv(1024) # Server will close, this won't block.
         self.assertEqual(reply, '')
+
+        # Connect again: ask for an unsupported feature.
+        sock = eventlet.connect(getAddr(SERV))
+        what, ssl_opts = client.read(sock)
+        self.assertEqual(ssl_opts, 'P' + FEATURES)
+        client.write(sock, SSL_CHOICE, 'PQ')
+        reply = sock.recv(1024)
+        self.assertEqual(reply, '')
         self.assertEqual(len(server.nodes), 0) # Again, no connection.
 
         server.stop()
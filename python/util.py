@@ -43,6 +43,60 @@ def rmap(func, info):
         return func(info)
     return mapfn(func, info)
 
+# Leaf types which rmapShared passes through without calling func.
+SCALAR_TYPES = frozenset([type(None), bool, int, long, str, unicode, float])
+
+def rmapSharedDict(func, d):
+    out = None
+    for k, v in d.iteritems():
+        if type(v) in SCALAR_TYPES:
+            continue
+        w = rmapShared(func, v)
+        if w is not v:
+            if out is None:
+                out = dict(d)
+            out[k] = w
+    return d if out is None else out
+
+def rmapSharedList(func, l):
+    for i, x in enumerate(l):
+        if type(x) in SCALAR_TYPES:
+            continue
+        y = rmapShared(func, x)
+        if y is not x:
+            out = list(l[:i])
+            out.append(y)
+            out.extend([rmapShared(func, z) for z in l[i + 1:]])
+            return out
+    return l
+
+def rmapSharedTuple(func, t):
+    out = rmapSharedList(func, t)
+    return t if out is t else tuple(out)
+
+RMAP_SHARED = {
+    list: rmapSharedList,
+    dict: rmapSharedDict,
+    tuple: rmapSharedTuple
+}
+
+def rmapShared(func, info):
+    """Like rmap but copies only what func changes.
+
+    Scalar leaves (SCALAR_TYPES) are kept without calling func and a
+    container is copied only if something in it changed, so plain data
+    comes back as the very same object. The result may therefore share
+    structure with info.
+    """
+    typ = type(info)
+    if typ in SCALAR_TYPES:
+        return info
+    try:
+        mapfn = RMAP_SHARED[typ]
+    except KeyError:
+        return func(info)
+    return mapfn(func, info)
+
 def removeAll(l, ob):
     """Remove all occurrences of ob from the list l."""
     i = 0
@@ -121,6 +175,34 @@ def timeCall(fn, *args):
     fn(*args)
     print time.time() - begin
 
+def gather(cbs, return_exceptions=False, timeout=None):
+    """Waits for callbacks (as returned by proxy.method_f) to complete.
+
+    Calls made with method_f are all in flight together, so the time
+    taken is that of the slowest rather than the sum.
+
+    Args:
+        cbs: callbacks from any thread model.
+        return_exceptions: return failures in place of results instead
+            of raising the first one.
+        timeout: seconds to wait for all the callbacks together.
+    Returns:
+        The results of cbs, in order.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for cb in cbs:
+        try:
+            if deadline is None:
+                results.append(cb.wait())
+            else:
+                results.append(cb.wait(max(deadline - time.time(), 0)))
+        except Exception, e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
 def importSymbol(path):
     mod_name, sym_name = path.rsplit('.', 1)
     mod = __import__(mod_name, fromlist=['*'])
@@ -4,7 +4,7 @@
 
 import unittest
 import sys
-from serf.util import EqualityMixin, rmap, Capture, getOptions, timeCall
+from serf.util import EqualityMixin, rmap, rmapShared, Capture, getOptions, timeCall
 
 class A(EqualityMixin):
     def __init__(self, arg):
@@ -40,6 +40,17 @@ class UtilTest(unittest.TestCase):
     
         self.assertTrue(A(1) != A(2))
 
+    def testRmapShared(self):
+        pod = {'a': [1, 2.5, (u'x', None)], 'b': 'y'}
+        self.assertTrue(rmapShared(convert, pod) is pod)
+
+        info = {'a': [1, (2, A('foo'))], 'b': [3]}
+        out = rmapShared(convert, info)
+        self.assertEqual(out, {'a': [1, (2, B('foo'))], 'b': [3]})
+        self.assertTrue(out['b'] is info['b']) # unchanged: shared
+        self.assertFalse(out['a'] is info['a'])
+        self.assertEqual(info['a'][1][1], A('foo')) # original untouched
+
     def testCapture(self):
         with Capture() as c:
             print 'not printed'
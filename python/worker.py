@@ -3,10 +3,13 @@
 import atexit
 import threading
 import traceback
+from collections import deque
 
 # The question here is: how expensive are condition variables?
 # Is OK to make a new one for each callback?
 
+WAIT_TIMEOUT = 10 # default seconds to wait for a callback
+
 class Callback(object):
     def __init__(self):
         self.cond = threading.Condition()
@@ -26,10 +29,10 @@ class Callback(object):
             self.called = True
             self.cond.notify()
 
-    def wait(self):
+    def wait(self, timeout=WAIT_TIMEOUT):
         with self.cond:
             if not self.called:
-                self.cond.wait(10)
+                self.cond.wait(timeout)
             if not self.called:
                 raise Exception('timeout')
             if self.exc is not None:
@@ -73,7 +76,9 @@ class Worker(object):
     def __init__(self, scheduler=None):
         self.thread = None
         self.scheduler = Scheduler() if scheduler is None else scheduler
-        self.items = []
+        self.items = deque()
+        self.timers = set() # pending callAfter timers, cancelled by stop
+        self.lock = threading.Lock()
         atexit.register(self.stop)
 
     def start(self):
@@ -89,6 +94,20 @@ class Worker(object):
     def call(self, *args):
         self.items.append(args)
 
+    def callAfter(self, secs, *args):
+        def fire():
+            with self.lock:
+                if timer not in self.timers:
+                    return # cancelled by stop
+                self.timers.remove(timer)
+            self.callFromThread(*args)
+        timer = threading.Timer(secs, fire)
+        timer.setDaemon(True)
+        with self.lock:
+            self.timers.add(timer)
+        timer.start()
+        return timer
+
     def callTS(self, *args):
         if self.thread is None:
             func = args[0]
@@ -102,18 +121,23 @@ class Worker(object):
         if self.thread is None:
             self.thread = threading.currentThread()
         while True:
-            self.items = self.scheduler.wait()
+            self.items = deque(self.scheduler.wait())
             if not self.items:
                 break
             while self.items:
                 try:
-                    args = self.items.pop(0)
+                    args = self.items.popleft()
                     func = args[0]
                     func(*args[1:])
                 except:
                     traceback.print_exc()
 
     def stop(self):
+        with self.lock:
+            timers, self.timers = self.timers, set()
+        for timer in timers:
+            timer.cancel()
+            timer.join()
         if self.thread is None:
             return
         self.scheduler.stop()
@@ -121,5 +145,72 @@ class Worker(object):
         self.thread = None
         self.scheduler.cleanup()
 
+    def inDispatchThread(self):
+        return self.thread is threading.currentThread()
+
+    def makeCallback(self):
+        return Callback()
+
+class WorkerPool(object):
+    """Thread model running calls on a number of Worker threads.
+
+    Calls made with callFor run on the worker chosen by hashing their
+    key. RPCHandler uses the target object's path as the key, so calls
+    to any one object stay ordered and single-threaded while calls to
+    different objects run in parallel.
+
+    Other calls from outside the pool, such as decoding incoming
+    messages, handling replies and timers, run on a separate dispatch
+    worker which runs no object's calls. So a reply reaches an object
+    blocked waiting for it, whichever worker the object is on.
+
+    :param n: number of workers for callFor
+    """
+    def __init__(self, n=4):
+        self.dispatcher = Worker()
+        self.workers = [Worker() for i in xrange(n)]
+
+    def start(self):
+        self.dispatcher.start()
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.dispatcher.stop()
+
+    def _current(self):
+        thread = threading.currentThread()
+        if self.dispatcher.thread is thread:
+            return self.dispatcher
+        for worker in self.workers:
+            if worker.thread is thread:
+                return worker
+        return None
+
+    def call(self, *args):
+        worker = self._current()
+        if worker is None:
+            self.dispatcher.callFromThread(*args)
+        else:
+            worker.call(*args)
+
+    def callFor(self, key, *args):
+        worker = self.workers[hash(key) % len(self.workers)]
+        if worker.thread is threading.currentThread():
+            worker.call(*args)
+        else:
+            worker.callFromThread(*args)
+
+    def callFromThread(self, *args):
+        self.dispatcher.callFromThread(*args)
+
+    def callAfter(self, secs, *args):
+        return self.dispatcher.callAfter(secs, *args)
+
+    def inDispatchThread(self):
+        return self.dispatcher.thread is threading.currentThread()
+
     def makeCallback(self):
         return Callback()
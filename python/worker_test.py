@@ -4,7 +4,7 @@
 
 import threading
 import unittest
-from serf.worker import Worker
+from serf.worker import Worker, WorkerPool
 from serf.test_handler import TestHandler
 
 class WorkerTest(unittest.TestCase):
@@ -25,6 +25,42 @@ class WorkerTest(unittest.TestCase):
             cb.success(42)
         self.assertEqual(th.received, [42])
 
+    def testPool(self):
+        pool = WorkerPool(3)
+        pool.start()
+        try:
+            th = TestHandler()
+            seen = []
+            def record(key, i):
+                seen.append((key, i, threading.currentThread()))
+                th.handle('message', {'message': i})
+            with th.expect(30):
+                for i in range(10):
+                    for key in ['a', 'b', 'c']:
+                        pool.callFor(key, record, key, i)
+            threads = {}
+            for key, i, thread in seen:
+                threads.setdefault(key, set()).add(thread)
+            for key in threads:
+                self.assertEqual(len(threads[key]), 1) # affinity
+                self.assertEqual([i for k, i, t in seen if k == key], range(10))
+
+            cb = pool.makeCallback()
+            pool.callAfter(0.01, cb.success, 'later')
+            self.assertEqual(cb.wait(), 'later')
+        finally:
+            pool.stop()
+
+    def testStopCancelsTimers(self):
+        worker = Worker()
+        worker.start()
+        called = []
+        timer = worker.callAfter(0.05, called.append, 1)
+        worker.stop()
+        timer.join()
+        self.assertEqual(called, [])
+        self.assertEqual(worker.timers, set())
+
 
 if __name__ == '__main__':
     unittest.main()